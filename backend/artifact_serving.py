@@ -0,0 +1,177 @@
+"""
+产物 / 上传文件的下载与预览
+
+- 强 ETag：优先使用文件目录中的内容哈希（sha256），否则退化为 mtime + size；If-None-Match 命中时返回 304
+- 字节范围请求（Range / If-Range）由 FileResponse 处理，大文件可以断点续传和拖动预览
+- 文本类文件（报告、CSV、日志等）按内容哈希缓存 gzip / brotli 压缩副本，只在第一次请求时压缩
+- 图片产物在收集时生成 WebP 缩略图（按内容哈希缓存），前端先加载缩略图，点击再打开原图
+
+未安装 Pillow 时不生成缩略图，未安装 brotli 时只提供 gzip。
+"""
+import os
+import gzip
+import uuid
+import logging
+from typing import Any, Dict, List, Optional
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.abspath(os.path.join("cache", "delivery"))
+THUMBNAIL_DIR = os.path.join(CACHE_DIR, "thumbnails")
+COMPRESSED_DIR = os.path.join(CACHE_DIR, "compressed")
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "480"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+# 小文件压缩收益不明显，过大的文件不值得在请求路径上压缩
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_MAX_BYTES = int(os.getenv("COMPRESS_MAX_MB", "32")) * 1024 * 1024
+
+THUMBNAIL_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"}
+COMPRESSIBLE_MIME_PREFIXES = ("text/",)
+COMPRESSIBLE_MIME_TYPES = {"application/json", "application/xml", "image/svg+xml", "application/javascript"}
+# 服务端的偏好顺序
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def _atomic_write(path: str, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def thumbnail_path(digest: str) -> str:
+    return os.path.join(THUMBNAIL_DIR, digest[:2], f"{digest}.webp")
+
+
+def make_thumbnail(path: str, digest: Optional[str]) -> Optional[str]:
+    """为图片生成 WebP 缩略图，返回缩略图路径；不是图片或无法生成时返回 None"""
+    if Image is None or not digest or os.path.splitext(path)[1].lower() not in THUMBNAIL_EXTENSIONS:
+        return None
+    target = thumbnail_path(digest)
+    if os.path.exists(target):
+        return target
+
+    def write(tmp_path: str):
+        with Image.open(path) as img:
+            img.seek(0)
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            img.save(tmp_path, "WEBP", quality=THUMBNAIL_QUALITY, method=4)
+
+    try:
+        _atomic_write(target, write)
+    except Exception as e:
+        logger.warning(f"Thumbnail failed for {path}: {e}")
+        return None
+    return target
+
+
+def make_thumbnails(entries: List[Optional[Dict[str, Any]]], root: str):
+    """为刚收集到的产物中的图片生成缩略图（在线程池中调用）"""
+    for entry in entries:
+        if entry and entry["mime"].startswith("image/"):
+            make_thumbnail(os.path.join(root, *entry["name"].split("/")), entry["sha256"])
+
+
+def _compressible(mime: str, size: int) -> bool:
+    if not COMPRESS_MIN_BYTES <= size <= COMPRESS_MAX_BYTES:
+        return False
+    return mime.startswith(COMPRESSIBLE_MIME_PREFIXES) or mime in COMPRESSIBLE_MIME_TYPES
+
+
+def _pick_encoding(request: Request) -> Optional[tuple]:
+    accepted = {
+        part.split(";")[0].strip().lower()
+        for part in request.headers.get("accept-encoding", "").split(",")
+        if part.strip() and not part.replace(" ", "").endswith(";q=0")
+    }
+    for encoding, suffix in ENCODINGS:
+        if encoding == "br" and brotli is None:
+            continue
+        if encoding in accepted:
+            return encoding, suffix
+    return None
+
+
+def compressed_variant(path: str, digest: str, encoding: str, suffix: str) -> str:
+    """按内容哈希缓存的压缩副本，不存在时生成"""
+    target = os.path.join(COMPRESSED_DIR, digest[:2], f"{digest}{suffix}")
+    if os.path.exists(target):
+        return target
+
+    def write(tmp_path: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        if encoding == "br":
+            data = brotli.compress(data, quality=9)
+        else:
+            data = gzip.compress(data, compresslevel=6, mtime=0)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+    _atomic_write(target, write)
+    return target
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match 使用弱比较
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag in tags
+
+
+def serve_file(request: Request, path: str, entry: Optional[Dict[str, Any]] = None,
+               filename: Optional[str] = None, cache_control: str = "no-cache") -> Response:
+    """
+    带条件请求 / 范围请求 / 压缩协商的文件响应。
+    entry 为文件目录中的条目（提供 sha256 和 MIME），调用方需保证它与磁盘上的文件一致。
+    """
+    st = os.stat(path)
+    digest = entry.get("sha256") if entry else None
+    mime = entry["mime"] if entry else None
+    etag = f'"{digest}"' if digest else f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers = {"Cache-Control": cache_control}
+
+    # Range 请求针对原始内容，不做压缩
+    encoding = None
+    if digest and mime and "range" not in request.headers and _compressible(mime, st.st_size):
+        encoding = _pick_encoding(request)
+        headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        # 不同编码的表示需要不同的 ETag
+        etag = f'"{digest}-{encoding[0]}"'
+    headers["ETag"] = etag
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if encoding is not None:
+        try:
+            variant = compressed_variant(path, digest, *encoding)
+            headers["Content-Encoding"] = encoding[0]
+            return FileResponse(variant, media_type=mime, headers=headers, filename=filename)
+        except OSError as e:
+            logger.warning(f"Compression failed for {path}: {e}")
+            headers["ETag"] = f'"{digest}"'
+    return FileResponse(path, media_type=mime, headers=headers, filename=filename, stat_result=st)
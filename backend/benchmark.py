@@ -0,0 +1,356 @@
+"""
+离线端到端基准测试
+
+启动一个本地的 OpenAI 兼容流式服务（按脚本输出 <Code>/<Answer> 步骤，可配置 token 速率），
+再在临时目录中启动后端，用 N 个并发 WebSocket 客户端驱动 /ws/chat，统计：
+- 首 token 延迟 (TTFT)、每一步延迟、沙箱执行时间（sandbox_ms 含排队，exec_run_ms 为实际执行）、
+  排队等待、产物收集 (tracker diff) 时间
+- 会话和步骤吞吐量
+
+用法:
+    python benchmark.py --clients 8 --steps 3 --tokens-per-sec 200
+    python benchmark.py --fixtures cache/llm_fixtures          # 回放 record 模式录制的会话
+    python benchmark.py --output result.json --thresholds benchmark_thresholds.json
+
+超出阈值时退出码为 1，便于在不同版本之间跟踪性能回退。
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import socket
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_STEPS = [
+    "<Analyze>读取数据并查看基本统计。</Analyze>\n<Code>\n"
+    "df = pd.DataFrame({'x': np.arange(20000), 'y': np.random.randn(20000).cumsum()})\n"
+    "print(df.describe())\n</Code>",
+    "<Understand>绘制趋势图。</Understand>\n<Code>\n"
+    "fig, ax = plt.subplots(figsize=(6, 3))\nax.plot(df['x'], df['y'])\n"
+    "plt.savefig('trend_{step}.png')\nprint('saved')\n</Code>",
+    "<Code>\nfor i in range(200):\n    print('row', i, df['y'].iloc[i])\n</Code>",
+]
+DEFAULT_ANSWER = (
+    "<Answer>\n# 基准测试报告\n\n![趋势](http://localhost:8080/output/trend_1.png)\n\n"
+    "```python\n[analysis_code.py]\n```\n\n## 结论\n数据呈随机游走。\n</Answer>"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return round(values[index], 1)
+
+
+def summarize(values: List[float]) -> Dict[str, Any]:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": round(max(values), 1) if values else None,
+    }
+
+
+# ---------------- 模拟的 OpenAI 兼容服务 ----------------
+
+def build_fake_llm(args) -> Any:
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    # fixture: 先按请求的缓存键精确匹配；匹配不到时（用户消息、文件列表或模型不同）按步骤序号回放录制的会话
+    fixtures: Dict[str, Dict[str, Any]] = {}
+    fixture_sessions: List[List[Dict[str, Any]]] = []
+    if args.fixtures:
+        from llm_cache import canonical_key, load_fixtures
+        paths = [args.fixtures]
+        if os.path.isdir(args.fixtures):
+            paths = sorted(os.path.join(args.fixtures, f) for f in os.listdir(args.fixtures) if f.endswith(".jsonl"))
+        for path in paths:
+            entries = load_fixtures(path)
+            fixture_sessions.append(entries)
+            fixtures.update((entry["key"], entry) for entry in entries)
+
+    def fixture_chunks(body: Dict[str, Any]) -> List[str]:
+        entry = fixtures.get(canonical_key(body))
+        if entry is None:
+            messages = body.get("messages", [])
+            first_user = next((m.get("content") or "" for m in messages if m.get("role") == "user"), "")
+            # 稳定的摘要（内置 hash() 对 str 按进程随机化），每次回放选中同一个录制会话
+            digest = int(hashlib.sha256(first_user.encode("utf-8")).hexdigest(), 16)
+            session = fixture_sessions[digest % len(fixture_sessions)]
+            step = sum(1 for m in messages if m.get("role") == "assistant")
+            entry = session[min(step, len(session) - 1)]
+        return entry["chunks"]
+
+    def scripted_text(messages: List[Dict[str, Any]]) -> str:
+        executed = sum(1 for m in messages if "<Execute>" in (m.get("content") or ""))
+        if executed < args.steps:
+            return DEFAULT_STEPS[executed % len(DEFAULT_STEPS)].replace("{step}", str(executed))
+        return DEFAULT_ANSWER
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "bench", "object": "model", "created": 0, "owned_by": "bench"}]}
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        if fixture_sessions:
+            chunks = fixture_chunks(body)
+        else:
+            text = scripted_text(body.get("messages", []))
+            size = max(1, args.chunk_chars)
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+
+        # 按字符估算 token 速率（中英文混合约 3 字符 / token）
+        delay = args.chunk_chars / 3 / args.tokens_per_sec if args.tokens_per_sec > 0 else 0
+
+        async def stream():
+            await asyncio.sleep(args.first_token_ms / 1000)
+            for piece in chunks:
+                data = {
+                    "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": body.get("model"),
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+                if delay:
+                    await asyncio.sleep(delay)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def run_fake_llm(args):
+    import uvicorn
+    sys.path.insert(0, BACKEND_DIR)
+    uvicorn.run(build_fake_llm(args), host="127.0.0.1", port=args.llm_port, log_level="warning")
+
+
+# ---------------- 后端进程 ----------------
+
+def wait_port(port: int, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def start_processes(args, work_dir: str) -> List[subprocess.Popen]:
+    fake_cmd = [
+        sys.executable, os.path.abspath(__file__), "--serve-fake-llm",
+        "--llm-port", str(args.llm_port), "--steps", str(args.steps),
+        "--tokens-per-sec", str(args.tokens_per_sec), "--chunk-chars", str(args.chunk_chars),
+        "--first-token-ms", str(args.first_token_ms),
+    ]
+    if args.fixtures:
+        fake_cmd += ["--fixtures", os.path.abspath(args.fixtures)]
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.llm_port}/v1",
+        "BACKEND_PORT": str(args.backend_port),
+        "LLM_CACHE_MODE": "off",
+    })
+    # 默认为每个并发会话预热一个内核，测量稳态性能而不是内核冷启动
+    env.setdefault("KERNEL_WARM_SPARES", str(args.clients))
+    fake = subprocess.Popen(fake_cmd, cwd=work_dir, env=env)
+    backend = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND_DIR, "main.py")],
+        cwd=work_dir, env=env,
+        stdout=open(os.path.join(work_dir, "backend.log"), "w"), stderr=subprocess.STDOUT,
+    )
+    processes = [fake, backend]
+    if not wait_port(args.llm_port, 30) or not wait_port(args.backend_port, 60):
+        stop_processes(processes)
+        raise RuntimeError(f"Failed to start benchmark servers, see {work_dir}/backend.log")
+    return processes
+
+
+def stop_processes(processes: List[subprocess.Popen]):
+    for proc in processes:
+        proc.terminate()
+    for proc in processes:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+# ---------------- 客户端 ----------------
+
+async def run_client(args, index: int, metrics: Dict[str, List[float]]) -> Dict[str, Any]:
+    import websockets
+
+    uri = f"ws://127.0.0.1:{args.backend_port}/ws/chat"
+    started = time.perf_counter()
+    steps = 0
+    step_started = None
+    result = {"client": index, "ok": False}
+    async with websockets.connect(uri, max_size=None) as ws:
+        await ws.send(json.dumps({"message": "分析数据", "model": "bench", "max_steps": args.steps + 3}))
+        while True:
+            raw = await asyncio.wait_for(ws.recv(), args.timeout)
+            data = json.loads(raw)
+            frames = data["frames"] if data.get("type") == "batch" else [data]
+            done = False
+            for frame in frames:
+                kind = frame.get("type")
+                now = time.perf_counter()
+                if kind == "step_update":
+                    if step_started is not None:
+                        metrics["step_ms"].append((now - step_started) * 1000)
+                    step_started = now
+                    steps += 1
+                elif kind == "llm_timing" and frame.get("ttft_ms") is not None:
+                    metrics["ttft_ms"].append(frame["ttft_ms"])
+                elif kind == "exec_timing":
+                    metrics["sandbox_ms"].append(frame["sandbox_ms"])
+                    metrics["collect_ms"].append(frame["collect_ms"])
+                elif kind == "step_metrics" and "exec_run" in frame.get("spans_ms", {}):
+                    # sandbox_ms 包含调度排队时间，exec_run 只是沙箱中的实际执行时间
+                    metrics["exec_run_ms"].append(frame["spans_ms"]["exec_run"])
+                elif kind == "exec_start":
+                    metrics["exec_wait_ms"].append(frame.get("wait_ms") or 0)
+                elif kind == "error":
+                    result["error"] = frame.get("content")
+                elif kind == "done":
+                    done = True
+            if done:
+                break
+    if step_started is not None:
+        metrics["step_ms"].append((time.perf_counter() - step_started) * 1000)
+    elapsed = time.perf_counter() - started
+    metrics["session_ms"].append(elapsed * 1000)
+    result.update({"ok": "error" not in result, "steps": steps, "elapsed_ms": round(elapsed * 1000, 1)})
+    return result
+
+
+async def drive(args) -> Dict[str, Any]:
+    metrics: Dict[str, List[float]] = {
+        k: [] for k in ("ttft_ms", "step_ms", "sandbox_ms", "exec_run_ms", "collect_ms", "exec_wait_ms", "session_ms")
+    }
+    # 预热一个会话，排除内核冷启动等一次性开销
+    if args.warmup:
+        await run_client(args, -1, {k: [] for k in metrics})
+
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(run_client(args, i, metrics) for i in range(args.clients)), return_exceptions=True
+    )
+    wall = time.perf_counter() - started
+
+    failures = [r for r in results if isinstance(r, BaseException) or not r.get("ok")]
+    total_steps = sum(r.get("steps", 0) for r in results if isinstance(r, dict))
+    return {
+        "config": {
+            "clients": args.clients, "steps": args.steps, "tokens_per_sec": args.tokens_per_sec,
+            "chunk_chars": args.chunk_chars, "first_token_ms": args.first_token_ms,
+            "fixtures": bool(args.fixtures),
+        },
+        "wall_s": round(wall, 2),
+        "failures": len(failures),
+        "errors": [str(r) if isinstance(r, BaseException) else r.get("error") for r in failures][:5],
+        "throughput": {
+            "sessions_per_min": round(args.clients / wall * 60, 2) if wall else None,
+            "steps_per_sec": round(total_steps / wall, 2) if wall else None,
+        },
+        "metrics": {k: summarize(v) for k, v in metrics.items()},
+    }
+
+
+def check_thresholds(result: Dict[str, Any], thresholds: Dict[str, Any]) -> List[str]:
+    """阈值格式: {"metrics.step_ms.p95": 2000, "throughput.steps_per_sec": {"min": 1.0}}"""
+    violations = []
+    for path, limit in thresholds.items():
+        value: Any = result
+        for part in path.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        if value is None:
+            continue
+        if isinstance(limit, dict):
+            if "max" in limit and value > limit["max"]:
+                violations.append(f"{path} = {value} > max {limit['max']}")
+            if "min" in limit and value < limit["min"]:
+                violations.append(f"{path} = {value} < min {limit['min']}")
+        elif value > limit:
+            violations.append(f"{path} = {value} > {limit}")
+    return violations
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="DataSight Agent 离线端到端基准测试")
+    parser.add_argument("--clients", type=int, default=4, help="并发会话数")
+    parser.add_argument("--steps", type=int, default=3, help="每个会话的 <Code> 步数（之后输出 <Answer>）")
+    parser.add_argument("--tokens-per-sec", type=float, default=300, help="模拟的 LLM 输出速率，0 表示不限速")
+    parser.add_argument("--chunk-chars", type=int, default=6, help="每个流式 chunk 的字符数")
+    parser.add_argument("--first-token-ms", type=float, default=50, help="模拟的首 token 延迟")
+    parser.add_argument("--fixtures", help="回放 LLM_CACHE_MODE=record 录制的 fixture (文件或目录)")
+    parser.add_argument("--timeout", type=float, default=120, help="单帧等待超时（秒）")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="不运行预热会话")
+    parser.add_argument("--output", help="结果写入 JSON 文件")
+    parser.add_argument("--thresholds", help="回归阈值 JSON 文件")
+    parser.add_argument("--keep", action="store_true", help="保留临时工作目录")
+    parser.add_argument("--llm-port", type=int, default=0)
+    parser.add_argument("--backend-port", type=int, default=0)
+    parser.add_argument("--serve-fake-llm", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.serve_fake_llm:
+        run_fake_llm(args)
+        return 0
+
+    args.llm_port = args.llm_port or free_port()
+    args.backend_port = args.backend_port or free_port()
+    work_dir = tempfile.mkdtemp(prefix="datasight_bench_")
+    processes = start_processes(args, work_dir)
+    try:
+        result = asyncio.run(drive(args))
+    finally:
+        stop_processes(processes)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    exit_code = 1 if result["failures"] else 0
+    if args.thresholds:
+        with open(args.thresholds, "r", encoding="utf-8") as f:
+            violations = check_thresholds(result, json.load(f))
+        for violation in violations:
+            print(f"[REGRESSION] {violation}")
+        if violations:
+            exit_code = 1
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3 @@
+# test_connection.py / test_proxy.py / test_pdf_conversion.py 是需要运行中的服务或命令行参数的手动脚本，
+# 不参与 pytest 收集
+collect_ignore = ["test_connection.py", "test_proxy.py", "test_pdf_conversion.py"]
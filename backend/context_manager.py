@@ -0,0 +1,246 @@
+"""
+对话上下文管理
+
+- 使用 tiktoken 统计 token（不可用时退化为字符估算）
+- 完整的对话记录 (transcript) 单独保存，用于生成报告
+- 发送给 LLM 的历史 (history) 超出预算时原地压缩：
+  先截断旧的代码执行输出，再精简旧的推理内容，最后丢弃最早的中间轮次
+- 请求布局对上游前缀缓存 (vLLM/SGLang prefix caching) 友好：
+  system prompt 固定不变，历史只追加，易变状态（文件列表等）只作为末尾的一条增量消息发送
+"""
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+
+# 每条消息的格式开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+TIKTOKEN_ENCODING = "cl100k_base"
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is not None or _encoding_failed:
+        return _encoding
+    with _encoding_lock:
+        if _encoding is None and not _encoding_failed:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+            except Exception:
+                # 离线环境可能无法下载编码表
+                _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """统计文本的 token 数"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return max(1, len(text) // 3)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(count_tokens(m.get("content") or "") + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def truncate_middle(text: str, max_tokens: int, note: str = "已省略") -> str:
+    """保留开头和结尾，中间用省略标记替换"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    lines = text.splitlines()
+    head: List[str] = []
+    tail: List[str] = []
+    budget = max_tokens // 2
+    used = 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        head.append(line)
+        used += cost
+    used = 0
+    for line in reversed(lines[len(head):]):
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        tail.insert(0, line)
+        used += cost
+
+    omitted = len(lines) - len(head) - len(tail)
+    if omitted <= 0:
+        # 单行超长：按字符截断
+        keep = max(1, max_tokens * 3 // 2)
+        return f"{text[:keep]}\n[... {note} {len(text) - 2 * keep} 字符 ...]\n{text[-keep:]}"
+    return "\n".join(head + [f"[... {note} {omitted} 行 ...]"] + tail)
+
+
+class ConversationContext:
+    """
+    管理一个会话的消息历史。
+    history 中的每条消息带有内部字段 `kind`，发送前会被去掉。
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        token_budget: int = 64000,
+        keep_recent_outputs: int = 2,
+        compact_output_tokens: int = 400,
+        compact_text_tokens: int = 200,
+    ):
+        self.token_budget = token_budget
+        self.keep_recent_outputs = keep_recent_outputs
+        self.compact_output_tokens = compact_output_tokens
+        self.compact_text_tokens = compact_text_tokens
+        self.transcript: List[Dict[str, Any]] = []
+        self.history: List[Dict[str, Any]] = []
+        self.compactions = 0
+        self.tokens_saved = 0
+        self.last_stats: Dict[str, Any] = {}
+        self._last_sent: List[str] = []
+        self._add("system", system_prompt, kind="prompt")
+
+    def _add(self, role: str, content: str, kind: str):
+        message = {"role": role, "content": content}
+        self.transcript.append(dict(message))
+        self.history.append({**message, "kind": kind, "tokens": count_tokens(content)})
+
+    def add_user(self, content: str):
+        self._add("user", content, kind="user")
+
+    def add_system(self, content: str):
+        self._add("system", content, kind="system")
+
+    def add_assistant(self, content: str):
+        self._add("assistant", content, kind="assistant")
+
+    def add_execution(self, content: str):
+        """代码执行结果只作为一条 user 消息（环境反馈）加入历史"""
+        self._add("user", content, kind="execution")
+
+    def _history_tokens(self) -> int:
+        return sum(m["tokens"] + MESSAGE_OVERHEAD_TOKENS for m in self.history)
+
+    def _replace(self, message: Dict[str, Any], content: str):
+        tokens = count_tokens(content)
+        self.tokens_saved += max(0, message["tokens"] - tokens)
+        message["content"] = content
+        message["tokens"] = tokens
+        message["compacted"] = True
+
+    def compact(self):
+        """超出预算时原地压缩历史（压缩结果会保留，保证之后的请求前缀稳定）"""
+        if self._history_tokens() <= self.token_budget:
+            return
+        self.compactions += 1
+
+        # 1. 截断较早的代码执行输出
+        executions = [m for m in self.history if m["kind"] == "execution"]
+        for message in executions[:-self.keep_recent_outputs or None]:
+            if not message.get("compacted") and message["tokens"] > self.compact_output_tokens:
+                self._replace(message, truncate_middle(message["content"], self.compact_output_tokens))
+        if self._history_tokens() <= self.token_budget:
+            return
+
+        # 2. 精简较早的 assistant / system 消息
+        for message in self.history[1:-4]:
+            if message["kind"] in ("assistant", "system") and not message.get("compacted") \
+                    and message["tokens"] > self.compact_text_tokens:
+                self._replace(message, truncate_middle(message["content"], self.compact_text_tokens))
+        if self._history_tokens() <= self.token_budget:
+            return
+
+        # 3. 丢弃最早的中间轮次，保留 system prompt 和第一条用户指令
+        first_user = next((i for i, m in enumerate(self.history) if m["kind"] == "user"), 0)
+        keep_head = first_user + 1
+        dropped = 0
+        while self._history_tokens() > self.token_budget and len(self.history) > keep_head + 4:
+            removed = self.history.pop(keep_head)
+            if removed["kind"] == "omitted":
+                dropped += removed.get("dropped", 0)
+            else:
+                dropped += 1
+            self.tokens_saved += removed["tokens"]
+        if dropped:
+            note = f"[... 较早的 {dropped} 条消息已省略以节省上下文 ...]"
+            self.history.insert(keep_head, {
+                "role": "user", "content": note, "kind": "omitted",
+                "tokens": count_tokens(note), "dropped": dropped,
+            })
+
+    @staticmethod
+    def _fingerprint(message: Dict[str, str]) -> str:
+        raw = f"{message['role']}\x00{message['content']}".encode("utf-8")
+        return hashlib.sha1(raw).hexdigest()
+
+    def build(self, volatile: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        压缩后生成发送给 LLM 的消息列表，并记录 token 统计。
+        volatile 为本次请求的易变状态，只追加在末尾、不写入历史，保证前缀字节稳定。
+        """
+        self.compact()
+        messages = [{"role": m["role"], "content": m["content"]} for m in self.history]
+        prompt_tokens = self._history_tokens()
+        if volatile:
+            messages.append({"role": "system", "content": volatile})
+            prompt_tokens += count_tokens(volatile) + MESSAGE_OVERHEAD_TOKENS
+
+        # 与上一次请求相同的前缀长度，用于验证上游前缀缓存是否可以复用
+        fingerprints = [self._fingerprint(m) for m in messages]
+        reused = 0
+        for previous, current in zip(self._last_sent, fingerprints):
+            if previous != current:
+                break
+            reused += 1
+        self._last_sent = fingerprints
+        reused_tokens = sum(m["tokens"] + MESSAGE_OVERHEAD_TOKENS for m in self.history[:reused])
+
+        self.last_stats = {
+            "prompt_tokens": prompt_tokens,
+            "token_budget": self.token_budget,
+            "messages": len(messages),
+            "transcript_messages": len(self.transcript),
+            "compactions": self.compactions,
+            "tokens_saved": self.tokens_saved,
+            "prefix_reused_messages": reused,
+            "prefix_reused_tokens": reused_tokens,
+        }
+        return messages
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.last_stats)
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        可 JSON 序列化的快照（压缩后的历史和统计），用于会话持久化。
+        完整的 transcript 不在快照中，由调用方单独追加保存。
+        """
+        return {
+            "history": self.history,
+            "compactions": self.compactions,
+            "tokens_saved": self.tokens_saved,
+            "last_sent": self._last_sent,
+        }
+
+    @classmethod
+    def from_state(
+        cls, system_prompt: str, state: Dict[str, Any], transcript: List[Dict[str, Any]], **kwargs
+    ) -> "ConversationContext":
+        """从快照恢复上下文；system prompt 已变化时使用新的版本"""
+        context = cls(system_prompt, **kwargs)
+        history = [dict(m) for m in state.get("history", [])]
+        if history and history[0].get("kind") == "prompt" and history[0]["content"] != system_prompt:
+            history[0] = dict(context.history[0])
+        context.history = history or context.history
+        context.transcript = [dict(m) for m in transcript] or context.transcript
+        context.compactions = state.get("compactions", 0)
+        context.tokens_saved = state.get("tokens_saved", 0)
+        context._last_sent = list(state.get("last_sent", []))
+        return context
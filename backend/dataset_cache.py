@@ -0,0 +1,308 @@
+"""
+列式数据集缓存
+
+上传的 CSV / Excel 会被转换成按内容哈希命名的列式缓存文件：
+- 安装了 pyarrow 时使用 Arrow IPC (Feather, 不压缩，可内存映射)
+- 否则退化为 pickle
+
+沙箱内核预先注入了 `load(filename)`，命中缓存时毫秒级返回 DataFrame。
+本模块不在顶层导入 pandas，服务进程只在子进程中构建缓存。
+"""
+import os
+import sys
+import json
+import glob
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+CACHE_DIR = os.path.abspath(os.getenv("DATASET_CACHE_DIR", os.path.join("cache", "datasets")))
+INDEX_FILE = "index.json"
+INDEX_LOCK_FILE = "index.lock"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+CSV_EXTENSIONS = {".csv", ".tsv", ".txt"}
+EXCEL_EXTENSIONS = {".xlsx", ".xlsm", ".xls"}
+SUPPORTED_EXTENSIONS = CSV_EXTENSIONS | EXCEL_EXTENSIONS
+# 超过该大小的 CSV 不整体读入内存，只构建 SQL 查询缓存（见 dataset_query）
+LARGE_FILE_MB = int(os.getenv("DATASET_LARGE_FILE_MB", "512"))
+PROFILE_SAMPLE_ROWS = 100_000
+
+_UNSET = object()
+feather: Any = _UNSET
+
+
+def _feather():
+    """pyarrow 只在构建 / 读取缓存时导入，服务进程只用到哈希索引，不需要加载它"""
+    global feather
+    if feather is _UNSET:
+        try:
+            import pyarrow  # noqa: F401
+            import pyarrow.feather as feather_module
+            feather = feather_module
+        except ImportError:
+            feather = None
+    return feather
+
+
+def _stat_key(st: os.stat_result) -> str:
+    # 同一个 inode 的硬链接共享缓存
+    return f"{st.st_dev}:{st.st_ino}"
+
+
+def _read_index() -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(os.path.join(CACHE_DIR, INDEX_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@contextmanager
+def _index_lock() -> Iterator[None]:
+    """
+    跨进程的索引写锁：多个内核进程会同时读-改-写 index.json，不加锁时会互相覆盖对方的记录。
+    POSIX 使用 flock，Windows 使用 msvcrt.locking；都不可用时不加锁
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, INDEX_LOCK_FILE), "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            f.seek(0)
+            # LK_LOCK 最多重试 10 秒后抛出 OSError，这里一直等到拿到锁
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _write_index(index: Dict[str, Dict[str, Any]]):
+    # 读取方不加锁，使用临时文件 + 原子替换，读到的总是完整的索引；写入方需持有 _index_lock
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(CACHE_DIR, INDEX_FILE))
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def file_sha256(path: str) -> str:
+    """计算文件内容的 SHA-256；文件未变化时直接使用索引里记录的值"""
+    # 供内核的读取跟踪使用（load() / sql() 命中缓存时不会打开源文件）
+    sys.audit("dataset_cache.read", path)
+    known = known_sha256(path)
+    if known:
+        return known
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    remember_sha256(path, digest)
+    return digest
+
+
+def _variant(read_kwargs: Dict[str, Any]) -> str:
+    """不同的读取参数（sheet、分隔符等）对应不同的缓存文件"""
+    if not read_kwargs:
+        return "default"
+    canonical = json.dumps(read_kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:12]
+
+
+def _cache_base(digest: str, read_kwargs: Dict[str, Any]) -> str:
+    return os.path.join(CACHE_DIR, f"{digest}__{_variant(read_kwargs)}")
+
+
+def _find_cached(base: str) -> Optional[str]:
+    for suffix in (".arrow", ".pkl"):
+        if os.path.exists(base + suffix):
+            return base + suffix
+    return None
+
+
+def _read_source(path: str, read_kwargs: Dict[str, Any]):
+    import pandas as pd
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in EXCEL_EXTENSIONS:
+        return pd.read_excel(path, **read_kwargs)
+    if ext == ".tsv" and "sep" not in read_kwargs:
+        return pd.read_csv(path, sep="\t", **read_kwargs)
+    return pd.read_csv(path, **read_kwargs)
+
+
+def _write_cache(df, base: str) -> str:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if _feather() is not None:
+        tmp_path = base + ".arrow.tmp"
+        try:
+            # 不压缩，读取时可以直接内存映射
+            df.to_feather(tmp_path, compression="uncompressed")
+            os.replace(tmp_path, base + ".arrow")
+            return base + ".arrow"
+        except Exception:
+            # 混合类型列、非字符串列名等无法转成 Arrow，退化为 pickle
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    tmp_path = base + ".pkl.tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, base + ".pkl")
+    return base + ".pkl"
+
+
+def _read_cache(cache_path: str):
+    import pandas as pd
+
+    if cache_path.endswith(".arrow"):
+        table = _feather().read_table(cache_path, memory_map=True)
+        return table.to_pandas()
+    return pd.read_pickle(cache_path)
+
+
+def load(filename: str, **read_kwargs):
+    """
+    读取 CSV / Excel 为 DataFrame，优先使用列式缓存。
+    额外参数会原样传给 pd.read_csv / pd.read_excel，并作为缓存键的一部分。
+    """
+    path = os.path.abspath(filename)
+    if os.path.splitext(path)[1].lower() not in SUPPORTED_EXTENSIONS:
+        raise ValueError(f"load() only supports {sorted(SUPPORTED_EXTENSIONS)}: {filename}")
+
+    base = _cache_base(file_sha256(path), read_kwargs)
+    cached = _find_cached(base)
+    if cached:
+        try:
+            return _read_cache(cached)
+        except Exception:
+            pass
+
+    df = _read_source(path, read_kwargs)
+    try:
+        _write_cache(df, base)
+    except Exception:
+        pass
+    return df
+
+
+def known_sha256(path: str) -> Optional[str]:
+    """只查询索引，不读取文件内容；文件未被索引或已被修改时返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    entry = _read_index().get(_stat_key(st))
+    if entry and entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:
+        return entry["sha256"]
+    return None
+
+
+def remember_sha256(path: str, digest: str):
+    """记录已知的内容哈希（例如上传时边写边算出的哈希），下游无需再次读取文件"""
+    st = os.stat(path)
+    with _index_lock():
+        index = _read_index()
+        index[_stat_key(st)] = {
+            "sha256": digest,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "path": os.path.abspath(path),
+        }
+        _write_index(index)
+
+
+def purge(digest: str):
+    """删除某个内容哈希对应的所有缓存文件和索引项"""
+    with _index_lock():
+        index = _read_index()
+        # 顺便清理源文件已经不存在的索引项
+        kept = {
+            k: e for k, e in index.items()
+            if e.get("sha256") != digest and os.path.exists(e.get("path", ""))
+        }
+        if kept != index:
+            _write_index(kept)
+    for cache_path in glob.glob(os.path.join(CACHE_DIR, f"{digest}__*")):
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+
+
+def invalidate(path: str):
+    """
+    源文件被删除或覆盖前调用，清理对应的缓存文件和索引。
+    不按 st_nlink 判断是否仍被使用（会话工作区中的视图也是硬链接）；
+    其他仍然引用同一内容的文件在下次读取时重建缓存。
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    entry = _read_index().get(_stat_key(st))
+    if entry is not None:
+        purge(entry["sha256"])
+
+
+def build(path: str) -> bool:
+    """为数据文件构建缓存和画像；不支持的格式返回 False"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in SUPPORTED_EXTENSIONS:
+        return False
+
+    import dataset_profile
+    if ext in CSV_EXTENSIONS and os.path.getsize(path) > LARGE_FILE_MB * 1024 * 1024:
+        # 大文件：画像基于前若干行，总行数来自查询缓存
+        import dataset_query
+        rows = dataset_query.row_count(path)
+        sample = _read_source(path, {"nrows": PROFILE_SAMPLE_ROWS})
+        dataset_profile.write_profile(path, sample, rows=rows)
+        return True
+
+    df = load(path)
+    dataset_profile.write_profile(path, df)
+    return True
+
+
+if __name__ == "__main__":
+    # 由服务进程以子进程方式调用：python dataset_cache.py build <path>
+    if len(sys.argv) == 3 and sys.argv[1] == "build":
+        try:
+            build(sys.argv[2])
+        except Exception as e:
+            print(f"[Error]: {e}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        print("usage: python dataset_cache.py build <path>", file=sys.stderr)
+        sys.exit(2)
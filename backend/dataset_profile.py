@@ -0,0 +1,187 @@
+"""
+数据集画像 (profile)
+
+每个上传文件只在构建缓存时计算一次画像，按内容哈希保存在缓存目录中：
+行数、列类型、缺失率、基数、数值摘要和少量样例行。
+服务进程只读取 JSON 并按 token 预算渲染到 `# Data` 上下文中，不需要导入 pandas。
+"""
+import os
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+from dataset_cache import CACHE_DIR, SUPPORTED_EXTENSIONS, file_sha256
+
+PROFILE_VERSION = 1
+SAMPLE_ROWS = 3
+MAX_CELL_CHARS = 40
+
+
+def profile_path(digest: str) -> str:
+    return os.path.join(CACHE_DIR, f"{digest}__profile.json")
+
+
+def _short(value: Any) -> str:
+    text = str(value)
+    return text if len(text) <= MAX_CELL_CHARS else text[:MAX_CELL_CHARS - 3] + "..."
+
+
+def _number(value: Any) -> Optional[float]:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if value != value:  # NaN
+        return None
+    return round(value, 4)
+
+
+def profile_dataframe(df) -> Dict[str, Any]:
+    """计算 DataFrame 的画像"""
+    import pandas as pd
+
+    rows = len(df)
+    columns = []
+    for name in df.columns:
+        series = df[name]
+        column = {
+            "name": str(name),
+            "dtype": str(series.dtype),
+            "null_rate": round(float(series.isna().mean()), 4) if rows else 0.0,
+        }
+        try:
+            column["n_unique"] = int(series.nunique(dropna=True))
+        except TypeError:
+            # 不可哈希的值（list/dict 等）无法统计基数
+            column["n_unique"] = None
+
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            desc = series.describe()
+            column["summary"] = {k: _number(desc.get(k)) for k in ("min", "max", "mean", "std")}
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            column["summary"] = {"min": _short(series.min()), "max": _short(series.max())}
+        elif column["n_unique"]:
+            top = series.value_counts(dropna=True).head(3)
+            column["top"] = [_short(v) for v in top.index]
+        columns.append(column)
+
+    sample = [
+        [_short(v) for v in row]
+        for row in df.head(SAMPLE_ROWS).itertuples(index=False, name=None)
+    ]
+    return {"version": PROFILE_VERSION, "rows": rows, "columns": columns, "sample": sample}
+
+
+def write_profile(path: str, df, rows: Optional[int] = None) -> str:
+    """
+    计算并保存文件画像，返回画像文件路径。
+    df 只是大文件的前若干行时，通过 rows 传入总行数。
+    """
+    target = profile_path(file_sha256(path))
+    profile = profile_dataframe(df)
+    if rows is not None and rows != profile["rows"]:
+        profile["sampled_rows"] = profile["rows"]
+        profile["rows"] = rows
+    tmp_path = target + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False)
+    os.replace(tmp_path, target)
+    return target
+
+
+def read_profile(path: str) -> Optional[Dict[str, Any]]:
+    """读取已缓存的画像；尚未构建或版本过期时返回 None"""
+    if os.path.splitext(path)[1].lower() not in SUPPORTED_EXTENSIONS:
+        return None
+    try:
+        with open(profile_path(file_sha256(path)), "r", encoding="utf-8") as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if profile.get("version") != PROFILE_VERSION:
+        return None
+    return profile
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数（中英文混合按 3 字符 / token）"""
+    return max(1, len(text) // 3)
+
+
+def _format_column(column: Dict[str, Any], detailed: bool) -> str:
+    parts = [column["dtype"]]
+    if column.get("null_rate"):
+        parts.append(f"null {column['null_rate']:.1%}")
+    if column.get("n_unique") is not None:
+        parts.append(f"unique {column['n_unique']}")
+    if detailed and column.get("summary"):
+        parts.append(", ".join(f"{k}={v}" for k, v in column["summary"].items() if v is not None))
+    if detailed and column.get("top"):
+        parts.append("top: " + " | ".join(column["top"]))
+    return f"  - {column['name']}: " + "; ".join(parts)
+
+
+def render_profile(name: str, profile: Optional[Dict[str, Any]], level: int = 0, max_columns: Optional[int] = None) -> str:
+    """
+    渲染单个文件的画像文本。level 越高越精简：
+    0 = 全部信息，1 = 去掉样例行，2 = 去掉数值摘要，3 = 只保留形状
+    """
+    if not profile:
+        return f"- {name}"
+
+    columns: List[Dict[str, Any]] = profile.get("columns", [])
+    shape = f"{profile.get('rows', '?')} rows x {len(columns)} columns"
+    if profile.get("sampled_rows"):
+        shape += f"; large file, stats from first {profile['sampled_rows']} rows, query with sql()"
+    lines = [f"- {name} ({shape})"]
+    if level >= 3:
+        return lines[0]
+
+    shown = columns if max_columns is None else columns[:max_columns]
+    lines.extend(_format_column(c, detailed=level < 2) for c in shown)
+    if len(shown) < len(columns):
+        lines.append(f"  - ... ({len(columns) - len(shown)} more columns)")
+
+    if level == 0 and profile.get("sample"):
+        header = " | ".join(c["name"] for c in shown)
+        lines.append(f"  sample rows: {header}")
+        lines.extend("    " + " | ".join(row[:len(shown)]) for row in profile["sample"])
+    return "\n".join(lines)
+
+
+def render_profiles(
+    entries: List[Dict[str, Any]],
+    token_budget: int,
+    count_tokens: Callable[[str], int] = estimate_tokens,
+) -> str:
+    """
+    在 token 预算内渲染多个文件的画像。
+    entries: [{"name": ..., "profile": ...}]，超出预算时逐级精简，宽表截断列。
+    """
+    if not entries:
+        return ""
+
+    for level in range(4):
+        text = "\n".join(render_profile(e["name"], e.get("profile"), level) for e in entries)
+        if count_tokens(text) <= token_budget:
+            return text
+
+        # 宽表：在当前精简级别下截断列数
+        if level < 3:
+            max_columns = 64
+            while max_columns >= 4:
+                text = "\n".join(
+                    render_profile(e["name"], e.get("profile"), level, max_columns) for e in entries
+                )
+                if count_tokens(text) <= token_budget:
+                    return text
+                max_columns //= 2
+
+    # 仍然超出预算：只列出能放下的文件
+    lines = []
+    for e in entries:
+        line = render_profile(e["name"], e.get("profile"), 3)
+        if count_tokens("\n".join(lines + [line])) > token_budget:
+            lines.append(f"- ... ({len(entries) - len(lines)} more files)")
+            break
+        lines.append(line)
+    return "\n".join(lines)
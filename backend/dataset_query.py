@@ -0,0 +1,222 @@
+"""
+大数据集的 SQL 查询（out-of-core）
+
+沙箱内核预先注入了 `sql(query)`，工作区中的 CSV / Excel 文件自动注册为同名表
+（文件名去掉扩展名，非字母数字字符替换为下划线，例如 `sales-2024.csv` -> `sales_2024`）：
+
+    sql("SELECT region, SUM(amount) AS total FROM sales_2024 GROUP BY region")
+
+- 安装了 duckdb 时：CSV 第一次查询时流式转换为 Parquet 缓存（按内容哈希命名，与 load() 的缓存共用目录），
+  之后的查询直接扫描 Parquet，只读取用到的列和行组（投影 / 谓词下推）；内存超出上限时 DuckDB 会溢写到磁盘
+- 否则退化为 SQLite：CSV 按块导入到磁盘上的 SQLite 数据库，查询时只有结果集进入内存
+- Excel 文件无法流式读取，通过 load() 读入后注册
+
+本模块只在沙箱子进程中使用，不在顶层导入 pandas。
+"""
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+from dataset_cache import CACHE_DIR, CSV_EXTENSIONS, EXCEL_EXTENSIONS, SUPPORTED_EXTENSIONS, file_sha256, load
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# 返回给调用方的最大行数，防止误把整张大表读入内存；需要更多时显式传入 limit
+DEFAULT_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "1000000"))
+SQLITE_CHUNK_ROWS = 200_000
+
+_lock = threading.Lock()
+_conn = None
+# 表名 -> (源文件路径, 内容哈希)，源文件变化时重新注册
+_registered: Dict[str, tuple] = {}
+
+
+def table_name(filename: str) -> str:
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    name = re.sub(r"\W", "_", stem, flags=re.ASCII).strip("_") or "data"
+    return f"t_{name}" if name[0].isdigit() else name
+
+
+def _memory_limit_mb() -> int:
+    # 沙箱有地址空间上限时只使用其中一半，剩余留给 pandas 结果和解释器本身
+    limit = int(os.getenv("SQL_MEMORY_MB", "0"))
+    if limit > 0:
+        return limit
+    sandbox = int(os.getenv("SANDBOX_MEMORY_MB", "0"))
+    return sandbox // 2 if sandbox > 0 else 2048
+
+
+def _connect():
+    global _conn
+    if _conn is not None:
+        return _conn
+    if duckdb is not None:
+        spill_dir = os.path.join(CACHE_DIR, "duckdb_tmp")
+        os.makedirs(spill_dir, exist_ok=True)
+        _conn = duckdb.connect(":memory:")
+        _conn.execute(f"SET memory_limit = '{_memory_limit_mb()}MB'")
+        _conn.execute(f"SET temp_directory = '{spill_dir}'")
+        threads = os.getenv("OMP_NUM_THREADS")
+        if threads and threads.isdigit():
+            _conn.execute(f"SET threads = {int(threads)}")
+    else:
+        _conn = sqlite3.connect(":memory:", check_same_thread=False)
+    return _conn
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _csv_options(path: str) -> str:
+    return ", delim = '\\t'" if os.path.splitext(path)[1].lower() == ".tsv" else ""
+
+
+def prepare(path: str) -> Optional[str]:
+    """
+    为 CSV 构建查询缓存（duckdb: Parquet，否则 SQLite），返回缓存路径；Excel 返回 None。
+    可以在上传后预先调用，避免第一次查询时转换。
+    """
+    path = os.path.abspath(path)
+    if os.path.splitext(path)[1].lower() not in CSV_EXTENSIONS:
+        return None
+    suffix = ".parquet" if duckdb is not None else ".sqlite"
+    target = os.path.join(CACHE_DIR, f"{file_sha256(path)}__query{suffix}")
+    if os.path.exists(target):
+        return target
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        if duckdb is not None:
+            _write_parquet(path, tmp_path)
+        else:
+            _write_sqlite(path, tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return target
+
+
+def _write_parquet(path: str, tmp_path: str):
+    conn = duckdb.connect(":memory:")
+    try:
+        conn.execute(f"SET memory_limit = '{_memory_limit_mb()}MB'")
+        conn.execute(
+            f"COPY (SELECT * FROM read_csv_auto({_literal(path)}{_csv_options(path)})) "
+            f"TO {_literal(tmp_path)} (FORMAT parquet, COMPRESSION zstd)"
+        )
+    finally:
+        conn.close()
+
+
+def _write_sqlite(path: str, tmp_path: str):
+    import pandas as pd
+
+    sep = "\t" if os.path.splitext(path)[1].lower() == ".tsv" else ","
+    conn = sqlite3.connect(tmp_path)
+    try:
+        for chunk in pd.read_csv(path, sep=sep, chunksize=SQLITE_CHUNK_ROWS):
+            chunk.to_sql("data", conn, if_exists="append", index=False)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def row_count(path: str) -> int:
+    """CSV 的总行数（从查询缓存读取，不把数据读入内存）"""
+    cached = prepare(path)
+    if duckdb is not None:
+        conn = duckdb.connect(":memory:")
+        try:
+            return conn.execute(f"SELECT COUNT(*) FROM read_parquet({_literal(cached)})").fetchone()[0]
+        finally:
+            conn.close()
+    conn = sqlite3.connect(cached)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM data").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _register(conn, name: str, path: str):
+    ext = os.path.splitext(path)[1].lower()
+    cached = prepare(path)
+    if duckdb is not None:
+        if cached:
+            conn.execute(f"CREATE OR REPLACE VIEW {_quote(name)} AS SELECT * FROM read_parquet({_literal(cached)})")
+        else:
+            conn.register(name, load(path))
+        return
+
+    conn.execute(f"DROP VIEW IF EXISTS {_quote(name)}")
+    conn.execute(f"DROP TABLE IF EXISTS {_quote(name)}")
+    if cached:
+        schema = f"db_{name}"
+        try:
+            conn.execute(f"DETACH DATABASE {_quote(schema)}")
+        except sqlite3.Error:
+            pass
+        conn.execute(f"ATTACH DATABASE {_literal(cached)} AS {_quote(schema)}")
+        conn.execute(f"CREATE TEMP VIEW {_quote(name)} AS SELECT * FROM {_quote(schema)}.data")
+    elif ext in EXCEL_EXTENSIONS:
+        load(path).to_sql(name, conn, index=False)
+
+
+def tables(directory: str = ".") -> Dict[str, str]:
+    """注册工作区中的数据文件，返回 {表名: 文件名}"""
+    conn = _connect()
+    found = {}
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if not entry.is_file() or os.path.splitext(entry.name)[1].lower() not in SUPPORTED_EXTENSIONS:
+            continue
+        name = table_name(entry.name)
+        if name in found:
+            continue
+        found[name] = entry.name
+        key = (os.path.abspath(entry.path), file_sha256(entry.path))
+        if _registered.get(name) != key:
+            _register(conn, name, entry.path)
+            _registered[name] = key
+    return found
+
+
+def sql(query: str, limit: Optional[int] = None):
+    """
+    对工作区中的数据文件执行 SQL，返回 DataFrame。
+    超过 limit（默认 SQL_MAX_ROWS）行时报错，请先在 SQL 中聚合或采样。
+    """
+    max_rows = limit or DEFAULT_MAX_ROWS
+    with _lock:
+        conn = _connect()
+        tables()
+        if duckdb is not None:
+            relation = conn.sql(query)
+            if relation is None:
+                return None
+            df = relation.limit(max_rows + 1).df()
+        else:
+            import pandas as pd
+
+            cursor = conn.execute(query)
+            if cursor.description is None:
+                conn.commit()
+                return None
+            columns = [d[0] for d in cursor.description]
+            df = pd.DataFrame(cursor.fetchmany(max_rows + 1), columns=columns)
+    if len(df) > max_rows:
+        raise ValueError(
+            f"Query returned more than {max_rows} rows; aggregate, filter or sample in SQL, "
+            f"or pass a larger limit="
+        )
+    return df
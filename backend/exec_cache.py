@@ -0,0 +1,312 @@
+"""
+代码执行结果缓存（可选，EXEC_CACHE=1 开启）
+
+用户重跑或微调分析时，Agent 经常生成与之前完全相同的清洗 / 聚合代码。命中缓存时直接回放
+之前的输出和产物，不再占用沙箱：
+- 查找键 = 会话的执行历史链 + 规范化后的代码（按 AST 比较，忽略注释和格式差异）
+- 条目记录代码读取过的工作区文件及其内容哈希（由内核的读取跟踪给出），查找时逐个校验，
+  数据文件变化后不会命中
+- 内核是常驻的，代码的结果还依赖之前定义的变量：历史链由每一步的代码和输入哈希依次累加，
+  内核重启（超时、崩溃、空闲回收）后清空
+- 命中的代码并没有真正执行，记入会话的待补执行列表；之后遇到未命中的代码时先静默补执行，
+  保证内核中的变量与历史一致
+- 只缓存成功结束的执行，输出超过 EXEC_CACHE_MAX_OUTPUT_KB 的不缓存；
+  执行期间改写了自身输入文件的步骤无法确定依赖，之后的步骤都不会命中
+- 输出保存在 SQLite 中，产物按内容哈希保存为独立文件（多个条目共享），
+  总大小超过 EXEC_CACHE_MAX_MB 时按最近使用时间淘汰（LRU）
+"""
+import os
+import ast
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import dataset_cache
+from utils import uniquify_path
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# 内存中保留执行历史链的会话数
+MAX_SESSIONS = 1000
+HIT_NOTICE = "[cache hit: identical code and input data, replaying the stored result without re-running]\n"
+
+
+def normalize_code(code: str) -> str:
+    """按 AST 规范化代码（注释、空行、缩进和引号风格不影响结果）；语法错误时退化为逐行去除首尾空白"""
+    try:
+        return ast.dump(ast.parse(code))
+    except (SyntaxError, ValueError):
+        return "\n".join(line.strip() for line in code.splitlines() if line.strip())
+
+
+def _sha256_text(*parts: str) -> str:
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def _sha256_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _step_token(code: str, deps: Dict[str, str]) -> str:
+    """一步执行对内核状态的贡献：代码 + 输入文件的内容哈希"""
+    return _sha256_text(normalize_code(code), json.dumps(deps, sort_keys=True))
+
+
+class SessionChain:
+    """会话的执行历史链"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.chain = ""
+        # 命中缓存、尚未在内核中真正执行的代码
+        self.pending: List[str] = []
+        # 最近一次真正执行时的内核标识
+        self.kernel_id: Optional[str] = None
+
+    def reset(self, kernel_id: Optional[str] = None):
+        self.chain = ""
+        self.pending = []
+        self.kernel_id = kernel_id
+
+    def advance(self, token: str):
+        self.chain = _sha256_text(self.chain, token)
+
+
+class ExecCache:
+    """SQLite 存储条目，产物文件按内容哈希存放；数据库和文件操作都在线程池中执行"""
+
+    def __init__(self, root: str, max_bytes: int = 512 * 1024 * 1024, max_output_bytes: int = 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.blob_dir = os.path.join(self.root, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_output_bytes = max_output_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.root, "index.sqlite"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, base TEXT, deps TEXT, output TEXT, artifacts TEXT,"
+            " elapsed_ms REAL, size INTEGER, created REAL, last_used REAL, hits INTEGER DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_base ON entries (base)")
+        self._conn.commit()
+        self._sessions: "OrderedDict[str, SessionChain]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # ---- 会话历史链 ----
+
+    def session(self, session_id: str, kernel_id: Optional[str]) -> SessionChain:
+        """取得会话的历史链；内核在上次执行之后被重启或回收过时先清空"""
+        with self._lock:
+            state = self._sessions.pop(session_id, None) or SessionChain(session_id)
+            self._sessions[session_id] = state
+            while len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        if state.kernel_id is not None and state.kernel_id != kernel_id:
+            state.reset()
+        return state
+
+    def take_pending(self, state: SessionChain) -> List[str]:
+        pending, state.pending = state.pending, []
+        return pending
+
+    # ---- 查找与回放 ----
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def lookup(self, state: SessionChain, code: str, work_dir: str) -> Optional[Dict[str, Any]]:
+        """查找可回放的条目：历史链和代码一致，且读取过的文件内容都没有变化"""
+        base = _sha256_text(state.chain, normalize_code(code))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, deps, output, artifacts, elapsed_ms, created FROM entries"
+                " WHERE base = ? ORDER BY last_used DESC", (base,)
+            ).fetchall()
+        for key, deps_json, output, artifacts_json, elapsed_ms, created in rows:
+            deps = json.loads(deps_json)
+            if not all(self._digest(os.path.join(work_dir, *rel.split("/"))) == digest for rel, digest in deps.items()):
+                continue
+            artifacts = json.loads(artifacts_json)
+            if not all(os.path.exists(self._blob_path(a["sha256"])) for a in artifacts):
+                continue
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE entries SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key)
+                )
+                self._conn.commit()
+            self.hits += 1
+            return {
+                "deps": deps,
+                "output": json.loads(output),
+                "artifacts": artifacts,
+                "elapsed_ms": elapsed_ms,
+                "age_s": round(time.time() - created, 1),
+            }
+        self.misses += 1
+        return None
+
+    @staticmethod
+    def _digest(path: str) -> Optional[str]:
+        try:
+            return dataset_cache.file_sha256(path)
+        except OSError:
+            return None
+
+    def replayed(self, state: SessionChain, code: str, entry: Dict[str, Any]):
+        """回放了一个条目：历史链照常前进，代码记入待补执行列表"""
+        state.advance(_step_token(code, entry["deps"]))
+        state.pending.append(code)
+
+    def restore_artifacts(self, entry: Dict[str, Any], output_dir: str) -> List[str]:
+        """把条目的产物放回会话产物目录（优先硬链接），返回实际的文件名"""
+        os.makedirs(output_dir, exist_ok=True)
+        names = []
+        for artifact in entry["artifacts"]:
+            dest = uniquify_path(Path(output_dir) / artifact["name"])
+            blob = self._blob_path(artifact["sha256"])
+            try:
+                os.link(blob, dest)
+            except OSError:
+                try:
+                    shutil.copyfile(blob, dest)
+                except OSError as e:
+                    logger.warning(f"Failed to restore cached artifact {artifact['name']}: {e}")
+                    continue
+            names.append(dest.name)
+        return names
+
+    # ---- 记录 ----
+
+    def _dependencies(self, reads: List[str], work_dir: str,
+                      before: Dict[str, Tuple[int, int]]) -> Optional[Dict[str, str]]:
+        """
+        读取过的输入文件 -> 内容哈希。before 为执行前工作区中的输入文件 -> (inode, mtime)，
+        取自文件跟踪器的状态，不再额外遍历工作区。
+        输入文件在执行期间被改写、或读取了来历不明的文件时返回 None（依赖无法确定）
+        """
+        deps = {}
+        for rel in reads:
+            path = os.path.join(work_dir, *rel.split("/"))
+            if rel not in before:
+                # 本步自己生成的文件已被产物收集移走；仍留在工作区的说明不是本步生成的
+                if os.path.exists(path):
+                    return None
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if (st.st_ino, st.st_mtime_ns) != before[rel]:
+                return None
+            digest = self._digest(path)
+            if digest is None:
+                return None
+            deps[rel] = digest
+        return deps
+
+    def record(self, state: SessionChain, code: str, usage: Dict[str, Any], kernel_id: Optional[str],
+               work_dir: str, before: Dict[str, Tuple[int, int]], output: Optional[List[str]],
+               artifact_paths: List[str], elapsed_ms: float):
+        """
+        一次真正的执行结束：推进历史链，成功且依赖明确时写入缓存。
+        output 为完整的输出行，超过 max_output_bytes 时调用方传 None（不缓存）
+        """
+        if not usage:
+            # 超时、崩溃或退化为一次性进程执行：内核状态未知，从头开始
+            state.reset(kernel_id)
+            return
+        state.kernel_id = kernel_id
+        deps = self._dependencies(usage.get("reads", []), work_dir, before)
+        if deps is None:
+            # 之后的步骤都不应命中
+            state.advance(uuid.uuid4().hex)
+            return
+        base = _sha256_text(state.chain, normalize_code(code))
+        state.advance(_step_token(code, deps))
+
+        if not usage.get("ok") or output is None:
+            return
+        output_json = json.dumps(output, ensure_ascii=False)
+        try:
+            artifacts = [self._store_blob(path) for path in artifact_paths]
+        except OSError as e:
+            logger.warning(f"Failed to store artifacts in execution cache: {e}")
+            return
+        artifacts_json = json.dumps(artifacts, ensure_ascii=False)
+        size = len(output_json) + sum(a["size"] for a in artifacts)
+        key = _sha256_text(base, json.dumps(deps, sort_keys=True))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries"
+                " (key, base, deps, output, artifacts, elapsed_ms, size, created, last_used, hits)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (key, base, json.dumps(deps, sort_keys=True), output_json, artifacts_json,
+                 elapsed_ms, size, now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _store_blob(self, path: str) -> Dict[str, Any]:
+        digest = _sha256_file(path)
+        blob = self._blob_path(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp_path = f"{blob}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, blob)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return {"name": os.path.basename(path), "sha256": digest, "size": os.path.getsize(blob)}
+
+    def _evict(self):
+        """总大小超过上限时按最近使用时间淘汰，并删除不再被引用的产物文件"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size, artifacts in self._conn.execute(
+            "SELECT key, size, artifacts FROM entries ORDER BY last_used ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((key, artifacts))
+            total -= size
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+        for _, artifacts in evicted:
+            for artifact in json.loads(artifacts):
+                digest = artifact["sha256"]
+                if self._conn.execute(
+                    "SELECT 1 FROM entries WHERE artifacts LIKE ? LIMIT 1", (f"%{digest}%",)
+                ).fetchone() is None:
+                    try:
+                        os.remove(self._blob_path(digest))
+                    except OSError:
+                        pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": count, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
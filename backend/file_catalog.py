@@ -0,0 +1,240 @@
+"""
+内存中的文件目录（uploads/ 和 output/）
+
+/files、/outputs 和 ReAct 循环的每一步都需要文件列表，逐个 listdir + stat 在产物很多时开销明显。
+目录只在启动时完整扫描一次，之后由上传、删除、产物收集和报告渲染等写入路径显式更新：
+- 每个条目记录 name（相对根目录的路径）、size、mtime、sha256、mime
+- 上传文件的哈希由上传存储给出，其余文件在登记时计算（超过 HASH_MAX_BYTES 的不计算）
+- 每次变更递增版本号，列表接口据此生成 ETag，未变化时返回 304
+- 定期 rescan 用于发现绕过上述路径的外部修改；大小和 mtime 未变的文件沿用已有哈希
+- 启动时的扫描只 stat 不读文件，哈希由后台的 fill_hashes 补齐，服务可以立即就绪
+"""
+import os
+import json
+import uuid
+import hashlib
+import logging
+import mimetypes
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+HASH_MAX_BYTES = int(os.getenv("CATALOG_HASH_MAX_MB", "64")) * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+def _sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class FileCatalog:
+    """一个目录下文件的内存索引，线程安全（产物收集和 PDF 渲染在线程池中登记文件）"""
+
+    def __init__(self, root: str, recursive: bool = False,
+                 hash_lookup: Optional[Callable[[str], Optional[str]]] = None):
+        self.root = os.path.abspath(root)
+        self.recursive = recursive
+        # 已知哈希的查询函数（如上传文件的哈希索引），查不到时才读取文件计算
+        self.hash_lookup = hash_lookup
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        # 进程内唯一的前缀：服务重启后旧的 ETag 全部失效
+        self._epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        # 顶层子目录（会话目录）-> 版本号，按会话过滤的列表不受其他会话的变更影响
+        self._dir_versions: Dict[str, int] = {}
+        # 按 mtime 倒序排好的条目，版本变化后重新排序
+        self._sorted: Optional[List[Dict[str, Any]]] = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, *name.split("/"))
+
+    def _touch(self, name: str):
+        self.version += 1
+        self._sorted = None
+        if "/" in name:
+            top = name.split("/", 1)[0]
+            self._dir_versions[top] = self._dir_versions.get(top, 0) + 1
+
+    def _stat_entry(self, name: str, sha256: Optional[str] = None,
+                    previous: Optional[Dict[str, Any]] = None, compute_hash: bool = True) -> Optional[Dict[str, Any]]:
+        path = self._path(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        if sha256 is None and previous and previous["size"] == st.st_size and previous["mtime"] == st.st_mtime:
+            sha256 = previous["sha256"]
+        if sha256 is None and compute_hash and self.hash_lookup is not None:
+            sha256 = self.hash_lookup(path)
+        if sha256 is None and compute_hash and st.st_size <= HASH_MAX_BYTES:
+            try:
+                sha256 = _sha256(path)
+            except OSError:
+                pass
+        return {
+            "name": name,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "sha256": sha256,
+            "mime": mimetypes.guess_type(name)[0] or "application/octet-stream",
+        }
+
+    def _walk(self) -> List[str]:
+        names = []
+        if not os.path.isdir(self.root):
+            return names
+        if not self.recursive:
+            for entry in os.scandir(self.root):
+                if entry.is_file() and not entry.name.startswith("."):
+                    names.append(entry.name)
+            return names
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                rel_path = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                names.append(rel_path.replace(os.sep, "/"))
+        return names
+
+    def scan(self, compute_hash: bool = True):
+        """
+        与磁盘完全同步（启动时和定期调用），返回新增 / 变化 / 删除的条目数。
+        compute_hash=False 时新文件的哈希留空，之后由 fill_hashes 或 lookup 补齐。
+        """
+        with self._lock:
+            previous = dict(self._entries)
+        entries = {}
+        for name in self._walk():
+            entry = self._stat_entry(name, previous=previous.get(name), compute_hash=compute_hash)
+            if entry is not None:
+                entries[name] = entry
+        changed = 0
+        with self._lock:
+            for name in set(self._entries) | set(entries):
+                old, new = self._entries.get(name), entries.get(name)
+                if old == new:
+                    continue
+                changed += 1
+                if new is None:
+                    del self._entries[name]
+                else:
+                    self._entries[name] = new
+                self._touch(name)
+        if changed:
+            logger.info(f"File catalog {self.root}: {changed} entries changed on rescan")
+        return changed
+
+    def upsert(self, name: str, sha256: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """登记（或刷新）一个文件；文件已不存在时从目录中移除"""
+        with self._lock:
+            previous = self._entries.get(name)
+        entry = self._stat_entry(name, sha256, previous)
+        with self._lock:
+            if entry is None:
+                if self._entries.pop(name, None) is not None:
+                    self._touch(name)
+            elif self._entries.get(name) != entry:
+                self._entries[name] = entry
+                self._touch(name)
+        return entry
+
+    def fill_hashes(self):
+        """为还没有哈希的条目计算哈希（启动后在后台调用）"""
+        with self._lock:
+            pending = [name for name, entry in self._entries.items() if entry["sha256"] is None]
+        for name in pending:
+            self.upsert(name)
+
+    def upsert_many(self, names: List[str]) -> List[Optional[Dict[str, Any]]]:
+        return [self.upsert(name) for name in names]
+
+    def remove(self, name: str):
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self._touch(name)
+
+    def prune_missing_dirs(self):
+        """移除已被整体删除的子目录（如 GC 回收的会话产物目录）下的条目"""
+        with self._lock:
+            tops = {name.split("/", 1)[0] for name in self._entries if "/" in name}
+        missing = {top for top in tops if not os.path.isdir(os.path.join(self.root, top))}
+        if not missing:
+            return
+        with self._lock:
+            for name in [n for n in self._entries if n.split("/", 1)[0] in missing]:
+                del self._entries[name]
+                self._touch(name)
+
+    def lookup(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        读取条目并确认与磁盘一致（一次 stat）；文件被绕过目录改写过时重新登记，
+        已不存在时移除并返回 None
+        """
+        entry = self.get(name)
+        try:
+            st = os.stat(self._path(name))
+        except OSError:
+            if entry is not None:
+                self.remove(name)
+            return None
+        if (entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime
+                and (entry["sha256"] is not None or st.st_size > HASH_MAX_BYTES)):
+            return entry
+        return self.upsert(name)
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(name)
+            return dict(entry) if entry else None
+
+    def etag(self, prefix: str = "", query: Optional[Dict[str, Any]] = None) -> str:
+        """
+        列表的 ETag；prefix 为某个会话目录时只随该目录的变更而变化。
+        query 为规范化后的过滤 / 分页参数，不同的查询得到不同的 ETag
+        """
+        suffix = ""
+        if query:
+            raw = json.dumps(query, sort_keys=True, separators=(",", ":"))
+            suffix = "-" + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:12]
+        with self._lock:
+            top = prefix.rstrip("/")
+            if top and "/" not in top:
+                return f'W/"{self._epoch}-{top}-{self._dir_versions.get(top, 0)}{suffix}"'
+            return f'W/"{self._epoch}-{self.version}{suffix}"'
+
+    def query(self, prefix: str = "", q: Optional[str] = None, mime: Optional[str] = None,
+              offset: int = 0, limit: Optional[int] = None) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        按 mtime 倒序返回 (总数, 当前页)。
+        q 为文件名子串（不区分大小写），mime 为前缀（如 "image/"）。
+        """
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self._entries.values(), key=lambda e: e["mtime"], reverse=True)
+            ordered = self._sorted
+        q = q.lower() if q else None
+        matched = [
+            e for e in ordered
+            if e["name"].startswith(prefix)
+            and (q is None or q in e["name"].lower())
+            and (mime is None or e["mime"].startswith(mime))
+        ]
+        page = matched[offset:offset + limit] if limit is not None else matched[offset:]
+        return len(matched), [dict(e) for e in page]
+
+    def names(self, prefix: str = "", exclude_prefix: Optional[str] = None) -> List[str]:
+        """prefix 下的文件名（去掉 prefix，按名称排序），用于构建 Agent 上下文"""
+        with self._lock:
+            names = [n[len(prefix):] for n in self._entries if n.startswith(prefix)]
+        return sorted(
+            n for n in names
+            if "/" not in n and not (exclude_prefix and n.startswith(exclude_prefix))
+        )
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import threading
+import subprocess
+from typing import Any, Dict, Optional, Iterator, List
+
+from sandbox_limits import sandbox_env, popen_kwargs, kill_process_group, describe_exit
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kernel_worker.py")
+
+
+class KernelDied(Exception):
+    """内核进程在执行过程中意外退出"""
+
+
+class Kernel:
+    """
+    一个常驻的 Python 解释器进程。
+    变量和 DataFrame 会在同一个内核的多次执行之间保留。
+    """
+
+    def __init__(self, cwd: Optional[str] = None):
+        # 每个内核进程唯一（不用进程号：进程号会被复用）
+        self.kernel_id = uuid.uuid4().hex
+        self.marker = f"\x1e__kernel_done_{uuid.uuid4().hex}__"
+        self.started_at = time.time()
+        self.last_used = time.time()
+        self.exec_count = 0
+        self.busy = False
+        # 最近一次执行的资源用量 {"cpu_s", "peak_rss_mb", "elapsed"}
+        self.last_usage: Dict[str, Any] = {}
+
+        # 环境变量白名单 + rlimit + 独立进程组，见 sandbox_limits
+        child_env = sandbox_env({"KERNEL_DONE_MARKER": self.marker})
+
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", WORKER_SCRIPT],
+            cwd=cwd or os.getcwd(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,  # Merge stderr into stdout
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            bufsize=1,
+            env=child_env,
+            **popen_kwargs(),
+        )
+
+        # 后台线程持续读取输出，主线程可以带超时地等待下一行
+        self._lines: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        try:
+            for line in self.process.stdout:
+                self._lines.put(line)
+        except Exception:
+            pass
+        finally:
+            self._lines.put(None)
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def execute(self, code_str: str, workspace_dir: str, timeout_sec: int = 60) -> Iterator[str]:
+        """
+        执行代码并逐行产出输出。
+        超时或进程崩溃时抛出 TimeoutError / KernelDied，由调用方负责重启内核。
+        """
+        self.busy = True
+        self.exec_count += 1
+        self.last_used = time.time()
+        self.last_usage = {}
+        request = {
+            "id": self.exec_count,
+            "code": code_str,
+            "cwd": os.path.abspath(workspace_dir),
+        }
+        try:
+            try:
+                self.process.stdin.write(json.dumps(request) + "\n")
+                self.process.stdin.flush()
+            except (BrokenPipeError, OSError, ValueError):
+                raise KernelDied(self.process.poll())
+
+            deadline = time.monotonic() + timeout_sec
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(timeout_sec)
+                try:
+                    line = self._lines.get(timeout=remaining)
+                except queue.Empty:
+                    raise TimeoutError(timeout_sec)
+
+                if line is None:
+                    raise KernelDied(self.process.wait())
+
+                idx = line.find(self.marker)
+                if idx == -1:
+                    yield line
+                    continue
+
+                # 结束标记可能紧跟在未换行的用户输出之后
+                if idx > 0:
+                    yield line[:idx]
+                try:
+                    status = json.loads(line[idx + len(self.marker):])
+                except ValueError:
+                    status = {"ok": True}
+                self.last_usage = {k: status[k] for k in ("cpu_s", "peak_rss_mb", "elapsed") if k in status}
+                self.last_usage["ok"] = bool(status.get("ok", True))
+                self.last_usage["reads"] = status.get("reads", [])
+                if not status.get("ok", True) and status.get("error"):
+                    yield f"\n[Execution failed: {status['error']}]"
+                return
+        finally:
+            self.busy = False
+            self.last_used = time.time()
+
+    def kill(self):
+        # 按进程组终止，用户代码启动的子进程一并清理
+        try:
+            kill_process_group(self.process)
+        except Exception:
+            pass
+        try:
+            self.process.stdin.close()
+        except Exception:
+            pass
+
+
+class KernelPool:
+    """
+    按会话分配常驻内核的进程池。
+    - 每个 session 独占一个内核，变量在步骤之间保留
+    - 空闲超时回收，池大小有上限
+    - 超时或崩溃时自动重启内核
+    - 预留 warm spare 内核，新会话无需等待冷启动
+    """
+
+    def __init__(self, max_kernels: int = 8, idle_timeout: float = 900, warm_spares: int = 1):
+        self.max_kernels = max(1, max_kernels)
+        self.idle_timeout = idle_timeout
+        self.warm_spares = max(0, warm_spares)
+        self._kernels: Dict[str, Kernel] = {}
+        self._spares: List[Kernel] = []
+        self._lock = threading.RLock()
+        self._usage: Dict[str, Dict[str, Any]] = {}
+        # session_id -> 池满时正在使用的临时内核（见 _execute_once）
+        self._oneshot: Dict[str, Kernel] = {}
+
+    def _size(self) -> int:
+        return len(self._kernels) + len(self._spares)
+
+    def _fill_spares(self):
+        self._spares = [k for k in self._spares if k.is_alive()]
+        while len(self._spares) < self.warm_spares and self._size() < self.max_kernels:
+            self._spares.append(Kernel())
+
+    def prewarm(self):
+        """启动预热的空闲内核（在服务启动时调用）"""
+        with self._lock:
+            self._fill_spares()
+
+    def evict_idle(self):
+        """回收空闲超时的内核"""
+        now = time.time()
+        with self._lock:
+            for session_id, kernel in list(self._kernels.items()):
+                if not kernel.busy and now - kernel.last_used > self.idle_timeout:
+                    kernel.kill()
+                    del self._kernels[session_id]
+
+    def _evict_lru(self) -> bool:
+        idle = [(k.last_used, sid) for sid, k in self._kernels.items() if not k.busy]
+        if not idle:
+            return False
+        _, session_id = min(idle)
+        self._kernels.pop(session_id).kill()
+        return True
+
+    @staticmethod
+    def _claim(kernel: Kernel) -> Kernel:
+        # 在锁内标记为忙，交给调用方之后、开始执行之前不会被当作空闲内核回收
+        kernel.busy = True
+        kernel.last_used = time.time()
+        return kernel
+
+    def _acquire(self, session_id: str) -> Optional[Kernel]:
+        """取得会话的内核并标记为忙（由 execute_stream 结束时清除）"""
+        with self._lock:
+            kernel = self._kernels.get(session_id)
+            if kernel is not None and kernel.is_alive():
+                return self._claim(kernel)
+            if kernel is not None:
+                del self._kernels[session_id]
+
+            self._spares = [k for k in self._spares if k.is_alive()]
+            if self._spares:
+                kernel = self._spares.pop(0)
+            else:
+                while self._size() >= self.max_kernels:
+                    if not self._evict_lru():
+                        return None
+                kernel = Kernel()
+            self._kernels[session_id] = kernel
+            self._claim(kernel)
+            self._fill_spares()
+            return kernel
+
+    def release(self, session_id: str):
+        """销毁指定会话的内核"""
+        with self._lock:
+            kernel = self._kernels.pop(session_id, None)
+        if kernel is not None:
+            kernel.kill()
+
+    def cancel(self, session_id: str):
+        """
+        中止该会话正在进行的执行：终止其内核进程（变量丢失），
+        执行中的 Kernel.execute 随即以 KernelDied 结束，由 execute_stream 按崩溃处理
+        """
+        with self._lock:
+            kernels = [k for k in (self._kernels.get(session_id), self._oneshot.get(session_id)) if k is not None]
+        for kernel in kernels:
+            kernel.kill()
+
+    def restart(self, session_id: str):
+        """重启指定会话的内核（会丢失变量）"""
+        self.release(session_id)
+
+    def execute_stream(self, session_id: str, code_str: str, workspace_dir: str, timeout_sec: int = 60) -> Iterator[str]:
+        """
+        Generator that yields stdout/stderr chunks as they happen,
+        using the session's persistent kernel.
+        """
+        # 内核在第一次迭代时才被取得并标记为忙：调用方拿到生成器后没有迭代就丢弃时不会占用内核
+        self.evict_idle()
+        kernel = self._acquire(session_id)
+        if kernel is None:
+            yield from self._execute_once(session_id, code_str, workspace_dir, timeout_sec)
+            return
+
+        try:
+            yield from kernel.execute(code_str, workspace_dir, timeout_sec)
+            self._usage[session_id] = kernel.last_usage
+        except TimeoutError:
+            self.restart(session_id)
+            yield f"\n[Timeout]: execution exceeded {timeout_sec} seconds (kernel restarted, variables were reset)"
+        except KernelDied as e:
+            self.restart(session_id)
+            yield f"\n[Kernel crashed: {describe_exit(e.args[0] if e.args else None)}; variables were reset]"
+        except GeneratorExit:
+            # 调用方中途放弃读取，内核里可能还有残留输出，直接重启
+            self.restart(session_id)
+            raise
+        finally:
+            # 无论 Kernel.execute 是否开始执行，都清除 _acquire 设置的忙标记（生成器被关闭或回收时同样执行）
+            kernel.busy = False
+            kernel.last_used = time.time()
+
+    def _execute_once(self, session_id: str, code_str: str, workspace_dir: str, timeout_sec: int) -> Iterator[str]:
+        """
+        池已满且所有内核都在忙时的退化路径：启动一个临时内核执行后立即销毁。
+        与常驻内核使用同一个 kernel_worker，上传文件的写时复制和读取跟踪同样生效；
+        变量不会保留，也不记录资源用量（执行结果缓存据此把它视为无状态的执行）。
+        """
+        kernel = Kernel()
+        with self._lock:
+            self._oneshot[session_id] = kernel
+        try:
+            yield from kernel.execute(code_str, workspace_dir, timeout_sec)
+        except TimeoutError:
+            yield f"\n[Timeout]: execution exceeded {timeout_sec} seconds"
+        except KernelDied as e:
+            yield f"\n[Process exited: {describe_exit(e.args[0] if e.args else None)}]"
+        finally:
+            with self._lock:
+                if self._oneshot.get(session_id) is kernel:
+                    del self._oneshot[session_id]
+            kernel.kill()
+
+    def has_kernel(self, session_id: str) -> bool:
+        """该会话的常驻内核是否仍在（变量仍然可用）"""
+        with self._lock:
+            kernel = self._kernels.get(session_id)
+            return kernel is not None and kernel.is_alive()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"sessions": len(self._kernels), "spares": len(self._spares), "max": self.max_kernels}
+
+    def kernel_id(self, session_id: str) -> Optional[str]:
+        """该会话常驻内核的唯一标识；内核不存在时返回 None（标识变化说明内核重启过）"""
+        with self._lock:
+            kernel = self._kernels.get(session_id)
+            return kernel.kernel_id if kernel is not None and kernel.is_alive() else None
+
+    def pop_usage(self, session_id: str) -> Dict[str, Any]:
+        """
+        取出该会话最近一次执行的资源用量（CPU 时间、峰值内存）、是否成功和读取过的工作区文件；
+        超时、崩溃或退化为一次性进程执行时返回空字典
+        """
+        return self._usage.pop(session_id, {})
+
+    def shutdown(self):
+        with self._lock:
+            kernels = list(self._kernels.values()) + self._spares
+            self._kernels.clear()
+            self._spares = []
+        for kernel in kernels:
+            kernel.kill()
@@ -0,0 +1,305 @@
+"""
+常驻 Python 内核进程 (由 kernel_pool.Kernel 启动)
+
+协议:
+- stdin 每行一个 JSON 请求: {"id": ..., "code": ..., "cwd": ...}
+- 用户代码的 stdout/stderr 合并后逐行写到 stdout
+- 每次执行结束后输出一行 `<KERNEL_DONE_MARKER><json>` 作为结束标记
+- 工作区中的上传文件是硬链接，写入前会先复制一份（写时复制）
+- 每次执行前设置 CPU 时间配额，结束标记中附带本次执行的 CPU 时间和峰值内存
+- 结束标记中附带本次执行读取过的工作区文件（执行结果缓存据此判断代码依赖的数据）
+"""
+import os
+import sys
+import io
+import json
+import time
+import signal
+import shutil
+import linecache
+import threading
+import traceback
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DONE_MARKER = os.environ.get("KERNEL_DONE_MARKER", "\x1e__kernel_done__")
+CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", "0"))
+
+
+class CPUTimeExceeded(BaseException):
+    """单次执行超出 CPU 时间配额（继承 BaseException，用户代码的 except Exception 不会吞掉）"""
+
+
+def _on_sigxcpu(signum, frame):
+    raise CPUTimeExceeded(f"CPU time limit of {CPU_SECONDS}s exceeded")
+
+
+def _cpu_seconds(who) -> float:
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _arm_cpu_limit():
+    """RLIMIT_CPU 按进程累计，每次执行前把软限制设为 已用时间 + 配额"""
+    if resource is None or CPU_SECONDS <= 0:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(_cpu_seconds(resource.RUSAGE_SELF)) + 1 + CPU_SECONDS
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def _disarm_cpu_limit():
+    if resource is None or CPU_SECONDS <= 0:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    try:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def _reset_peak_rss():
+    # Linux 4.0+ 支持重置 VmHWM，使峰值内存按单次执行统计
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return 0.0
+    # ru_maxrss 在 macOS 上是字节，Linux 上是 KB（进程生命周期内的峰值）
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _usage_snapshot() -> float:
+    if resource is None:
+        return time.process_time()
+    return _cpu_seconds(resource.RUSAGE_SELF) + _cpu_seconds(resource.RUSAGE_CHILDREN)
+
+
+def _preload(namespace: dict):
+    """预先导入常用的数据分析库，避免每一步都支付导入开销"""
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    preloads = [
+        ("pd", "pandas"),
+        ("np", "numpy"),
+        ("matplotlib", "matplotlib"),
+        ("plt", "matplotlib.pyplot"),
+        ("sns", "seaborn"),
+        ("scipy", "scipy"),
+        ("stats", "scipy.stats"),
+        ("sm", "statsmodels.api"),
+    ]
+    for alias, module_name in preloads:
+        try:
+            module = __import__(module_name, fromlist=["_"])
+            namespace[alias] = module
+        except Exception:
+            pass
+
+    # 列式缓存加载器：load('sales.xlsx') 命中缓存时毫秒级返回
+    try:
+        import dataset_cache
+        namespace["load"] = dataset_cache.load
+        # 服务进程中 pyarrow 是按需导入的，内核里提前导入，第一次 load() 不用等
+        dataset_cache._feather()
+    except Exception:
+        pass
+
+    # 大文件 SQL 查询：sql("SELECT ... FROM sales GROUP BY ...")
+    try:
+        from dataset_query import sql
+        namespace["sql"] = sql
+    except Exception:
+        pass
+
+    # 大数据量绘图：line_plot / scatter_plot 自动降采样，中文字体只在内核启动时配置一次
+    try:
+        import plot_helpers
+        plot_helpers.setup_fonts()
+        plot_helpers.install_guard()
+        for name in ("line_plot", "scatter_plot", "save_chart", "lttb"):
+            namespace[name] = getattr(plot_helpers, name)
+    except Exception:
+        pass
+
+
+_WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | getattr(os, "O_APPEND", 0) | getattr(os, "O_TRUNC", 0)
+_cow_state = threading.local()
+
+
+def _break_link(path: str):
+    """写入前把硬链接替换为独立副本，避免改写共享的上传文件（写时复制）"""
+    tmp_path = f"{path}.{os.getpid()}.cow"
+    shutil.copy2(path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _copy_on_write_hook(event: str, args):
+    if event != "open" or getattr(_cow_state, "active", False):
+        return
+    path, _, flags = args
+    if not isinstance(flags, int) or not flags & _WRITE_FLAGS or isinstance(path, int):
+        return
+    try:
+        path = os.path.abspath(os.fsdecode(path))
+        # 只处理当前工作区内、仍与其他文件共享 inode 的文件
+        if not path.startswith(os.getcwd() + os.sep) or os.stat(path).st_nlink <= 1:
+            return
+    except (OSError, TypeError, ValueError):
+        return
+    _cow_state.active = True
+    try:
+        _break_link(path)
+    except OSError:
+        pass
+    finally:
+        _cow_state.active = False
+
+
+# 本次执行中读取过的工作区文件（相对路径）
+_reads = set()
+
+
+def _read_tracking_hook(event: str, args):
+    if event == "open":
+        path, _, flags = args
+        if isinstance(path, int) or (isinstance(flags, int) and flags & _WRITE_FLAGS):
+            return
+    elif event == "dataset_cache.read":
+        # load() / sql() 命中列式缓存时不会打开源文件，由 dataset_cache 显式报告
+        path = args[0]
+    else:
+        return
+    try:
+        path = os.path.abspath(os.fsdecode(path))
+        cwd = os.getcwd()
+    except (OSError, TypeError, ValueError):
+        return
+    if path.startswith(cwd + os.sep):
+        _reads.add(os.path.relpath(path, cwd).replace(os.sep, "/"))
+
+
+def _close_figures():
+    """每步执行后关闭残留的 figure，防止常驻进程内存增长"""
+    plt = sys.modules.get("matplotlib.pyplot")
+    if plt is not None:
+        try:
+            plt.close("all")
+        except Exception:
+            pass
+
+
+def _run(code_str: str, filename: str, namespace: dict) -> dict:
+    """在持久命名空间中执行一段代码，返回执行状态"""
+    status = {"ok": True, "error": None}
+    # 注册源码，让 traceback 能显示出错的代码行
+    linecache.cache[filename] = (len(code_str), None, code_str.splitlines(True), filename)
+    try:
+        compiled = compile(code_str, filename, "exec")
+        exec(compiled, namespace)
+    except CPUTimeExceeded as e:
+        print(f"\n[Error]: {e}")
+        status = {"ok": False, "error": "CPUTimeExceeded"}
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            status = {"ok": False, "error": f"SystemExit({e.code})"}
+    except BaseException as e:
+        # 去掉内核自身的栈帧，只保留用户代码部分
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != filename:
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb if tb is not None else e.__traceback__)
+        status = {"ok": False, "error": type(e).__name__}
+    return status
+
+
+def main():
+    # 协议通道使用独立的文件描述符，用户代码拿到的是普通的 stdout/stderr
+    protocol_in = os.fdopen(os.dup(sys.stdin.fileno()), "r", encoding="utf-8")
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    sys.stdin = io.StringIO()
+
+    user_stream = io.TextIOWrapper(
+        os.fdopen(os.dup(sys.stdout.fileno()), "wb"),
+        encoding="utf-8",
+        errors="replace",
+        line_buffering=True,
+    )
+    sys.stdout = user_stream
+    sys.stderr = user_stream
+
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+    _preload(namespace)
+    sys.addaudithook(_copy_on_write_hook)
+    sys.addaudithook(_read_tracking_hook)
+    if resource is not None and hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, _on_sigxcpu)
+
+    step = 0
+    for raw in protocol_in:
+        raw = raw.strip()
+        if not raw:
+            continue
+        try:
+            request = json.loads(raw)
+        except ValueError:
+            continue
+
+        step += 1
+        cwd = request.get("cwd")
+        if cwd:
+            try:
+                os.chdir(cwd)
+            except OSError as e:
+                print(f"[Error]: cannot enter workspace {cwd}: {e}")
+
+        started = time.perf_counter()
+        cpu_started = _usage_snapshot()
+        _reset_peak_rss()
+        _reads.clear()
+        _arm_cpu_limit()
+        try:
+            status = _run(request.get("code", ""), f"<step_{step}>", namespace)
+            _close_figures()
+        except CPUTimeExceeded:
+            # 信号恰好在用户代码之外到达
+            status = {"ok": False, "error": "CPUTimeExceeded"}
+        finally:
+            _disarm_cpu_limit()
+
+        try:
+            user_stream.flush()
+        except Exception:
+            pass
+
+        status["id"] = request.get("id")
+        status["elapsed"] = round(time.perf_counter() - started, 4)
+        status["cpu_s"] = round(_usage_snapshot() - cpu_started, 3)
+        status["peak_rss_mb"] = _peak_rss_mb()
+        status["reads"] = sorted(_reads)
+        protocol_out.write(DONE_MARKER + json.dumps(status) + "\n")
+        protocol_out.flush()
+
+
+if __name__ == "__main__":
+    main()
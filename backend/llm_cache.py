@@ -0,0 +1,264 @@
+"""
+LLM 响应缓存与录制/回放
+
+包装 AsyncOpenAI 的流式 chat.completions.create：
+- 以模型、采样参数和规范化后的消息列表的哈希作为键，命中时直接回放缓存的流式 chunk（不做任何延时）
+- 缓存保存在本地 SQLite 中，按 TTL 和条目数上限（LRU）淘汰
+- record 模式总是请求上游，并把每次请求和响应追加写入 JSONL fixture，用于离线基准测试
+
+模式 (LLM_CACHE_MODE):
+- off: 不使用缓存
+- readwrite: 命中则回放，未命中请求上游并写入缓存
+- record: 总是请求上游，写入缓存和 fixture
+- replay: 只从缓存回放，未命中时报错（离线运行）
+"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MODES = ("off", "readwrite", "record", "replay")
+# 参与缓存键的请求参数（stream_options 等只影响传输方式的参数不参与）
+KEY_PARAMS = ("model", "temperature", "top_p", "max_tokens", "stop", "seed")
+
+
+class CacheMiss(Exception):
+    """replay 模式下没有对应的缓存"""
+
+
+def canonical_key(params: Dict[str, Any]) -> str:
+    """模型 + 采样参数 + 消息列表的规范化哈希"""
+    payload = {k: params.get(k) for k in KEY_PARAMS if params.get(k) is not None}
+    payload["messages"] = [
+        {"role": m.get("role"), "content": m.get("content") or ""} for m in params.get("messages", [])
+    ]
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _make_chunk(content: Optional[str] = None, usage: Optional[Dict[str, Any]] = None) -> SimpleNamespace:
+    """构造与 openai 流式 chunk 结构兼容的对象"""
+    if usage is not None:
+        details = usage.get("prompt_tokens_details")
+        usage_obj = SimpleNamespace(
+            **{k: v for k, v in usage.items() if k != "prompt_tokens_details"},
+            prompt_tokens_details=SimpleNamespace(**details) if details else None,
+        )
+        return SimpleNamespace(choices=[], usage=usage_obj)
+    delta = SimpleNamespace(content=content, role=None)
+    choice = SimpleNamespace(index=0, delta=delta, finish_reason=None)
+    return SimpleNamespace(choices=[choice], usage=None)
+
+
+def _usage_dict(usage) -> Optional[Dict[str, Any]]:
+    if usage is None:
+        return None
+    if hasattr(usage, "model_dump"):
+        return usage.model_dump()
+    return dict(vars(usage))
+
+
+class LLMCache:
+    """SQLite 存储；所有数据库操作都在线程池中执行"""
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600, max_entries: int = 5000):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, chunks TEXT, size INTEGER,"
+            " created REAL, last_used REAL, hits INTEGER DEFAULT 0)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chunks, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, record: Dict[str, Any]):
+        data = json.dumps(record, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, chunks, size, created, last_used, hits)"
+                " VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (key, model, data, len(data), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        if self.ttl:
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": count, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ReplayStream:
+    """按原顺序回放缓存的 chunk，接口与 openai 的 AsyncStream 一致（async 迭代 + close）"""
+
+    cache_hit = True
+
+    def __init__(self, record: Dict[str, Any]):
+        self._record = record
+        self._closed = False
+
+    async def __aiter__(self) -> AsyncIterator[SimpleNamespace]:
+        for content in self._record.get("chunks", []):
+            if self._closed:
+                return
+            yield _make_chunk(content)
+            # 只让出事件循环，不模拟网络延迟
+            await asyncio.sleep(0)
+        if self._record.get("usage") and not self._closed:
+            yield _make_chunk(usage=self._record["usage"])
+
+    async def close(self):
+        self._closed = True
+
+
+class RecordingStream:
+    """透传上游流，同时记录 chunk；正常结束或被调用方主动关闭时写入缓存"""
+
+    cache_hit = False
+
+    def __init__(self, upstream, on_complete):
+        self._upstream = upstream
+        self._on_complete = on_complete
+        self._chunks: List[str] = []
+        self._usage: Optional[Dict[str, Any]] = None
+        self._saved = False
+
+    def __getattr__(self, name: str):
+        # 透传上游流的附加属性（例如路由器记录的上游地址和实际使用的模型）
+        return getattr(self._upstream, name)
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        async for chunk in self._upstream:
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                self._usage = _usage_dict(usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                self._chunks.append(chunk.choices[0].delta.content)
+            yield chunk
+        await self._save()
+
+    async def _save(self):
+        if self._saved or not self._chunks:
+            return
+        self._saved = True
+        await self._on_complete({"chunks": self._chunks, "usage": self._usage})
+
+    async def close(self):
+        # 提前派发 <Code> 时调用方会主动关闭流，已收到的部分就是会被使用的完整响应
+        try:
+            await self._upstream.close()
+        finally:
+            await self._save()
+
+
+class CachedChatCompletions:
+    """chat.completions 的缓存包装，只缓存流式请求"""
+
+    def __init__(self, client, cache: Optional[LLMCache], mode: str = "off", record_dir: Optional[str] = None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown LLM cache mode: {mode}")
+        self.client = client
+        self.cache = cache
+        self.mode = mode if cache is not None else "off"
+        self.record_dir = os.path.abspath(record_dir) if record_dir else None
+        if self.record_dir:
+            os.makedirs(self.record_dir, exist_ok=True)
+
+    async def create(self, fixture: Optional[str] = None, **params):
+        """
+        与 client.chat.completions.create 参数相同；fixture 为 record 模式下写入的 fixture 名（通常是会话 ID）
+        """
+        if self.mode == "off" or not params.get("stream"):
+            return await self.client.chat.completions.create(**params)
+
+        loop = asyncio.get_event_loop()
+        key = canonical_key(params)
+        if self.mode in ("readwrite", "replay"):
+            record = await loop.run_in_executor(None, self.cache.get, key)
+            if record is not None:
+                return ReplayStream(record)
+            if self.mode == "replay":
+                raise CacheMiss(f"No cached response for request {key[:12]}")
+
+        upstream = await self.client.chat.completions.create(**params)
+
+        async def on_complete(record: Dict[str, Any]):
+            try:
+                await loop.run_in_executor(None, self.cache.put, key, params.get("model", ""), record)
+                if self.mode == "record" and self.record_dir:
+                    await loop.run_in_executor(None, self._write_fixture, fixture or "default", key, params, record)
+            except Exception as e:
+                logger.warning(f"Failed to store LLM response in cache: {e}")
+
+        return RecordingStream(upstream, on_complete)
+
+    def _write_fixture(self, name: str, key: str, params: Dict[str, Any], record: Dict[str, Any]):
+        entry = {
+            "key": key,
+            "model": params.get("model"),
+            "messages": params.get("messages"),
+            "chunks": record["chunks"],
+            "usage": record.get("usage"),
+            "recorded_at": time.time(),
+        }
+        with open(os.path.join(self.record_dir, f"{name}.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def load_fixtures(path: str) -> List[Dict[str, Any]]:
+    """读取 record 模式写出的 fixture 文件（单个 .jsonl 或目录）"""
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".jsonl"))
+    entries = []
+    for file_path in files:
+        with open(file_path, "r", encoding="utf-8") as f:
+            entries.extend(json.loads(line) for line in f if line.strip())
+    return entries
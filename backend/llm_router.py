@@ -0,0 +1,452 @@
+"""
+多上游 LLM 路由
+
+- 每个上游 (OPENAI_BASE_URL 可用逗号分隔多个) 使用独立的 httpx 连接池，池大小、keep-alive 和超时可配置，
+  可选 HTTP/2（需要安装 h2）
+- 按最少在途请求数 (least outstanding requests) 选择上游，相同时选首 token 延迟较低的
+- 连接错误、超时、429 和 5xx 自动换一个上游重试，连续失败的上游按指数退避暂停使用；
+  所有上游都失败时依次尝试 LLM_FALLBACK_MODELS 中的模型
+- 对冲请求 (hedging)：流式请求在该上游最近首 token 延迟的 P95（可配置）内没有返回第一个 chunk 时，
+  向另一个上游再发一次，先返回的胜出，另一个立即取消
+- 每个上游记录请求数、错误数、在途数和首 token 延迟分位数，由 /llm/backends 导出
+
+对外提供与 AsyncOpenAI 相同的 `chat.completions.create` 和 `models.list` 接口，可以直接交给 CachedChatCompletions。
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import importlib.util
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 这些状态码反映上游的健康状况（超时、限流、服务端错误），换一个上游重试可能成功
+RETRYABLE_STATUS = {408, 429}
+# 模型不存在：请求本身的问题，不重试也不暂停上游，直接换备用模型
+MODEL_NOT_FOUND_STATUS = 404
+# 上游连续失败后的暂停时间上限 (秒)
+MAX_COOLDOWN = 30.0
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [v.strip() for v in (value or "").split(",") if v.strip()]
+
+
+def _retryable(error: BaseException) -> bool:
+    if isinstance(error, httpx.TransportError):
+        return True
+    from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code in RETRYABLE_STATUS or error.status_code >= 500)
+
+
+def _model_not_found(error: BaseException) -> bool:
+    from openai import APIStatusError
+
+    return isinstance(error, APIStatusError) and error.status_code == MODEL_NOT_FOUND_STATUS
+
+
+class Backend:
+    """一个上游地址及其连接池和延迟统计"""
+
+    def __init__(self, base_url: str, api_key: Optional[str], limits: httpx.Limits, timeout: httpx.Timeout, http2: bool):
+        self.base_url = base_url
+        self.api_key = api_key
+        self._client_options = {"limits": limits, "timeout": timeout, "http2": http2}
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.ttft_samples: deque = deque(maxlen=256)
+        self.ttft_ewma: Optional[float] = None
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+
+    @property
+    def client(self):
+        # openai SDK 导入和 TLS 上下文的创建都较慢，第一次使用时才创建客户端，不拖慢服务启动
+        # （服务就绪后由 LLMRouter.warm_up 在后台提前创建）
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from openai import AsyncOpenAI
+
+                    self.http_client = httpx.AsyncClient(trust_env=False, **self._client_options)
+                    # 重试由路由器负责，SDK 自身不再重试
+                    self._client = AsyncOpenAI(
+                        api_key=self.api_key, base_url=self.base_url, http_client=self.http_client, max_retries=0
+                    )
+        return self._client
+
+    def reserve(self):
+        """选中后立即计入在途请求，并发请求不会都挑中同一个上游"""
+        self.outstanding += 1
+        self.requests += 1
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def record_success(self, ttft: Optional[float] = None):
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        if ttft is not None:
+            self.ttft_samples.append(ttft)
+            self.ttft_ewma = ttft if self.ttft_ewma is None else 0.8 * self.ttft_ewma + 0.2 * ttft
+
+    def record_failure(self, error: BaseException):
+        self.errors += 1
+        if not _retryable(error):
+            # 请求本身的问题（参数错误等），与上游健康无关
+            return
+        self.consecutive_failures += 1
+        self.down_until = time.monotonic() + min(MAX_COOLDOWN, 2.0 ** (self.consecutive_failures - 1))
+
+    def ttft_percentile(self, percentile: float) -> Optional[float]:
+        if not self.ttft_samples:
+            return None
+        ordered = sorted(self.ttft_samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    def stats(self) -> Dict[str, Any]:
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            "base_url": self.base_url,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "available": self.available(),
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "ttft_samples": len(self.ttft_samples),
+            "ttft_ewma_ms": ms(self.ttft_ewma),
+            "ttft_p50_ms": ms(self.ttft_percentile(50)),
+            "ttft_p95_ms": ms(self.ttft_percentile(95)),
+            "ttft_p99_ms": ms(self.ttft_percentile(99)),
+        }
+
+
+class _Attempt:
+    """已经收到第一个 chunk 的上游流"""
+
+    def __init__(self, backend: Backend, stream, iterator, first):
+        self.backend = backend
+        self.stream = stream
+        self.iterator = iterator
+        self.first = first
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.backend.outstanding -= 1
+
+    async def close(self):
+        self.release()
+        try:
+            await self.stream.close()
+        except Exception:
+            pass
+
+
+class RoutedStream:
+    """路由后的流式响应，接口与 openai 的 AsyncStream 一致；附带实际使用的上游和模型"""
+
+    def __init__(self, attempt: _Attempt, model: str, hedged: bool, attempts: int):
+        self._attempt = attempt
+        self.backend = attempt.backend.base_url
+        self.model = model
+        self.hedged = hedged
+        self.attempts = attempts
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        try:
+            if self._attempt.first is not None:
+                yield self._attempt.first
+            async for chunk in self._attempt.iterator:
+                yield chunk
+        finally:
+            self._attempt.release()
+
+    async def close(self):
+        await self._attempt.close()
+
+
+class LLMRouter:
+    """多上游路由器"""
+
+    def __init__(
+        self,
+        base_urls: List[str],
+        api_keys: List[Optional[str]],
+        limits: httpx.Limits,
+        timeout: httpx.Timeout,
+        http2: bool = False,
+        max_attempts: int = 3,
+        fallback_models: Optional[List[str]] = None,
+        hedge: bool = False,
+        hedge_percentile: float = 95,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 0.5,
+    ):
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("LLM_HTTP2 is enabled but the h2 package is not installed, falling back to HTTP/1.1")
+            http2 = False
+        base_urls = base_urls or [None]
+        self.backends = [
+            Backend(url, api_keys[i] if i < len(api_keys) else (api_keys[0] if api_keys else None), limits, timeout, http2)
+            for i, url in enumerate(base_urls)
+        ]
+        self.max_attempts = max(1, max_attempts)
+        self.fallback_models = fallback_models or []
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        # 与 AsyncOpenAI 相同的调用方式
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.models = SimpleNamespace(list=self.list_models)
+
+    @classmethod
+    def from_env(cls) -> "LLMRouter":
+        return cls(
+            base_urls=_split(os.getenv("OPENAI_BASE_URL")),
+            api_keys=_split(os.getenv("OPENAI_API_KEY")),
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "100")),
+                max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", "20")),
+                keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30")),
+            ),
+            timeout=httpx.Timeout(
+                float(os.getenv("LLM_TIMEOUT", "60")),
+                connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "10")),
+            ),
+            http2=os.getenv("LLM_HTTP2", "0").lower() in ("1", "true", "yes"),
+            max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", "3")),
+            fallback_models=_split(os.getenv("LLM_FALLBACK_MODELS")),
+            hedge=os.getenv("LLM_HEDGE", "0").lower() in ("1", "true", "yes"),
+            hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "95")),
+            hedge_min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")),
+            hedge_min_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5")),
+        )
+
+    def _pick(self, exclude: Optional[set] = None) -> Backend:
+        """最少在途请求的可用上游；全部暂停时忽略暂停状态"""
+        candidates = [b for b in self.backends if not exclude or b not in exclude] or self.backends
+        candidates = [b for b in candidates if b.available()] or candidates
+        backend = min(
+            candidates,
+            key=lambda b: (b.outstanding, b.ttft_ewma if b.ttft_ewma is not None else 0.0),
+        )
+        backend.reserve()
+        return backend
+
+    def _hedge_delay(self, backend: Backend) -> Optional[float]:
+        if not self.hedge or len(backend.ttft_samples) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, backend.ttft_percentile(self.hedge_percentile))
+
+    async def _open(self, backend: Backend, params: Dict[str, Any]) -> _Attempt:
+        """发起请求并等待第一个 chunk，记录首 chunk 延迟（调用前已由 _pick 计入在途请求）"""
+        started = time.perf_counter()
+        stream = None
+        try:
+            stream = await backend.client.chat.completions.create(**params)
+            iterator = stream.__aiter__()
+            try:
+                first = await iterator.__anext__()
+            except StopAsyncIteration:
+                first = None
+        except BaseException as e:
+            backend.outstanding -= 1
+            if not isinstance(e, asyncio.CancelledError):
+                backend.record_failure(e)
+            if stream is not None:
+                try:
+                    await stream.close()
+                except Exception:
+                    pass
+            raise
+        backend.record_success(time.perf_counter() - started)
+        return _Attempt(backend, stream, iterator, first)
+
+    async def _open_hedged(self, backend: Backend, params: Dict[str, Any], tried: set):
+        """返回 (attempt, hedged)；首 chunk 超过对冲阈值时向另一个上游再发一次"""
+        primary = asyncio.create_task(self._open(backend, params))
+        delay = self._hedge_delay(backend)
+        if delay is None:
+            return await primary, False
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result(), False
+
+        other = self._pick(exclude=tried | {backend})
+        other.hedges += 1
+        logger.info(f"Hedging LLM request: {backend.base_url} exceeded {delay * 1000:.0f} ms, also trying {other.base_url}")
+        secondary = asyncio.create_task(self._open(other, params))
+        pending = {primary, secondary}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((t for t in done if t.exception() is None), None)
+            if winner is None:
+                error = next(iter(done)).exception()
+                continue
+            # 另一个请求：还在进行的取消，已经建立的流关闭
+            for loser in (primary, secondary):
+                if loser is not winner:
+                    loser.cancel()
+                    loser.add_done_callback(self._close_late)
+            if winner is secondary:
+                other.hedges_won += 1
+            return winner.result(), True
+        raise error
+
+    @staticmethod
+    def _close_late(task: asyncio.Task):
+        # 被取消的对冲请求如果已经建立了流，需要关闭以释放连接
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(task.result().close())
+
+    async def create(self, **params):
+        """
+        与 client.chat.completions.create 相同。流式请求返回 RoutedStream；
+        所有上游和备用模型都失败时抛出最后一个错误。
+        """
+        models = [params.get("model")] + [m for m in self.fallback_models if m != params.get("model")]
+        last_error: Optional[BaseException] = None
+        attempts = 0
+        for model in models:
+            request = {**params, "model": model}
+            tried: set = set()
+            for _ in range(self.max_attempts):
+                backend = self._pick(exclude=tried)
+                tried.add(backend)
+                attempts += 1
+                try:
+                    if not params.get("stream"):
+                        return await self._call(backend, request)
+                    attempt, hedged = await self._open_hedged(backend, request, tried)
+                    return RoutedStream(attempt, model, hedged, attempts)
+                except Exception as e:
+                    last_error = e
+                    if _model_not_found(e) and model != models[-1]:
+                        # 其他上游大概率同样没有这个模型，直接换下一个模型
+                        break
+                    if not _retryable(e):
+                        raise
+                    logger.warning(f"LLM request to {backend.base_url} ({model}) failed: {e}")
+            if model != models[-1]:
+                logger.warning(f"All upstreams failed for {model}, falling back to {models[models.index(model) + 1]}")
+        raise last_error
+
+    async def _call(self, backend: Backend, params: Dict[str, Any]):
+        try:
+            response = await backend.client.chat.completions.create(**params)
+        except Exception as e:
+            backend.record_failure(e)
+            raise
+        finally:
+            backend.outstanding -= 1
+        backend.record_success()
+        return response
+
+    async def list_models(self):
+        last_error: Optional[BaseException] = None
+        for backend in sorted(self.backends, key=lambda b: (not b.available(), b.errors)):
+            try:
+                return await backend.client.models.list()
+            except Exception as e:
+                last_error = e
+        raise last_error
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [b.stats() for b in self.backends]
+
+    def warm_up(self):
+        """提前创建各上游的客户端（在线程池中调用），第一次请求不用等待"""
+        for backend in self.backends:
+            backend.client
+
+    async def aclose(self):
+        for backend in self.backends:
+            if backend.http_client is not None:
+                await backend.http_client.aclose()
+
+
+class ModelListCache:
+    """
+    上游模型列表缓存：
+    - 后台任务定期刷新，/v1/models 直接返回内存中的列表，不再每次页面加载都请求上游
+    - 刷新失败时继续返回旧列表（记录最后一次错误），失败后 retry_after 秒内不再重试
+    - 还没有任何列表时才等待一次刷新，最多 timeout 秒
+    """
+
+    def __init__(self, router: "LLMRouter", ttl: float = 300.0, timeout: float = 3.0, retry_after: float = 15.0):
+        self.router = router
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.models: Optional[List[Dict[str, Any]]] = None
+        self.fetched_at = 0.0
+        self.failed_at = 0.0
+        self.last_error: Optional[str] = None
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def _fetch(self):
+        try:
+            page = await asyncio.wait_for(self.router.list_models(), self.timeout)
+            self.models = [m.model_dump() if hasattr(m, "model_dump") else dict(m) for m in page.data]
+            self.fetched_at = time.monotonic()
+            self.last_error = None
+        except Exception as e:
+            self.failed_at = time.monotonic()
+            self.last_error = f"{type(e).__name__}: {e}"
+            logger.warning(f"Model list refresh failed: {self.last_error}")
+
+    def refresh(self) -> asyncio.Task:
+        """启动一次刷新；已有刷新在进行时复用同一个任务"""
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._fetch())
+        return self._refreshing
+
+    async def get(self) -> Optional[List[Dict[str, Any]]]:
+        now = time.monotonic()
+        fresh = self.models is not None and now - self.fetched_at < self.ttl
+        if not fresh and now - self.failed_at >= self.retry_after:
+            task = self.refresh()
+            if self.models is None:
+                # 请求被取消时不取消共享的刷新任务
+                await asyncio.shield(task)
+        return self.models
+
+    async def run(self):
+        """后台刷新循环，在列表过期之前更新"""
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.retry_after if self.last_error else max(self.ttl / 2, 1.0))
+
+    def ids(self) -> List[str]:
+        """当前缓存列表中的模型 id"""
+        return [m.get("id") for m in self.models or () if m.get("id")]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "models": len(self.models) if self.models is not None else None,
+            "age_s": round(time.monotonic() - self.fetched_at, 1) if self.models is not None else None,
+            "last_error": self.last_error,
+        }
@@ -1,22 +1,20 @@
+import time
+# 启动耗时从这里开始计算（见 startup 中的预算检查）
+STARTUP_STARTED = time.perf_counter()
 import os
+import re
 import json
 import asyncio
 import logging
-from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Iterator, Optional
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
-import httpx
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import io
-import base64
 import traceback
+import subprocess
 import sys
 
 # 加载环境变量
@@ -25,12 +23,29 @@ env_path = os.path.join(root_dir, '.env')
 load_dotenv(dotenv_path=env_path)
 
 BACKEND_PORT = int(os.getenv("BACKEND_PORT", "8080"))
+# 从加载模块到就绪的时间预算 (秒)，超出时告警。
+# 仅 FastAPI / pydantic 的导入就约 0.35 秒，实测热启动约 0.7 秒、冷启动（文件缓存未命中）约 1 秒；
+# 默认 2 秒给冷启动留出余量，用来发现真正的回归（例如服务进程误导入 pandas 会多出数秒）
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "2.0"))
+# 服务进程不应导入的重型库（数据处理和绘图只在沙箱 / 子进程中进行）
+HEAVY_MODULES = ("pandas", "matplotlib", "seaborn", "pyarrow", "scipy", "statsmodels", "sklearn")
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="DataSight Agent API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    服务生命周期：startup 与 shutdown 定义在下文
+    """
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+app = FastAPI(title="DataSight Agent API", lifespan=lifespan)
 
 # 配置 CORS
 app.add_middleware(
@@ -39,25 +54,99 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Total-Count"],
 )
 
-# 挂载静态文件目录，用于访问生成的图表和报告
+# 生成的图表和报告通过 /output/<路径> 访问（见 get_output，支持条件请求、范围请求和压缩）
 os.makedirs("output", exist_ok=True)
 os.makedirs("uploads", exist_ok=True)
-app.mount("/output", StaticFiles(directory="output"), name="output")
 
-# 初始化 OpenAI 客户端
-# 创建一个不使用系统代理的 httpx 客户端，并设置超时
-http_client = httpx.AsyncClient(trust_env=False, timeout=httpx.Timeout(60.0, connect=10.0))
+# 列式数据集缓存目录（沙箱内核通过环境变量继承）
+os.environ.setdefault("DATASET_CACHE_DIR", os.path.abspath(os.path.join("cache", "datasets")))
+import dataset_cache
+import dataset_profile
+import upload_store
+import artifact_serving
+from file_catalog import FileCatalog
+DATASET_CACHE_SCRIPT = os.path.abspath(dataset_cache.__file__)
+# 注入到 # Data 上下文中的数据画像 token 预算
+PROFILE_TOKEN_BUDGET = int(os.getenv("PROFILE_TOKEN_BUDGET", "2000"))
+PROFILE_BUILD_TIMEOUT = float(os.getenv("PROFILE_BUILD_TIMEOUT", "30"))
+# 上传文件和产物的内存目录：启动时扫描一次，之后由上传、删除、产物收集路径更新，列表接口和 Agent 上下文不再扫描目录
+uploads_catalog = FileCatalog("uploads", hash_lookup=dataset_cache.known_sha256)
+outputs_catalog = FileCatalog("output", recursive=True)
+# 列表接口单页最大条数
+CATALOG_PAGE_MAX = int(os.getenv("CATALOG_PAGE_MAX", "1000"))
+
+async def serve_catalog_file(request: Request, catalog: FileCatalog, name: str, download: bool = False) -> Response:
+    """
+    按目录条目返回文件；确认条目与磁盘一致（必要时重新计算哈希）和压缩都可能读文件，放到线程池中执行
+    """
+    def serve():
+        entry = catalog.lookup(name)
+        if entry is None:
+            return None
+        path = os.path.join(catalog.root, *name.split("/"))
+        return artifact_serving.serve_file(request, path, entry, filename=os.path.basename(name) if download else None)
+
+    response = await asyncio.get_event_loop().run_in_executor(None, serve)
+    if response is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return response
+
+def catalog_listing(request: Request, catalog: FileCatalog, to_item, prefix: str = "",
+                    q: Optional[str] = None, mime: Optional[str] = None,
+                    offset: int = 0, limit: Optional[int] = None) -> Response:
+    """
+    目录列表响应：按 mtime 倒序分页，总数放在 X-Total-Count 中；
+    目录未变化且客户端带了相同的 If-None-Match 时返回 304
+    """
+    offset = max(offset, 0)
+    limit = min(limit, CATALOG_PAGE_MAX) if limit is not None and limit >= 0 else None
+    # 不同的过滤条件和分页是不同的表示，ETag 需要区分
+    etag = catalog.etag(prefix, query={"q": q, "mime": mime, "offset": offset, "limit": limit})
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    total, entries = catalog.query(prefix, q=q, mime=mime, offset=offset, limit=limit)
+    headers["X-Total-Count"] = str(total)
+    return JSONResponse([to_item(e) for e in entries], headers=headers)
 
-client = AsyncOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("OPENAI_BASE_URL"),
-    http_client=http_client
+# 初始化 LLM 客户端
+# OPENAI_BASE_URL 可以是逗号分隔的多个上游：独立连接池、最少在途请求路由、失败重试、对冲请求和备用模型
+from llm_router import LLMRouter, ModelListCache
+llm_router = LLMRouter.from_env()
+# 模型列表缓存：后台定期刷新，上游不可用时返回旧列表，页面加载不用等待上游超时
+model_list = ModelListCache(
+    llm_router,
+    ttl=float(os.getenv("MODEL_LIST_TTL", "300")),
+    timeout=float(os.getenv("MODEL_LIST_TIMEOUT", "3")),
 )
+# 上游模型列表不可用时返回的默认模型
+DEFAULT_MODELS = ["deepseek-ai/DeepSeek-V3.1-Terminus", "gpt-4o", "claude-3-5-sonnet"]
 
-# 全局状态存储（简化版，实际应使用数据库或 Redis）
-chat_history: List[Dict[str, Any]] = []
+# 可选的 LLM 响应缓存 / 录制回放（相同模型和消息列表直接回放缓存的流式响应）
+from llm_cache import LLMCache, CachedChatCompletions
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "off").lower()
+llm_cache = None
+if LLM_CACHE_MODE != "off":
+    llm_cache = LLMCache(
+        os.getenv("LLM_CACHE_PATH", os.path.join("cache", "llm_cache.sqlite")),
+        ttl=float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600))),
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000")),
+    )
+llm_completions = CachedChatCompletions(
+    llm_router, llm_cache, LLM_CACHE_MODE,
+    record_dir=os.getenv("LLM_RECORD_DIR", os.path.join("cache", "llm_fixtures")) if LLM_CACHE_MODE == "record" else None,
+)
+
+# 会话持久化：断线后按 session_id 恢复上下文（需要 aiosqlite）
+from session_store import SessionStore, aiosqlite
+SESSION_PERSIST = os.getenv("SESSION_PERSIST", "1").lower() in ("1", "true", "yes")
+session_store = None
+if SESSION_PERSIST and aiosqlite is not None:
+    session_store = SessionStore(os.getenv("SESSION_DB_PATH", os.path.join("cache", "sessions.sqlite")))
 
 class ModelListResponse(BaseModel):
     id: str
@@ -72,51 +161,156 @@ class ModelsResponse(BaseModel):
 @app.get("/v1/models", response_model=ModelsResponse)
 async def list_models():
     """
-    获取可用模型列表
+    获取可用模型列表（来自缓存，见 ModelListCache）
+    """
+    models = await model_list.get()
+    if models:
+        return {"object": "list", "data": models}
+    else:
+        logger.error(f"获取模型列表失败: {model_list.last_error}")
+        # 返回默认模型用于测试
+        return ModelsResponse(data=[ModelListResponse(id=m) for m in DEFAULT_MODELS])
+
+def build_dataset_cache(file_path: str, timeout: float = 600):
+    """
+    在子进程中为数据文件构建列式缓存和数据画像（避免在服务进程中导入 pandas）
     """
     try:
-        # 尝试从上游获取，如果失败则返回默认
-        models = await client.models.list()
-        return models
+        result = subprocess.run(
+            [sys.executable, DATASET_CACHE_SCRIPT, "build", file_path],
+            capture_output=True, text=True, timeout=timeout,
+        )
+        if result.returncode != 0:
+            logger.warning(f"Dataset cache build failed for {file_path}: {result.stderr.strip()}")
     except Exception as e:
-        logger.error(f"获取模型列表失败: {e}")
-        # 返回默认模型用于测试
-        return ModelsResponse(data=[
-            ModelListResponse(id="deepseek-ai/DeepSeek-V3.1-Terminus"),
-            ModelListResponse(id="gpt-4o"),
-            ModelListResponse(id="claude-3-5-sonnet")
-        ])
+        logger.warning(f"Dataset cache build failed for {file_path}: {e}")
+
+def collect_data_profiles(filenames: List[str]) -> List[Dict[str, Any]]:
+    """
+    读取上传文件的数据画像；尚未构建时同步构建一次（带超时）
+    """
+    entries = []
+    for name in filenames:
+        file_path = os.path.join("uploads", name)
+        profile = None
+        try:
+            profile = dataset_profile.read_profile(file_path)
+            if profile is None and os.path.splitext(name)[1].lower() in dataset_cache.SUPPORTED_EXTENSIONS:
+                build_dataset_cache(file_path, timeout=PROFILE_BUILD_TIMEOUT)
+                profile = dataset_profile.read_profile(file_path)
+        except Exception as e:
+            logger.warning(f"Failed to load profile for {name}: {e}")
+        entries.append({"name": name, "profile": profile})
+    return entries
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
     """
-    上传文件接口
+    上传文件接口（分块流式写入，按内容哈希去重）
     """
-    file_path = f"uploads/{file.filename}"
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
-    return {"filename": file.filename, "path": file_path}
+    filename = os.path.basename(file.filename)
+    file_path = f"uploads/{filename}"
+    result = await upload_store.save_stream(upload_store.iter_upload(file), file_path)
+    uploads_catalog.upsert(filename, result["sha256"])
+    # 后台预先构建列式缓存，沙箱中的 load() 可以直接命中
+    asyncio.get_event_loop().run_in_executor(None, build_dataset_cache, file_path)
+    return {"filename": filename, "path": file_path, **result}
 
-@app.get("/uploads/{filename}")
-async def get_upload(filename: str):
+# 大文件分片续传：POST 创建 -> PUT 追加分片（offset 为已上传字节数）-> POST complete
+resumable_uploads: Dict[str, "upload_store.ResumableUpload"] = {}
+
+class ResumableUploadRequest(BaseModel):
+    filename: str
+    total_size: Optional[int] = None
+
+def get_resumable_upload(upload_id: str) -> "upload_store.ResumableUpload":
+    upload = resumable_uploads.get(upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+@app.post("/uploads/resumable")
+async def create_resumable_upload(req: ResumableUploadRequest):
     """
-    获取/下载上传的文件
+    创建分片上传会话
     """
-    file_path = os.path.join("uploads", filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path, filename=filename)
-    else:
-        raise HTTPException(status_code=404, detail="File not found")
+    upload = upload_store.ResumableUpload(os.path.basename(req.filename), req.total_size)
+    resumable_uploads[upload.upload_id] = upload
+    return upload.status()
+
+@app.get("/uploads/resumable/{upload_id}")
+async def get_resumable_upload_status(upload_id: str):
+    """
+    查询已接收的字节数，断线后从该位置继续上传
+    """
+    return get_resumable_upload(upload_id).status()
+
+@app.put("/uploads/resumable/{upload_id}")
+async def append_resumable_upload(upload_id: str, request: Request, offset: int = 0):
+    """
+    追加一个分片（请求体为原始字节）
+    """
+    upload = get_resumable_upload(upload_id)
+    try:
+        return await upload.append(offset, request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/uploads/resumable/{upload_id}/complete")
+async def complete_resumable_upload(upload_id: str):
+    """
+    完成分片上传，校验大小后提交到 uploads/
+    """
+    upload = get_resumable_upload(upload_id)
+    file_path = f"uploads/{upload.filename}"
+    try:
+        result = await upload.complete(file_path)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    resumable_uploads.pop(upload_id, None)
+    uploads_catalog.upsert(upload.filename, result["sha256"])
+    asyncio.get_event_loop().run_in_executor(None, build_dataset_cache, file_path)
+    return {"filename": upload.filename, "path": file_path, **result}
+
+@app.delete("/uploads/resumable/{upload_id}")
+async def abort_resumable_upload(upload_id: str):
+    """
+    取消分片上传
+    """
+    upload = resumable_uploads.pop(upload_id, None)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    upload.abort()
+    return {"message": f"Upload {upload_id} aborted"}
+
+@app.api_route("/uploads/{filename}", methods=["GET", "HEAD"])
+async def get_upload(filename: str, request: Request):
+    """
+    获取/下载上传的文件（ETag / Range 由 serve_file 处理）
+    """
+    filename = os.path.basename(filename)
+    return await serve_catalog_file(request, uploads_catalog, filename, download=True)
+
+def resolve_upload_path(filename: str) -> str:
+    """
+    上传文件的路径，限制在 uploads/ 目录内（不能指向 blob 存储或其他目录）
+    """
+    upload_root = os.path.abspath("uploads")
+    file_path = os.path.abspath(os.path.join(upload_root, filename))
+    if os.path.dirname(file_path) != upload_root:
+        raise HTTPException(status_code=400, detail="Invalid upload path")
+    return file_path
 
 @app.delete("/files/{filename}")
 async def delete_file(filename: str):
     """
     删除上传的文件
     """
-    file_path = os.path.join("uploads", filename)
-    if os.path.exists(file_path):
+    file_path = resolve_upload_path(filename)
+    if os.path.isfile(file_path):
         try:
-            os.remove(file_path)
+            upload_store.remove(file_path)
+            uploads_catalog.remove(os.path.relpath(file_path, uploads_catalog.root).replace(os.sep, "/"))
             return {"message": f"File {filename} deleted"}
         except Exception as e:
             logger.error(f"Failed to delete file {filename}: {e}")
@@ -125,30 +319,38 @@ async def delete_file(filename: str):
         raise HTTPException(status_code=404, detail="File not found")
 
 @app.get("/files")
-async def list_files():
-    """
-    列出上传的文件
-    """
-    files = []
-    for filename in os.listdir("uploads"):
-        file_path = os.path.join("uploads", filename)
-        if os.path.isfile(file_path):
-            files.append({
-                "name": filename,
-                "size": os.path.getsize(file_path),
-                "path": file_path
-            })
-    return files
-
-@app.delete("/outputs/{filename}")
+async def list_files(request: Request, q: Optional[str] = None, mime: Optional[str] = None,
+                     offset: int = 0, limit: Optional[int] = None):
+    """
+    列出上传的文件（来自内存目录，支持按文件名 / MIME 前缀过滤和分页）
+    """
+    return catalog_listing(
+        request, uploads_catalog, lambda e: {**e, "path": f"uploads/{e['name']}"},
+        q=q, mime=mime, offset=offset, limit=limit,
+    )
+
+def resolve_output_path(filename: str) -> str:
+    """
+    产物路径（可能带会话目录，如 <session_id>/chart.png），限制在 output/ 目录内
+    """
+    output_root = os.path.abspath("output")
+    file_path = os.path.abspath(os.path.join(output_root, filename))
+    if not file_path.startswith(output_root + os.sep):
+        raise HTTPException(status_code=400, detail="Invalid output path")
+    return file_path
+
+@app.delete("/outputs/{filename:path}")
 async def delete_output(filename: str):
     """
-    删除生成的产物文件
+    删除生成的产物文件（只能删除会话目录 output/<session_id>/ 下的产物）
     """
-    file_path = os.path.join("output", filename)
-    if os.path.exists(file_path):
+    file_path = resolve_output_path(filename)
+    if not is_session_id(os.path.relpath(file_path, os.path.abspath("output")).split(os.sep)[0]):
+        raise HTTPException(status_code=400, detail="Invalid output path")
+    if os.path.isfile(file_path):
         try:
             os.remove(file_path)
+            outputs_catalog.remove(os.path.relpath(file_path, outputs_catalog.root).replace(os.sep, "/"))
             return {"message": f"Output {filename} deleted"}
         except Exception as e:
             logger.error(f"Failed to delete output {filename}: {e}")
@@ -157,30 +359,331 @@ async def delete_output(filename: str):
         raise HTTPException(status_code=404, detail="Output not found")
 
 @app.get("/outputs")
-async def list_outputs():
-    """
-    列出生成的产物文件
-    """
-    files = []
-    if os.path.exists("output"):
-        for filename in os.listdir("output"):
-            file_path = os.path.join("output", filename)
-            if os.path.isfile(file_path):
-                files.append({
-                    "name": filename,
-                    "size": os.path.getsize(file_path),
-                    "path": file_path,
-                    "url": f"http://127.0.0.1:{BACKEND_PORT}/output/{filename}"
-                })
-    # 按时间倒序排序
-    files.sort(key=lambda x: os.path.getmtime(x["path"]), reverse=True)
-    return files
-
-from utils import execute_code_stream, WorkspaceTracker, convert_md_to_pdf
+async def list_outputs(request: Request, session_id: Optional[str] = None, q: Optional[str] = None,
+                       mime: Optional[str] = None, offset: int = 0, limit: Optional[int] = None):
+    """
+    列出某个会话生成的产物文件（位于 output/<session_id>/ 下），按时间倒序。
+    必须指定 session_id，客户端不能列出其他会话的产物
+    """
+    if not session_id or not is_session_id(session_id):
+        raise HTTPException(status_code=400, detail="Invalid session id")
+    return catalog_listing(
+        request, outputs_catalog,
+        lambda e: {
+            **e,
+            "path": f"output/{e['name']}",
+            "url": f"http://127.0.0.1:{BACKEND_PORT}/output/{e['name']}",
+        },
+        prefix=f"{session_id}/", q=q, mime=mime, offset=offset, limit=limit,
+    )
+
+@app.api_route("/output/{filename:path}", methods=["GET", "HEAD"])
+async def get_output(filename: str, request: Request):
+    """
+    获取产物文件（output/<session_id>/<文件名>）
+    """
+    file_path = resolve_output_path(filename)
+    name = os.path.relpath(file_path, outputs_catalog.root).replace(os.sep, "/")
+    return await serve_catalog_file(request, outputs_catalog, name)
+
+@app.get("/thumbnails/{filename:path}")
+async def get_thumbnail(filename: str, request: Request):
+    """
+    图片的 WebP 缩略图，filename 为 output/... 或 uploads/... 形式的路径；
+    无法生成缩略图（非位图、未安装 Pillow）时返回 404，前端退回加载原图
+    """
+    root, _, name = filename.partition("/")
+    if root == "output":
+        file_path = resolve_output_path(name)
+        catalog = outputs_catalog
+        name = os.path.relpath(file_path, catalog.root).replace(os.sep, "/")
+    elif root == "uploads":
+        catalog = uploads_catalog
+        name = os.path.basename(name)
+    else:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    def serve():
+        entry = catalog.lookup(name)
+        if entry is None:
+            return None
+        thumb = artifact_serving.make_thumbnail(os.path.join(catalog.root, *name.split("/")), entry["sha256"])
+        if thumb is None:
+            return None
+        return artifact_serving.serve_file(
+            request, thumb, {"sha256": f"{entry['sha256']}-thumb", "mime": "image/webp"}
+        )
+
+    response = await asyncio.get_event_loop().run_in_executor(None, serve)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+    return response
+
+from utils import WorkspaceTracker, OutputCapture
+from kernel_pool import KernelPool
+from scheduler import ExecutionScheduler
+from context_manager import ConversationContext, count_tokens
+from tag_parser import TagStreamParser, extract_blocks
+from ws_sender import BufferedSender
+from session_workspace import SessionWorkspace, new_session_id, is_session_id, unique_name, collect_garbage
+from report_renderer import ReportRenderQueue, LocalAssets
+import metrics
+from metrics import StepSpans
+# 指标的 model 标签只使用已知模型，防止客户端传入任意模型名产生无上限的时间序列
+metrics.set_known_models(lambda: [*DEFAULT_MODELS, *llm_router.fallback_models, *model_list.ids()])
 
 # Agent 系统提示词 (从环境变量加载)
 SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "You are DataSight Agent.")
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "160000"))
+# 发送给 LLM 的对话历史 token 上限，超出后压缩旧的执行输出和推理内容
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "64000"))
+# 请求流式 usage 统计（上游支持时可拿到 cached_tokens，用于确认前缀缓存命中）
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "0").lower() in ("1", "true", "yes")
+
+# 代码执行内核池配置
+EXEC_TIMEOUT = int(os.getenv("EXEC_TIMEOUT", "60"))
+# 代码执行输出上限：实时推送给前端 / 反馈给 LLM 分别限制
+EXEC_OUTPUT_LIMITS = {
+    "client_max_bytes": int(os.getenv("EXEC_CLIENT_MAX_BYTES", str(256 * 1024))),
+    "client_max_lines": int(os.getenv("EXEC_CLIENT_MAX_LINES", "4000")),
+    "llm_max_bytes": int(os.getenv("EXEC_LLM_MAX_BYTES", str(16 * 1024))),
+    "llm_max_lines": int(os.getenv("EXEC_LLM_MAX_LINES", "400")),
+    "spill_max_bytes": int(os.getenv("EXEC_LOG_MAX_BYTES", str(64 * 1024 * 1024))),
+}
+kernel_pool = KernelPool(
+    max_kernels=int(os.getenv("KERNEL_POOL_SIZE", "8")),
+    idle_timeout=float(os.getenv("KERNEL_IDLE_TIMEOUT", "900")),
+    warm_spares=int(os.getenv("KERNEL_WARM_SPARES", "1")),
+)
+# 可选的代码执行结果缓存：相同的代码在相同的执行历史和输入数据上直接回放输出和产物
+from exec_cache import ExecCache, HIT_NOTICE
+exec_cache = None
+if os.getenv("EXEC_CACHE", "0").lower() in ("1", "true", "yes"):
+    exec_cache = ExecCache(
+        os.getenv("EXEC_CACHE_DIR", os.path.join("cache", "exec")),
+        max_bytes=int(os.getenv("EXEC_CACHE_MAX_MB", "512")) * 1024 * 1024,
+        max_output_bytes=int(os.getenv("EXEC_CACHE_MAX_OUTPUT_KB", "1024")) * 1024,
+    )
+# 全局执行调度器：限制并发沙箱数量，其余请求按会话公平排队
+exec_scheduler = ExecutionScheduler(max_concurrent=int(os.getenv("MAX_CONCURRENT_EXECUTIONS", "4")))
+# 报告 PDF 后台渲染队列（相同内容按哈希缓存）
+report_queue = ReportRenderQueue(
+    os.path.join("cache", "reports"),
+    max_workers=int(os.getenv("REPORT_RENDER_WORKERS", "2")),
+)
+
+async def notify_report_job(job, sender: BufferedSender):
+    """
+    等待渲染任务完成，并通过 WebSocket 推送最终状态
+    """
+    await asyncio.wrap_future(job.future)
+    if job.started_at and job.finished_at:
+        metrics.observe("report_queue", job.started_at - job.created_at)
+        metrics.observe("report_render", job.finished_at - job.started_at)
+    logger.info(f"Report job {job.job_id} {job.status}: {job.pdf_path}")
+    await sender.send_json({"type": "report_job", **job.to_dict()})
+    if job.status == "done":
+        await sender.send_json({"type": "files_updated"})
+
+@app.get("/llm/backends")
+async def llm_backends():
+    """
+    各 LLM 上游的在途请求数、错误数、对冲次数和首 token 延迟分位数
+    """
+    return {"backends": llm_router.stats()}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Prometheus 指标（各阶段耗时直方图、token 数、步骤数）
+    """
+    data = metrics.render_latest()
+    if data is None:
+        raise HTTPException(status_code=503, detail="prometheus_client is not installed")
+    return Response(content=data, media_type=metrics.CONTENT_TYPE_LATEST)
+
+@app.get("/reports")
+async def list_report_jobs(session_id: Optional[str] = None):
+    """
+    列出报告渲染任务
+    """
+    return [job.to_dict() for job in report_queue.list(session_id)]
+
+@app.get("/reports/{job_id}")
+async def get_report_job(job_id: str):
+    """
+    查询报告渲染任务状态
+    """
+    job = report_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return job.to_dict()
+
+# 当前连接中的会话 -> 连接和释放事件，GC 不会回收它们的目录
+active_sessions: Dict[str, Dict[str, Any]] = {}
+SESSION_GC_INTERVAL = float(os.getenv("SESSION_GC_INTERVAL", "600"))
+KERNEL_EVICT_INTERVAL = float(os.getenv("KERNEL_EVICT_INTERVAL", "60"))
+# 同一会话重新连接时，等待旧连接退出的最长时间
+SESSION_TAKEOVER_TIMEOUT = float(os.getenv("SESSION_TAKEOVER_TIMEOUT", "10"))
+
+async def claim_session(requested: str, websocket: WebSocket) -> Optional[Dict[str, Any]]:
+    """
+    恢复已保存的会话：旧连接仍在（例如前端点击停止后立即重连）时先关闭它并等待其退出。
+    会话不存在或无法接管时返回 None。
+    """
+    if session_store is None or not is_session_id(requested):
+        return None
+    previous = active_sessions.get(requested)
+    if previous is not None:
+        try:
+            await previous["websocket"].close()
+        except Exception:
+            pass
+        try:
+            await asyncio.wait_for(previous["released"].wait(), SESSION_TAKEOVER_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Session {requested} is still busy, starting a new session")
+            return None
+    return await session_store.load(requested)
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    """
+    会话概要：token 用量、每一步的指标和产物文件
+    """
+    if session_store is None:
+        raise HTTPException(status_code=503, detail="Session persistence is disabled")
+    if not is_session_id(session_id):
+        raise HTTPException(status_code=400, detail="Invalid session id")
+    summary = await session_store.summary(session_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return summary
+
+def register_artifacts(session_id: str, names: List[str]):
+    """
+    把新收集的产物登记到目录，并为其中的图片生成缩略图（在线程池中调用）
+    """
+    entries = outputs_catalog.upsert_many([f"{session_id}/{name}" for name in names])
+    artifact_serving.make_thumbnails(entries, outputs_catalog.root)
+
+def resolve_output_links(content: str, workspace: SessionWorkspace) -> str:
+    """
+    把报告中的 /output/<文件名> 链接改写为本会话的 /output/<session_id>/<文件名>
+    """
+    def replace(match):
+        name = match.group(2)
+        if outputs_catalog.get(f"{workspace.session_id}/{name}") is not None:
+            return f"{match.group(1)}{workspace.session_id}/{name}"
+        return match.group(0)
+    return re.sub(r"(/output/)([^/\s\)\]\"'<>]+)", replace, content)
+
+async def session_gc_loop():
+    """
+    定期回收过期的会话执行目录和产物目录
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, collect_garbage, "output", set(active_sessions))
+            # 回收的产物目录从目录中移除；uploads/ 很小，顺便全量核对一次外部修改
+            await loop.run_in_executor(None, outputs_catalog.prune_missing_dirs)
+            await loop.run_in_executor(None, uploads_catalog.scan)
+        except Exception as e:
+            logger.warning(f"Session GC failed: {e}")
+        await asyncio.sleep(SESSION_GC_INTERVAL)
+
+async def kernel_idle_loop():
+    """
+    定期回收空闲超时的内核；不依赖新的执行请求触发，空闲的服务也能释放内存
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(KERNEL_EVICT_INTERVAL)
+        try:
+            await loop.run_in_executor(None, kernel_pool.evict_idle)
+        except Exception as e:
+            logger.warning(f"Kernel eviction failed: {e}")
+
+# 启动状态，由 /healthz 导出
+startup_state: Dict[str, Any] = {"ready": False, "startup_ms": None}
+
+async def warm_up_in_background():
+    """
+    就绪之后再做的预热：LLM 客户端（openai SDK 导入和 TLS 上下文）、内核进程、文件哈希，不占用启动时间
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        # 客户端在线程池中创建，之后的模型列表刷新不会在事件循环中导入 openai
+        await loop.run_in_executor(None, llm_router.warm_up)
+        asyncio.create_task(model_list.run())
+        # 预热内核，让第一个会话也不用等待冷启动；内核会导入 pandas 等库，与启动阶段争抢 CPU，放到就绪之后
+        await loop.run_in_executor(None, kernel_pool.prewarm)
+        await loop.run_in_executor(None, uploads_catalog.fill_hashes)
+        await loop.run_in_executor(None, outputs_catalog.fill_hashes)
+    except Exception as e:
+        logger.warning(f"Background warm-up failed: {e}")
+
+def check_startup_budget() -> float:
+    """
+    记录启动耗时；超出预算或服务进程中加载了重型库时告警
+    """
+    elapsed = time.perf_counter() - STARTUP_STARTED
+    metrics.observe("startup", elapsed)
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+    if heavy:
+        logger.warning(f"Heavy modules loaded in the server process: {', '.join(heavy)}")
+    if elapsed > STARTUP_BUDGET:
+        logger.warning(f"Startup took {elapsed * 1000:.0f} ms, over the {STARTUP_BUDGET * 1000:.0f} ms budget")
+    else:
+        logger.info(f"Ready in {elapsed * 1000:.0f} ms")
+    return elapsed
+
+async def startup():
+    """
+    启动阶段只做必须的轻量工作，内核预热、模型列表和文件哈希在就绪之后于后台进行
+    """
+    loop = asyncio.get_event_loop()
+    # 只 stat 不读文件，哈希稍后补齐
+    await loop.run_in_executor(None, uploads_catalog.scan, False)
+    await loop.run_in_executor(None, outputs_catalog.scan, False)
+    if session_store is not None:
+        await session_store.open()
+    asyncio.create_task(session_gc_loop())
+    asyncio.create_task(kernel_idle_loop())
+    asyncio.create_task(warm_up_in_background())
+    startup_state["startup_ms"] = round(check_startup_budget() * 1000, 1)
+    startup_state["ready"] = True
+
+@app.get("/healthz")
+async def healthz():
+    """
+    就绪检查：启动完成后返回 200，否则 503；附带内核、调度和模型列表状态
+    """
+    body = {
+        "status": "ok" if startup_state["ready"] else "starting",
+        **startup_state,
+        "kernels": kernel_pool.stats(),
+        "executions": {"running": exec_scheduler.running, "queued": exec_scheduler.queue_depth()},
+        "model_list": model_list.stats(),
+        "exec_cache": exec_cache.stats() if exec_cache is not None else None,
+    }
+    return JSONResponse(body, status_code=200 if startup_state["ready"] else 503)
+
+async def shutdown():
+    """
+    关闭内核进程、调度器、报告队列和各个存储
+    """
+    exec_scheduler.shutdown()
+    kernel_pool.shutdown()
+    report_queue.shutdown()
+    if llm_cache is not None:
+        llm_cache.close()
+    if exec_cache is not None:
+        exec_cache.close()
+    if session_store is not None:
+        await session_store.close()
+    await llm_router.aclose()
 
 @app.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
@@ -188,45 +691,126 @@ async def websocket_endpoint(websocket: WebSocket):
     WebSocket 聊天接口，实现 Agent 自主循环
     """
     await websocket.accept()
+    # 合并发送 token / 输出帧，客户端跟不上时做背压和输出精简
+    sender = BufferedSender(websocket)
+    
+    # 每个连接对应一个会话，会话内的代码在同一个常驻内核中执行
+    # 带 session_id 重新连接时从持久化的快照恢复上下文，内核未被回收时变量也仍然可用
+    restore_started = time.perf_counter()
+    saved = await claim_session(websocket.query_params.get("session_id", ""), websocket)
+    session_id = websocket.query_params["session_id"] if saved else new_session_id()
     
-    # 初始化工作区跟踪器
-    workspace_dir = "uploads"  # 或者使用单独的 workspace 目录，这里复用 uploads 以便读取文件
-    # 实际上代码执行目录应该是 uploads，generated 是 output
-    tracker = WorkspaceTracker("uploads", "output")
+    # 会话独立的执行目录（上传文件以硬链接的方式出现在其中）和产物目录 output/<session_id>/
+    workspace = SessionWorkspace(session_id, "uploads", "output")
+    released = asyncio.Event()
+    active_sessions[session_id] = {"websocket": websocket, "released": released}
+    tracker = WorkspaceTracker(workspace.work_dir, workspace.output_dir)
+    workspace.sync_uploads(uploads_catalog.version)
+    # 恢复的会话中已有的视图也要登记（sync_uploads 只返回本次新建的路径）
+    tracker.ignore([os.path.join(workspace.work_dir, name) for name in workspace.linked])
+    report_tasks: set = set()
+    # 代码执行期间收到的消息（前端忙碌时不发送，保险起见留给下一轮）和连接是否已断开
+    early_messages: List[str] = []
+    connection = {"closed": False}
+
+    async def watch_disconnect():
+        """
+        代码执行期间监听连接：客户端断开（例如点击停止）时立即中止本会话的执行，
+        静默的长时间计算不会一直占着执行槽位直到超时
+        """
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                connection["closed"] = True
+                kernel_pool.cancel(session_id)
+                return
+            if message.get("text") is not None:
+                early_messages.append(message["text"])
+
+    async def finish_step(spans: StepSpans):
+        """发送本步的 step_metrics，并保存会话快照"""
+        step_metrics = spans.finish()
+        await sender.send_json(step_metrics)
+        if session_store is not None:
+            session_store.save(session_id, context, spans.model)
+            session_store.add_step(session_id, step_metrics)
+
+    def execute_with_catch_up(cache_state, pending: List[str], code: str, catch_up: Dict[str, bool]) -> Iterator[str]:
+        """
+        先静默补执行之前命中缓存而跳过的代码（恢复内核中的变量），再执行本步代码（在线程池中运行）
+        """
+        for previous in pending:
+            for _ in kernel_pool.execute_stream(session_id, previous, workspace.work_dir, EXEC_TIMEOUT):
+                pass
+            if not kernel_pool.pop_usage(session_id):
+                # 补执行超时或崩溃，内核已重启，历史链从头开始；与超时 / 崩溃一样告知用户和模型
+                cache_state.reset()
+                catch_up["failed"] = True
+                yield (
+                    "[Kernel restarted while re-running steps replayed from the execution cache; "
+                    "variables from earlier steps were reset]\n"
+                )
+                break
+        if pending:
+            # 补执行重新生成的产物之前已经从缓存放回，直接丢弃
+            for name in tracker.diff_and_collect():
+                try:
+                    os.remove(os.path.join(workspace.output_dir, name))
+                except OSError:
+                    pass
+        yield from kernel_pool.execute_stream(session_id, code, workspace.work_dir, EXEC_TIMEOUT)
     
     try:
-        # 获取当前文件列表 (for initial context)
-        current_files = []
-        if os.path.exists("uploads"):
-             current_files = [f for f in os.listdir("uploads") if os.path.isfile(os.path.join("uploads", f))]
-        
-        file_context_str = "\n当前系统已上传的文件列表 (位于当前目录):\n" + "\n".join([f"- {f}" for f in current_files]) if current_files else "\n当前暂无已上传文件。"
-        
-        # 初始化对话历史
-        # 注意：这里不再把 file_context_str 放到 system prompt，而是作为 system prompt 的补充，或者 user message 的一部分
-        # 为了简单，我们还是放在 system prompt，或者追加到 system prompt
-        messages = [{"role": "system", "content": SYSTEM_PROMPT + file_context_str}]
+        # 对话上下文：完整记录保存在 transcript 中，发送给 LLM 的历史按 token 预算压缩
+        # system prompt 保持字节稳定，文件列表随用户消息的 # Data 发送，便于上游复用前缀缓存
+        if saved:
+            context = ConversationContext.from_state(
+                SYSTEM_PROMPT, saved["context"], saved["transcript"], token_budget=CONTEXT_TOKEN_BUDGET
+            )
+            kernel_alive = kernel_pool.has_kernel(session_id)
+            if not kernel_alive:
+                context.add_system("[System Update] 会话已恢复，但代码执行环境已重启，之前定义的变量需要重新计算。")
+        else:
+            context = ConversationContext(SYSTEM_PROMPT, token_budget=CONTEXT_TOKEN_BUDGET)
+            kernel_alive = False
+        await sender.send_json({
+            "type": "session",
+            "session_id": session_id,
+            "resumed": bool(saved),
+            "kernel_alive": kernel_alive,
+            "messages": len(context.transcript),
+            "restore_ms": round((time.perf_counter() - restore_started) * 1000, 1),
+        })
         
         while True:
             # 接收用户消息
-            data = await websocket.receive_text()
+            if connection["closed"]:
+                raise WebSocketDisconnect()
+            data = early_messages.pop(0) if early_messages else await websocket.receive_text()
             user_input = json.loads(data)
             user_message = user_input.get("message", "")
-            selected_model = user_input.get("model", "deepseek-ai/DeepSeek-V3.1-Terminus")
+            selected_model = user_input.get("model", DEFAULT_MODELS[0])
             max_steps = int(user_input.get("max_steps", 30))
+            # 服务端开启执行缓存时，单条消息可以用 "exec_cache": false 强制重新执行
+            use_exec_cache = exec_cache is not None and bool(user_input.get("exec_cache", True))
             
             # 添加用户消息到历史
             # 每次用户发消息，我们都重新扫描一下文件列表，确保最新
             # 也可以把文件列表附在用户消息后面，类似 DeepAnalyze 的 # Data
-            current_files = []
-            if os.path.exists("uploads"):
-                 current_files = [f for f in os.listdir("uploads") if os.path.isfile(os.path.join("uploads", f))]
+            workspace.touch()
+            current_files = uploads_catalog.names()
             
-            file_context_update = "\n\n# Data (Current Files):\n(注意：读取文件时请直接使用文件名，不要加 uploads/ 前缀)\n" + "\n".join([f"- {f}" for f in current_files])
+            # 附上每个文件的数据画像（schema、缺失率、数值摘要、样例），减少探索性步骤
+            loop = asyncio.get_event_loop()
+            profile_entries = await loop.run_in_executor(None, collect_data_profiles, current_files)
+            data_profiles = dataset_profile.render_profiles(profile_entries, PROFILE_TOKEN_BUDGET, count_tokens)
+            file_context_update = "\n\n# Data (Current Files):\n(注意：读取文件时请直接使用文件名，不要加 uploads/ 前缀；以下数据画像已预先计算，无需再执行 head()/info()/describe() 探索)\n" + data_profiles
             
             full_user_message = f"# Instruction\n{user_message}{file_context_update}"
             
-            messages.append({"role": "user", "content": full_user_message})
+            context.add_user(full_user_message)
+            if session_store is not None:
+                session_store.save(session_id, context, selected_model, title=user_message[:80])
             
             # Agent 自主循环 (ReAct Loop)
             step_count = 0
@@ -235,42 +819,47 @@ async def websocket_endpoint(websocket: WebSocket):
                 step_count += 1
                 
                 # Notify frontend of step progress
-                await websocket.send_json({"type": "step_update", "current": step_count, "max": max_steps})
+                await sender.send_json({"type": "step_update", "current": step_count, "max": max_steps})
+                # 本步各阶段计时，结束时发送 step_metrics 并写入 Prometheus
+                spans = StepSpans(step_count, selected_model)
+                context_started = time.perf_counter()
                 
-                # ---------------- NEW: Refresh Output Files Context ----------------
-                # 在每一步调用 AI 前，先扫描 output 目录，告诉 AI 已经生成了哪些图表
+                # ---------------- Refresh Output Files Context ----------------
+                # 在每一步调用 AI 前，先从产物目录索引中取出本会话的文件，告诉 AI 已经生成了哪些图表
                 # 这样 AI 就知道它已经画了什么，可以在报告中引用
-                current_outputs = []
-                if os.path.exists("output"):
-                     current_outputs = [f for f in os.listdir("output") if os.path.isfile(os.path.join("output", f)) and not f.startswith("report_")]
+                # 该状态每一步都会变化，只作为请求末尾的增量消息发送，不写入历史
+                current_outputs = outputs_catalog.names(f"{session_id}/", exclude_prefix="report_")
                 
                 output_context = ""
                 if current_outputs:
-                    output_context = "\n\n[System Update] 目前已生成的产物文件 (位于 output/ 目录):\n" + "\n".join([f"- {f}" for f in current_outputs])
-                    # 将这个上下文临时追加到最后一条消息，或者作为一条新的 system 消息（但 OpenAI 不建议频繁插 system）
-                    # 这里我们选择追加到最后一条 user 消息（如果是 user）或者 assistant 消息后面（稍微 hacky）
-                    # 最稳妥的方式是追加到 messages 列表里作为一条临时 system 消息，但在发送后移除？
-                    # 或者直接 append 到 messages，反正 history 越来越长也没关系，这正是 context。
-                    messages.append({"role": "system", "content": output_context})
+                    output_context = "[System Update] 目前已生成的产物文件 (位于 output/ 目录):\n" + "\n".join([f"- {f}" for f in current_outputs])
                 # -------------------------------------------------------------------
                 
                 # If we are nearing the limit, prompt the agent to wrap up
                 if step_count == max_steps - 2:
-                    messages.append({"role": "user", "content": "Please finish your analysis and generate the final report now using <Answer> tag."})
+                    context.add_user("Please finish your analysis and generate the final report now using <Answer> tag.")
+
+                messages = context.build(volatile=output_context)
+                spans.record("context_build", time.perf_counter() - context_started)
+                await sender.send_json({"type": "context_stats", "step": step_count, **context.stats()})
 
-                logger.info(f"Step {step_count}: Sending request to LLM...")
+                logger.info(f"Step {step_count}: Sending request to LLM ({context.stats()['prompt_tokens']} prompt tokens)...")
                 # 调用 LLM
+                request_started = time.perf_counter()
                 try:
-                    response = await client.chat.completions.create(
+                    extra_args = {"stream_options": {"include_usage": True}} if LLM_STREAM_USAGE else {}
+                    response = await llm_completions.create(
+                        fixture=session_id,
                         model=selected_model,
                         messages=messages,
                         temperature=0.1,
                         max_tokens=MAX_TOKENS,
-                        stream=True
+                        stream=True,
+                        **extra_args
                     )
                 except Exception as e:
                     logger.error(f"LLM request failed: {e}")
-                    await websocket.send_json({"type": "error", "content": f"LLM request failed: {str(e)}"})
+                    await sender.send_json({"type": "error", "content": f"LLM request failed: {str(e)}"})
                     break
 
                 logger.info(f"Step {step_count}: Received LLM response stream")
@@ -284,115 +873,266 @@ async def websocket_endpoint(websocket: WebSocket):
                 # Let's keep sending stream_start ONCE at the beginning of the turn?
                 # Actually, the previous loop logic sent stream_start for every chunk? No.
                 
-                await websocket.send_json({"type": "stream_start"})
+                await sender.send_json({"type": "stream_start"})
                 
+                ttft = None
+                cached_tokens = None
+                usage_tokens = None
+                early_dispatch = False
+                # 增量解析标签：<Code> 闭合后立即停止生成并开始执行
+                parser = TagStreamParser()
                 async for chunk in response:
-                    if chunk.choices[0].delta.content:
+                    # 开启 include_usage 时最后一个 chunk 只有 usage，没有 choices
+                    usage = getattr(chunk, "usage", None)
+                    if usage is not None:
+                        usage_tokens = (getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None))
+                        details = getattr(usage, "prompt_tokens_details", None)
+                        cached_tokens = getattr(details, "cached_tokens", None) if details else None
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if ttft is None:
+                            ttft = time.perf_counter() - request_started
                         content = chunk.choices[0].delta.content
+                        closed = parser.feed(content)
+                        if any(tag == "Code" for tag, _ in closed) and "Answer" not in parser.seen_tags:
+                            # 丢弃 </Code> 之后的内容，并取消上游剩余的生成
+                            content = content[:len(content) - (len(parser.buffer) - parser.closed_end)]
+                            early_dispatch = True
                         full_content += content
-                        await websocket.send_json({"type": "stream_token", "content": content})
+                        await sender.send_token(content)
+                        if early_dispatch:
+                            break
                 
-                await websocket.send_json({"type": "stream_end"})
-                messages.append({"role": "assistant", "content": full_content})
+                if early_dispatch:
+                    try:
+                        await response.close()
+                    except Exception as e:
+                        logger.warning(f"Failed to cancel upstream generation: {e}")
+                
+                # 记录首 token 延迟，用于验证前缀缓存是否命中
+                llm_timing = {
+                    "type": "llm_timing",
+                    "step": step_count,
+                    "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+                    "total_ms": round((time.perf_counter() - request_started) * 1000, 1),
+                    "prefix_reused_messages": context.stats().get("prefix_reused_messages"),
+                    "prefix_reused_tokens": context.stats().get("prefix_reused_tokens"),
+                    "cached_tokens": cached_tokens,
+                    "early_dispatch": early_dispatch,
+                    "cache_hit": getattr(response, "cache_hit", False),
+                    "backend": getattr(response, "backend", None),
+                    "model": getattr(response, "model", selected_model),
+                    "hedged": getattr(response, "hedged", False),
+                    "attempts": getattr(response, "attempts", 1),
+                }
+                logger.info(f"Step {step_count}: TTFT {llm_timing['ttft_ms']} ms, prefix reused {llm_timing['prefix_reused_tokens']} tokens, upstream cached {cached_tokens}, response cache hit {llm_timing['cache_hit']}")
+                await sender.send_json(llm_timing)
+                await sender.send_json({"type": "stream_end"})
+                context.add_assistant(full_content)
+                spans.record("llm_ttft", ttft)
+                spans.record("llm_stream", time.perf_counter() - request_started)
+                # 上游返回 usage 时使用真实值，否则使用本地估算
+                tokens_in, tokens_out = usage_tokens or (None, None)
+                spans.set_tokens(
+                    tokens_in or context.stats().get("prompt_tokens"),
+                    tokens_out or context.history[-1]["tokens"],
+                )
                 
                 # 解析 Agent 意图
                 tag_type = None
                 content_body = ""
                 
                 # Check for Answer first, as it might be the last step
-                if "<Answer>" in full_content:
+                if "Answer" in parser.seen_tags:
                      tag_type = "report"
-                elif "<Code>" in full_content and "</Code>" in full_content:
+                elif parser.first_block("Code") is not None:
                      tag_type = "code"
-                     try:
-                        start = full_content.find("<Code>") + 6
-                        # Handle potential language attribute (though prompt says <Code>)
-                        if 'language="python"' in full_content:
-                             # ... (This case might be deprecated if we strictly use <Code>)
-                             pass
-                        end = full_content.find("</Code>")
-                        content_body = full_content[start:end].strip()
-                     except:
-                        content_body = ""
+                     content_body = parser.first_block("Code")
                 
                 if tag_type == "code" and content_body:
                     # ... (existing code execution logic)
-                    await websocket.send_json({"type": "step", "step_type": "executing"})
+                    await sender.send_json({"type": "step", "step_type": "executing"})
                     
                     # 使用新的 execute_code_stream 实时流式传输执行结果
                     # 注意：uploads 目录作为 workspace，这样代码可以直接读取 uploads 里的文件
                     
                     # 1. 发送 <Execute> 标签开始
-                    await websocket.send_json({"type": "stream_start"})
-                    await websocket.send_json({"type": "stream_token", "content": "\n<Execute>\n```\n"})
+                    await sender.send_json({"type": "stream_start"})
+                    await sender.send_token("\n<Execute>\n```\n")
+                    
+                    # 执行前同步新上传的文件到会话目录
+                    loop = asyncio.get_event_loop()
+                    # 由上传文件目录的版本号驱动：上传 / 删除 / 定期扫描发现变化后才重新同步
+                    tracker.ignore(await loop.run_in_executor(None, workspace.sync_uploads, uploads_catalog.version))
+                    workspace.touch()
                     
-                    full_execution_output = ""
+                    # 有界捕获：前端和 LLM 各自只保留首尾，超长时完整日志写入会话产物目录
+                    capture = OutputCapture(workspace.output_dir, **EXEC_OUTPUT_LIMITS)
+                    
+                    # 开启执行缓存时先查找：历史链、代码和读取过的数据都一致则直接回放
+                    # （本条消息关闭缓存时仍然记录历史链，之前跳过的代码也照常补执行）
+                    cache_state = None
+                    cache_entry = None
+                    if exec_cache is not None:
+                        cache_state = exec_cache.session(session_id, kernel_pool.kernel_id(session_id))
+                        if use_exec_cache:
+                            cache_entry = await loop.run_in_executor(
+                                None, exec_cache.lookup, cache_state, content_body, workspace.work_dir
+                            )
                     
                     # 2. 实时流式传输 stdout/stderr
                     # 优化：不要每行都发 stream_start/end，只发 token
-                    for line in execute_code_stream(content_body, "uploads"):
-                        full_execution_output += line
-                        await websocket.send_json({"type": "stream_token", "content": line})
+                    # 执行在线程池中进行并由全局调度器排队，不阻塞其他会话
+                    exec_wait = {"ms": 0.0}
+
+                    async def exec_notify(frame: Dict[str, Any]):
+                        if frame.get("type") == "exec_start":
+                            exec_wait["ms"] = frame.get("wait_ms") or 0.0
+                        await sender.send_json(frame)
+
+                    exec_started = time.perf_counter()
+                    if cache_entry is not None:
+                        exec_cache.replayed(cache_state, content_body, cache_entry)
+                        await sender.send_json({
+                            "type": "exec_cache",
+                            "step": step_count,
+                            "hit": True,
+                            "saved_ms": cache_entry["elapsed_ms"],
+                            "age_s": cache_entry["age_s"],
+                        })
+                        for line in [HIT_NOTICE] + cache_entry["output"]:
+                            visible = capture.feed(line)
+                            if visible:
+                                await sender.send_token(visible, droppable=True)
+                        output_tail = capture.finish()
+                        exec_lines = None
+                    else:
+                        pending = []
+                        before = {}
+                        # 缓存最多保存 max_output_bytes 的输出，超出后不再记录
+                        exec_lines = None
+                        recorded_bytes = 0
+                        catch_up = {"failed": False}
+                        if cache_state is not None:
+                            pending = exec_cache.take_pending(cache_state)
+                            before = tracker.input_state()
+                            exec_lines = []
+                        exec_stream = exec_scheduler.run_stream(
+                            session_id,
+                            execute_with_catch_up,
+                            cache_state, pending, content_body, catch_up,
+                            notify=exec_notify,
+                            interrupt=lambda: kernel_pool.cancel(session_id),
+                        )
+                        watcher = asyncio.create_task(watch_disconnect())
+                        try:
+                            async for line in exec_stream:
+                                if exec_lines is not None:
+                                    recorded_bytes += len(line)
+                                    if recorded_bytes > exec_cache.max_output_bytes:
+                                        exec_lines = None
+                                    else:
+                                        exec_lines.append(line)
+                                visible = capture.feed(line)
+                                if visible:
+                                    await sender.send_token(visible, droppable=True)
+                        finally:
+                            watcher.cancel()
+                            await exec_stream.aclose()
+                            output_tail = capture.finish()
+                        if connection["closed"]:
+                            raise WebSocketDisconnect()
+                    if output_tail:
+                        await sender.send_token(output_tail, droppable=True)
+                    full_execution_output = capture.llm_text()
+                    sandbox_ms = round((time.perf_counter() - exec_started) * 1000, 1)
+                    exec_usage = kernel_pool.pop_usage(session_id) if cache_entry is None else {}
+                    spans.step_type = "code"
+                    if cache_entry is not None:
+                        spans.record("exec_cache_replay", sandbox_ms / 1000)
+                    else:
+                        spans.record("exec_queue", exec_wait["ms"] / 1000)
+                        spans.record("exec_run", max(0.0, sandbox_ms - exec_wait["ms"]) / 1000)
                     
                     # 3. 发送 <Execute> 标签结束
-                    await websocket.send_json({"type": "stream_token", "content": "\n```\n</Execute>\n"})
-                    await websocket.send_json({"type": "stream_end"})
+                    await sender.send_token("\n```\n</Execute>\n")
+                    await sender.send_json({"type": "stream_end"})
                     
                     # 4. 收集生成的文件并发送 <Files> 标签
-                    new_artifacts = tracker.diff_and_collect()
+                    loop = asyncio.get_event_loop()
+                    collect_started = time.perf_counter()
+                    if cache_entry is not None:
+                        new_artifacts = await loop.run_in_executor(
+                            None, exec_cache.restore_artifacts, cache_entry, workspace.output_dir
+                        )
+                    else:
+                        new_artifacts = await loop.run_in_executor(None, tracker.diff_and_collect)
+                        for phase, seconds in tracker.last_timings.items():
+                            spans.record(phase, seconds)
+                        if cache_state is not None:
+                            await loop.run_in_executor(
+                                None, exec_cache.record,
+                                cache_state, content_body, exec_usage, kernel_pool.kernel_id(session_id),
+                                # 补执行失败的提示不应被回放，这一步不缓存
+                                workspace.work_dir, before, None if catch_up["failed"] else exec_lines,
+                                [os.path.join(workspace.output_dir, f) for f in new_artifacts],
+                                max(0.0, sandbox_ms - exec_wait["ms"]),
+                            )
+                    await sender.send_json({
+                        "type": "exec_timing",
+                        "step": step_count,
+                        "cache_hit": cache_entry is not None,
+                        "sandbox_ms": sandbox_ms,
+                        "collect_ms": round((time.perf_counter() - collect_started) * 1000, 1),
+                        "artifacts": len(new_artifacts),
+                        "cpu_s": exec_usage.get("cpu_s"),
+                        "peak_rss_mb": exec_usage.get("peak_rss_mb"),
+                    })
+                    if capture.spill_name:
+                        new_artifacts.append(capture.spill_name)
+                    if new_artifacts:
+                        await loop.run_in_executor(None, register_artifacts, session_id, new_artifacts)
+                    if session_store is not None and new_artifacts:
+                        session_store.add_artifacts(session_id, new_artifacts)
                     files_xml = ""
+                    history_files_xml = ""
                     if new_artifacts:
-                        files_xml = "\n<Files>\n" + "\n".join([f"output/{f}" for f in new_artifacts]) + "\n</Files>\n"
-                        await websocket.send_json({"type": "stream_start"})
-                        await websocket.send_json({"type": "stream_token", "content": files_xml})
-                        await websocket.send_json({"type": "stream_end"})
+                        # 历史中只记录文件名（与会话无关），请求内容可跨会话复用缓存；报告生成时再解析到会话目录
+                        history_files_xml = "\n<Files>\n" + "\n".join([f"output/{f}" for f in new_artifacts]) + "\n</Files>\n"
+                        files_xml = "\n<Files>\n" + "\n".join([workspace.output_url_path(f) for f in new_artifacts]) + "\n</Files>\n"
+                        await sender.send_json({"type": "stream_start"})
+                        await sender.send_token(files_xml)
+                        await sender.send_json({"type": "stream_end"})
                         
                         # --- NEW: Notify frontend to refresh outputs list immediately ---
-                        await websocket.send_json({"type": "files_updated"})
+                        await sender.send_json({"type": "files_updated"})
                         # ----------------------------------------------------------------
                     
                     # 构建完整的步骤内容用于历史记录
-                    full_step_content = f"\n<Execute>\n```\n{full_execution_output}\n```\n</Execute>\n{files_xml}"
-                    
-                    messages.append({"role": "assistant", "content": full_step_content})
+                    full_step_content = f"\n<Execute>\n```\n{full_execution_output}\n```\n</Execute>\n{history_files_xml}"
                     
-                    # 仅把 execute 部分作为用户反馈（模拟环境输出）
-                    # files 部分其实是 system 告知产生的文件，也可以包含
-                    messages.append({
-                        "role": "user", 
-                        "content": full_step_content
-                    })
+                    # 执行结果只作为一条环境反馈加入历史，避免 assistant/user 重复
+                    context.add_execution(full_step_content)
+                    await finish_step(spans)
                 
                 elif tag_type == "report":
                     # 任务完成，保存报告
                     # 即使没有闭合标签，只要有 <Answer> 也尝试提取
-                    start = full_content.find("<Answer>") + 8
-                    end = full_content.find("</Answer>")
+                    report_content = parser.body("Answer")
+                    spans.step_type = "report"
+                    report_started = time.perf_counter()
                     
-                    if start >= 8:
+                    if report_content is not None:
                         try:
-                            if end != -1:
-                                report_content = full_content[start:end].strip()
-                            else:
-                                report_content = full_content[start:].strip() # 提取到最后
-                            
                             # ----------------------------
                             # Code Injection Logic
                             # ----------------------------
                             # 1. 收集所有代码片段
                             all_code_snippets = []
-                            for msg in messages:
+                            for msg in context.transcript:
                                 if msg.get("role") == "assistant":
-                                    content = msg.get("content", "")
-                                    if "<Code>" in content and "</Code>" in content:
-                                        try:
-                                            c_start = content.find("<Code>") + 6
-                                            c_end = content.find("</Code>")
-                                            code_snippet = content[c_start:c_end].strip()
-                                            if code_snippet:
-                                                all_code_snippets.append(code_snippet)
-                                        except:
-                                            pass
+                                    all_code_snippets.extend(
+                                        snippet for snippet in extract_blocks(msg.get("content", ""), "Code") if snippet
+                                    )
                             
                             # 2. 去重：保留顺序
                             unique_code_snippets = list(dict.fromkeys(all_code_snippets))
@@ -407,48 +1147,43 @@ async def websocket_endpoint(websocket: WebSocket):
                                     report_content += "\n\n## 附录：分析代码\n\n```python\n" + full_code + "\n```\n"
                             # ----------------------------
 
-                            import time
-                            timestamp = int(time.time())
-                            report_filename = f"report_{timestamp}.md"
-                            report_path = os.path.join("output", report_filename)
+                            # 报告中引用的是文件名，指向本会话的产物目录
+                            report_content = resolve_output_links(report_content, workspace)
+
+                            report_name = unique_name("report")
+                            report_filename = f"{report_name}.md"
+                            report_path = os.path.join(workspace.output_dir, report_filename)
                             
                             with open(report_path, "w", encoding="utf-8") as f:
                                 f.write(report_content)
+                            outputs_catalog.upsert(f"{session_id}/{report_filename}")
                                 
-                            # 生成 PDF (防止死锁：替换本地图片路径，并在线程池中运行)
-                            pdf_filename = f"report_{timestamp}.pdf"
-                            pdf_path = os.path.join("output", pdf_filename)
-                            
-                            # 替换图片 URL 为本地绝对路径，避免 xhtml2pdf 发起 HTTP 请求导致死锁
-                            # 假设 URL 格式为 http://localhost:8080/output/filename.png
-                            # 或者 http://127.0.0.1:8080/output/filename.png
-                            abs_output_dir = os.path.abspath("output").replace("\\", "/")
-                            
-                            # 简单的字符串替换
-                            pdf_report_content = report_content.replace(f"http://localhost:{BACKEND_PORT}/output/", f"file:///{abs_output_dir}/")
-                            pdf_report_content = pdf_report_content.replace(f"http://127.0.0.1:{BACKEND_PORT}/output/", f"file:///{abs_output_dir}/")
-                            
-                            # 在线程池中运行同步的 convert_md_to_pdf，避免阻塞 Event Loop
-                            loop = asyncio.get_event_loop()
-                            success = await loop.run_in_executor(None, convert_md_to_pdf, pdf_report_content, pdf_path)
-                            
-                            if success:
-                                logger.info(f"Generated PDF report: {pdf_path}")
-                            else:
-                                logger.error("Failed to generate PDF report")
+                            # 生成 PDF：提交到后台渲染队列，图片由渲染器直接读取本地文件
+                            pdf_path = os.path.join(workspace.output_dir, f"{report_name}.pdf")
+                            job = report_queue.submit(
+                                report_content, pdf_path, LocalAssets("output", workspace.output_dir), session_id
+                            )
+                            # 渲染线程结束时登记 PDF（连接已断开也要登记）
+                            job.future.add_done_callback(
+                                lambda _, name=f"{session_id}/{report_name}.pdf": outputs_catalog.upsert(name)
+                            )
+                            await sender.send_json({"type": "report_job", **job.to_dict()})
+                            task = asyncio.create_task(notify_report_job(job, sender))
+                            report_tasks.add(task)
+                            task.add_done_callback(report_tasks.discard)
+                            if session_store is not None:
+                                session_store.add_artifacts(session_id, [report_filename, f"{report_name}.pdf"])
 
                             # 通知前端有新文件
-                            await websocket.send_json({"type": "files_updated"})
+                            await sender.send_json({"type": "files_updated"})
                         except Exception as e:
                             logger.error(f"Failed to save report: {e}")
                             traceback.print_exc()
 
-                    # 任务完成，跳出所有循环
-                    await websocket.send_json({"type": "done"})
-                    return # 退出 websocket_endpoint 函数中的 while True 循环 (实际上是 return out of the function, which closes the socket)
-                    # 或者 break 到外层循环?
-                    # 如果 break 到外层，外层是 while True (等待用户输入)。
-                    # 但如果是 report，通常意味着一次任务结束。用户可以继续发消息，所以应该是 break 内层循环。
+                    spans.record("report_write", time.perf_counter() - report_started)
+                    await finish_step(spans)
+                    # 任务完成，跳出内层循环并发送 done；连接保持打开，
+                    # 用户可以继续发消息，报告渲染状态也通过该连接推送
                     break 
                 
                 else:
@@ -464,17 +1199,30 @@ async def websocket_endpoint(websocket: WebSocket):
                          # 它通常会紧接着输出 <Code> 或者 <Answer>。
                          # 如果它停了，我们必须 nudge 它。
                          # 使用一个空内容的 user message 或者 "Continue"
-                         messages.append({"role": "user", "content": "Continue"})
+                         context.add_user("Continue")
+                    await finish_step(spans)
             
             # 如果 max_steps 到了还没 break (report)，也会走到这里
             # 发送 done 信号，告诉前端这一轮 turn 结束了
-            await websocket.send_json({"type": "done"})
+            await sender.send_json({"type": "done"})
 
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected")
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
+        await sender.close()
         await websocket.close()
+    finally:
+        # 渲染任务本身继续在后台执行，只停止向已断开的连接推送状态
+        for task in report_tasks:
+            task.cancel()
+        tracker.close()
+        if session_store is not None:
+            session_store.forget(session_id)
+        if active_sessions.get(session_id, {}).get("websocket") is websocket:
+            del active_sessions[session_id]
+        released.set()
+        await sender.close()
 
 if __name__ == "__main__":
     import uvicorn
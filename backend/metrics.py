@@ -0,0 +1,103 @@
+"""
+热路径计时与 Prometheus 指标
+
+- StepSpans 记录 Agent 每一步各阶段的耗时（上下文组装、LLM 首 token / 流式总时长、沙箱排队 / 执行、
+  产物收集、文件移动等）和 token 数，每一步结束时作为 step_metrics 帧发送给前端
+- 同时写入按模型标记的 Prometheus 直方图，由 /metrics 导出；model 标签只取已知模型（默认模型、
+  备用模型和上游模型列表），客户端传入的其他名字一律记为 "other"，避免产生无上限的时间序列
+- 未安装 prometheus_client 时只保留每步的计时帧
+"""
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+except ImportError:
+    CONTENT_TYPE_LATEST = "text/plain; charset=utf-8"
+    Counter = Histogram = generate_latest = None
+
+# 覆盖毫秒级（上下文组装、文件收集）到分钟级（长时间运行的代码、报告渲染）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+PHASE_SECONDS = None
+LLM_TOKENS = None
+STEPS = None
+if Histogram is not None:
+    PHASE_SECONDS = Histogram(
+        "datasight_phase_seconds", "Agent 每一步各阶段耗时", ["phase", "model"], buckets=BUCKETS
+    )
+    LLM_TOKENS = Counter("datasight_llm_tokens_total", "LLM 输入 / 输出 token 数", ["direction", "model"])
+    STEPS = Counter("datasight_steps_total", "Agent 步骤数", ["step_type", "model"])
+
+
+_known_models: Callable[[], Iterable[str]] = lambda: ()
+
+
+def set_known_models(provider: Callable[[], Iterable[str]]):
+    """设置已知模型名的来源（每次取标签时调用，上游模型列表刷新后自动生效）"""
+    global _known_models
+    _known_models = provider
+
+
+def model_label(model: Optional[str]) -> str:
+    """把模型名映射为有界的标签值：未知模型记为 other"""
+    if not model:
+        return ""
+    return model if model in set(_known_models()) else "other"
+
+
+def observe(phase: str, seconds: float, model: str = ""):
+    """记录一个不属于某一步的阶段耗时（例如后台报告渲染）"""
+    if PHASE_SECONDS is not None:
+        PHASE_SECONDS.labels(phase=phase, model=model_label(model)).observe(seconds)
+
+
+def render_latest() -> Optional[bytes]:
+    """Prometheus 文本格式的指标；prometheus_client 不可用时返回 None"""
+    if generate_latest is None:
+        return None
+    return generate_latest()
+
+
+class StepSpans:
+    """一步之内各阶段的耗时记录"""
+
+    def __init__(self, step: int, model: str):
+        self.step = step
+        self.model = model_label(model)
+        self.step_type = "other"
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.tokens_in: Optional[int] = None
+        self.tokens_out: Optional[int] = None
+
+    def record(self, phase: str, seconds: Optional[float]):
+        if seconds is None:
+            return
+        # 同一阶段在一步中出现多次时累加
+        self.spans[phase] = self.spans.get(phase, 0.0) + seconds
+
+    def set_tokens(self, tokens_in: Optional[int], tokens_out: Optional[int]):
+        self.tokens_in = tokens_in
+        self.tokens_out = tokens_out
+
+    def finish(self) -> Dict[str, Any]:
+        """写入 Prometheus 并返回发送给前端的 step_metrics 帧"""
+        total = time.perf_counter() - self.started
+        self.record("step_total", total)
+        if PHASE_SECONDS is not None:
+            for phase, seconds in self.spans.items():
+                PHASE_SECONDS.labels(phase=phase, model=self.model).observe(seconds)
+            if self.tokens_in:
+                LLM_TOKENS.labels(direction="in", model=self.model).inc(self.tokens_in)
+            if self.tokens_out:
+                LLM_TOKENS.labels(direction="out", model=self.model).inc(self.tokens_out)
+            STEPS.labels(step_type=self.step_type, model=self.model).inc()
+        return {
+            "type": "step_metrics",
+            "step": self.step,
+            "step_type": self.step_type,
+            "spans_ms": {k: round(v * 1000, 1) for k, v in self.spans.items()},
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+        }
@@ -0,0 +1,263 @@
+"""
+沙箱中的大数据量绘图辅助函数
+
+百万行数据直接交给 `sns.scatterplot` / `plt.plot` 时，matplotlib 逐点渲染会超过执行超时，生成的 PNG 也有几 MB。
+内核启动时预先注入以下函数（见 kernel_worker._preload）：
+
+    line_plot(df, x="date", y="sales", hue="region")      # 时间序列，超过 PLOT_LINE_POINTS 的序列用 LTTB 降采样
+    scatter_plot(df, x="price", y="qty")                   # 超过 PLOT_MAX_POINTS 行时改为 hexbin 密度图（有 hue 时分层采样）
+    save_chart("trend.png")                                # 统一 dpi + bbox_inches="tight"，保存后关闭 figure
+
+- 中文字体在内核启动时配置一次（setup_fonts），生成的代码不需要再设置 rcParams
+- 兜底：Axes.plot / Axes.scatter / sns.scatterplot 收到超过 PLOT_GUARD_POINTS 个点时自动降采样并打印提示，
+  覆盖直接调用 plt / seaborn / DataFrame.plot 的代码；PLOT_GUARD_POINTS=0 关闭
+
+本模块只在沙箱子进程中使用。
+"""
+import os
+import functools
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+
+# 散点图超过该行数时改为 hexbin / 采样
+PLOT_MAX_POINTS = int(os.getenv("PLOT_MAX_POINTS", "50000"))
+# 折线图每条序列保留的点数（约为图宽像素数的两倍，降采样后肉眼无差别）
+PLOT_LINE_POINTS = int(os.getenv("PLOT_LINE_POINTS", "4000"))
+# 直接调用 matplotlib 时的兜底阈值
+PLOT_GUARD_POINTS = int(os.getenv("PLOT_GUARD_POINTS", "200000"))
+PLOT_DPI = int(os.getenv("PLOT_DPI", "120"))
+PLOT_HEXBIN_GRIDSIZE = 60
+# 额外的中文字体文件（与报告 PDF 使用同一个字体时设置为同一路径）
+PLOT_FONT_PATH = os.getenv("PLOT_FONT_PATH", "")
+
+CJK_FONT_CANDIDATES = [
+    "Noto Sans CJK SC", "Noto Sans SC", "Source Han Sans SC", "Source Han Sans CN",
+    "WenQuanYi Micro Hei", "WenQuanYi Zen Hei", "SimHei", "Microsoft YaHei",
+    "PingFang SC", "Heiti TC", "Arial Unicode MS",
+]
+
+
+def setup_fonts() -> Optional[str]:
+    """把已安装的中文字体放到 sans-serif 列表最前面，返回选中的字体名（没有时返回 None）"""
+    import matplotlib
+    from matplotlib import font_manager
+
+    if PLOT_FONT_PATH and os.path.exists(PLOT_FONT_PATH):
+        try:
+            font_manager.fontManager.addfont(PLOT_FONT_PATH)
+            CJK_FONT_CANDIDATES.insert(0, font_manager.FontProperties(fname=PLOT_FONT_PATH).get_name())
+        except Exception:
+            pass
+    installed = {f.name for f in font_manager.fontManager.ttflist}
+    found = [name for name in CJK_FONT_CANDIDATES if name in installed]
+    rc = matplotlib.rcParams
+    rc["font.family"] = "sans-serif"
+    rc["font.sans-serif"] = found + [name for name in rc["font.sans-serif"] if name not in found]
+    rc["axes.unicode_minus"] = False
+    return found[0] if found else None
+
+
+def _as_float(values) -> Optional[np.ndarray]:
+    """转成可以计算面积的浮点数组；日期按纳秒整数处理，非数值返回 None"""
+    arr = np.asarray(values)
+    if np.issubdtype(arr.dtype, np.datetime64) or np.issubdtype(arr.dtype, np.timedelta64):
+        return arr.view("int64").astype(float)
+    try:
+        return arr.astype(float)
+    except (TypeError, ValueError):
+        return None
+
+
+def lttb(x, y, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets 降采样，返回保留点的下标（升序）。
+    x 需已排序；首尾两点总是保留，其余每个桶保留与相邻桶构成最大三角形的点，峰谷不会被抹平。
+    """
+    xf, yf = _as_float(x), _as_float(y)
+    n = len(yf)
+    if n_out >= n or n_out < 3 or xf is None or yf is None:
+        return np.arange(n)
+    # NaN 不参与选点（保持为负面积）
+    yf = np.where(np.isfinite(yf), yf, np.nan)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = xf[next_start:next_end].mean()
+        avg_y = np.nanmean(yf[next_start:next_end]) if np.isfinite(yf[next_start:next_end]).any() else yf[a]
+        area = np.abs((xf[a] - avg_x) * (yf[start:end] - yf[a]) - (xf[a] - xf[start:end]) * (avg_y - yf[a]))
+        a = start + int(np.argmax(np.nan_to_num(area, nan=-1.0)))
+        keep[i + 1] = a
+    return keep
+
+
+def _take(values, index: np.ndarray):
+    if hasattr(values, "iloc"):
+        return values.iloc[index]
+    return np.asarray(values)[index]
+
+
+def _sample_index(n: int, n_out: int) -> np.ndarray:
+    # 固定随机种子，同样的数据每次画出同样的图
+    return np.sort(np.random.default_rng(0).choice(n, size=n_out, replace=False))
+
+
+def line_plot(data, x: str, y: Union[str, Sequence[str]], hue: Optional[str] = None, ax=None,
+              max_points: int = PLOT_LINE_POINTS, **kwargs):
+    """
+    折线图 / 时间序列：按 x 排序，每条序列超过 max_points 个点时用 LTTB 降采样。
+    y 可以是列名列表（每列一条线），hue 按分组各画一条线。返回 Axes。
+    """
+    import matplotlib.pyplot as plt
+
+    ax = ax or plt.gca()
+    columns: List[str] = [y] if isinstance(y, str) else list(y)
+    if hue is not None:
+        series = [(str(key), group, columns[0]) for key, group in data.groupby(hue, sort=True)]
+    else:
+        series = [(column if len(columns) > 1 else None, data, column) for column in columns]
+
+    total, kept = 0, 0
+    for label, frame, column in series:
+        frame = frame[[x, column]].dropna().sort_values(x, kind="stable")
+        xs, ys = frame[x], frame[column]
+        index = lttb(xs, ys, max_points)
+        total += len(frame)
+        kept += len(index)
+        ax.plot(_take(xs, index), _take(ys, index), label=label, **kwargs)
+    if total > kept:
+        print(f"[plot] line_plot: {total:,} points decimated to {kept:,} with LTTB")
+    ax.set_xlabel(x)
+    ax.set_ylabel(columns[0] if len(columns) == 1 else "")
+    if len(series) > 1:
+        ax.legend(title=hue)
+    return ax
+
+
+def scatter_plot(data, x: str, y: str, hue: Optional[str] = None, ax=None,
+                 max_points: int = PLOT_MAX_POINTS, kind: str = "auto", **kwargs):
+    """
+    散点图：行数不超过 max_points 时等同于 sns.scatterplot；
+    超过时 kind="auto" 无 hue 画 hexbin 密度图、有 hue 按分组比例采样到 max_points 行。
+    kind 也可以显式指定为 "hexbin" / "sample"。返回 Axes。
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    ax = ax or plt.gca()
+    n = len(data)
+    if kind == "auto":
+        kind = "scatter" if n <= max_points else ("hexbin" if hue is None else "sample")
+
+    if kind == "hexbin":
+        frame = data[[x, y]].dropna()
+        hb = ax.hexbin(frame[x], frame[y], gridsize=PLOT_HEXBIN_GRIDSIZE, mincnt=1, bins="log",
+                       cmap=kwargs.pop("cmap", "viridis"), **kwargs)
+        ax.figure.colorbar(hb, ax=ax, label="count (log)")
+        ax.set_xlabel(x)
+        ax.set_ylabel(y)
+        print(f"[plot] scatter_plot: {n:,} rows drawn as a hexbin density plot")
+        return ax
+
+    if kind == "sample" and n > max_points:
+        if hue is not None:
+            data = data.groupby(hue, group_keys=False).sample(frac=max_points / n, random_state=0)
+        else:
+            data = data.iloc[_sample_index(n, max_points)]
+        kwargs.setdefault("s", 6)
+        kwargs.setdefault("alpha", 0.5)
+        kwargs.setdefault("linewidth", 0)
+        print(f"[plot] scatter_plot: {n:,} rows sampled to {len(data):,}")
+    return sns.scatterplot(data=data, x=x, y=y, hue=hue, ax=ax, **kwargs)
+
+
+def save_chart(filename: str, fig=None, dpi: int = PLOT_DPI, **kwargs) -> str:
+    """保存图表并关闭 figure（统一 dpi，裁掉多余白边），返回文件名"""
+    import matplotlib.pyplot as plt
+
+    fig = fig or plt.gcf()
+    kwargs.setdefault("bbox_inches", "tight")
+    fig.savefig(filename, dpi=dpi, **kwargs)
+    plt.close(fig)
+    return filename
+
+
+def _is_large(values) -> bool:
+    return hasattr(values, "__len__") and not isinstance(values, str) and len(values) > PLOT_GUARD_POINTS
+
+
+def install_guard():
+    """给 Axes.plot / Axes.scatter / sns.scatterplot 加上超大输入的降采样兜底"""
+    if PLOT_GUARD_POINTS <= 0:
+        return
+    from matplotlib.axes import Axes
+
+    original_plot, original_scatter = Axes.plot, Axes.scatter
+    if getattr(original_plot, "_plot_guard", False):
+        return
+
+    def plot(self, *args, **kwargs):
+        # 只处理最常见的 plot(x, y[, fmt]) 形式，其余调用原样传递
+        if (len(args) in (2, 3) and "data" not in kwargs and _is_large(args[0]) and _is_large(args[1])
+                and len(args[0]) == len(args[1]) and (len(args) == 2 or isinstance(args[2], str))
+                and np.ndim(args[0]) == 1 and np.ndim(args[1]) == 1):
+            x, y = args[0], args[1]
+            xf = _as_float(x)
+            if xf is not None and np.all(np.diff(xf) >= 0):
+                index = lttb(x, y, PLOT_LINE_POINTS)
+                method = "LTTB"
+            else:
+                index = np.linspace(0, len(x) - 1, PLOT_LINE_POINTS).astype(np.int64)
+                method = "striding"
+            print(f"[plot] plot(): {len(x):,} points decimated to {len(index):,} by {method}; "
+                  f"use line_plot() for time series")
+            args = (_take(x, index), _take(y, index)) + args[2:]
+        return original_plot(self, *args, **kwargs)
+
+    def scatter(self, x, y, *args, **kwargs):
+        if _is_large(x) and np.ndim(x) == 1 and len(x) == len(y) and "data" not in kwargs:
+            n = len(x)
+            index = _sample_index(n, PLOT_MAX_POINTS)
+            args = tuple(_take(v, index) if _is_large(v) and len(v) == n else v for v in args)
+            for key in ("s", "c", "alpha", "linewidths", "edgecolors"):
+                value = kwargs.get(key)
+                if value is not None and _is_large(value) and len(value) == n:
+                    kwargs[key] = _take(value, index)
+            print(f"[plot] scatter(): {n:,} points sampled to {len(index):,}; "
+                  f"use scatter_plot() for a hexbin density plot")
+            x, y = _take(x, index), _take(y, index)
+        return original_scatter(self, x, y, *args, **kwargs)
+
+    Axes.plot, Axes.scatter = functools.wraps(original_plot)(plot), functools.wraps(original_scatter)(scatter)
+    Axes.plot._plot_guard = True
+
+    # seaborn 在 Axes.scatter 之后再按原始行数设置颜色 / 大小，必须在它拿到数据之前采样
+    try:
+        import seaborn as sns
+    except ImportError:
+        return
+    original_scatterplot = sns.scatterplot
+
+    @functools.wraps(original_scatterplot)
+    def scatterplot(data=None, *, x=None, y=None, hue=None, size=None, style=None, **kwargs):
+        n = len(data) if hasattr(data, "iloc") else (len(x) if data is None and _is_large(x) else 0)
+        if n > PLOT_GUARD_POINTS:
+            index = _sample_index(n, PLOT_MAX_POINTS)
+            if data is not None:
+                data = data.iloc[index]
+            else:
+                x, y, hue, size, style = (
+                    _take(v, index) if _is_large(v) and len(v) == n else v for v in (x, y, hue, size, style)
+                )
+            print(f"[plot] sns.scatterplot: {n:,} rows sampled to {len(index):,}; "
+                  f"use scatter_plot() for a hexbin density plot")
+        return original_scatterplot(data=data, x=x, y=y, hue=hue, size=size, style=style, **kwargs)
+
+    sns.scatterplot = scatterplot
@@ -0,0 +1,251 @@
+"""
+报告渲染队列
+
+- Markdown -> HTML -> PDF 全部使用纯 Python 实现 (markdown + xhtml2pdf/reportlab)，Linux 上无需 pandoc / Word
+- 中文使用 reportlab 内置的 CID 字体 STSong-Light；也可以通过 REPORT_FONT_PATH 指定 TTF 字体嵌入
+- 图片通过 link_callback 直接读取 output/ 下的本地文件，不再改写 URL，也不会向本服务发起 HTTP 请求
+- 渲染在独立的线程池中排队执行，WebSocket 和 REST 接口只查询任务状态
+- 相同的报告内容（含引用的图片）按哈希缓存，重复渲染直接复用
+"""
+import os
+import re
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from urllib.parse import unquote, urlparse
+
+logger = logging.getLogger(__name__)
+
+RENDERER_VERSION = 1
+REPORT_FONT_PATH = os.getenv("REPORT_FONT_PATH", "")
+CID_FONT = "STSong-Light"
+
+REPORT_CSS = """
+@page { size: a4; margin: 2cm 1.8cm; }
+body { font-family: %(font)s; font-size: 10.5pt; line-height: 1.5; }
+h1 { font-size: 20pt; margin-bottom: 8pt; }
+h2 { font-size: 15pt; margin-top: 14pt; border-bottom: 1px solid #cccccc; }
+h3 { font-size: 12.5pt; margin-top: 10pt; }
+pre { font-family: %(font)s; font-size: 8.5pt; background-color: #f5f5f5; padding: 6pt; border: 1px solid #e0e0e0; }
+code { font-family: %(font)s; background-color: #f5f5f5; }
+table { border: 1px solid #cccccc; padding: 3pt; }
+th { background-color: #eeeeee; }
+img { zoom: 80%%; }
+"""
+
+_font_lock = threading.Lock()
+_font_family: Optional[str] = None
+
+
+def _register_fonts() -> str:
+    """注册中文字体，返回 CSS 中使用的字体名"""
+    global _font_family
+    with _font_lock:
+        if _font_family is None:
+            from reportlab.pdfbase import pdfmetrics
+            from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+            from xhtml2pdf.default import DEFAULT_FONT
+
+            if REPORT_FONT_PATH and os.path.exists(REPORT_FONT_PATH):
+                from reportlab.pdfbase.ttfonts import TTFont
+                pdfmetrics.registerFont(TTFont("ReportFont", REPORT_FONT_PATH))
+                DEFAULT_FONT["reportfont"] = "ReportFont"
+                _font_family = "ReportFont"
+            else:
+                pdfmetrics.registerFont(UnicodeCIDFont(CID_FONT))
+                DEFAULT_FONT[CID_FONT.lower()] = CID_FONT
+                _font_family = CID_FONT
+    return _font_family
+
+
+class LocalAssets:
+    """把报告中引用的 /output/... 链接解析为本地文件，禁止访问 output 目录之外的路径"""
+
+    def __init__(self, output_root: str, base_dir: str):
+        self.output_root = os.path.abspath(output_root)
+        self.base_dir = os.path.abspath(base_dir)
+
+    def resolve(self, uri: str) -> Optional[str]:
+        parsed = urlparse(uri)
+        if parsed.scheme in ("http", "https", "file", ""):
+            path = unquote(parsed.path)
+        else:
+            return None
+        marker = "/output/"
+        if marker in path:
+            candidate = os.path.join(self.output_root, path.split(marker, 1)[1])
+        elif parsed.scheme in ("http", "https"):
+            return None
+        elif os.path.isabs(path):
+            candidate = path
+        else:
+            candidate = os.path.join(self.base_dir, path)
+        candidate = os.path.abspath(candidate)
+        if not candidate.startswith(self.output_root + os.sep) or not os.path.isfile(candidate):
+            return None
+        return candidate
+
+    def link_callback(self, uri: str, rel: str) -> str:
+        # 解析失败时返回空字符串，xhtml2pdf 会跳过该资源而不是发起网络请求
+        return self.resolve(uri) or ""
+
+
+_IMAGE_RE = re.compile(r"!\[[^\]]*\]\(\s*<?([^)\s>]+)>?[^)]*\)|<img[^>]+src=[\"']([^\"']+)[\"']", re.IGNORECASE)
+
+
+def content_key(md_content: str, assets: LocalAssets) -> str:
+    """报告内容及其引用的本地图片共同决定渲染结果"""
+    h = hashlib.sha256()
+    h.update(f"v{RENDERER_VERSION}:{REPORT_FONT_PATH}\x00".encode("utf-8"))
+    h.update(md_content.encode("utf-8"))
+    for match in _IMAGE_RE.finditer(md_content):
+        uri = match.group(1) or match.group(2)
+        path = assets.resolve(uri)
+        if path:
+            st = os.stat(path)
+            h.update(f"\x00{uri}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def markdown_to_html(md_content: str, font_family: str) -> str:
+    import markdown
+
+    body = markdown.markdown(md_content, extensions=["extra", "sane_lists"], output_format="html")
+    css = REPORT_CSS % {"font": font_family}
+    return f'<html><head><meta charset="utf-8"><style>{css}</style></head><body>{body}</body></html>'
+
+
+def render_pdf(md_content: str, output_path: str, assets: LocalAssets) -> None:
+    """把 Markdown 渲染为 PDF，失败时抛出异常"""
+    from xhtml2pdf import pisa
+
+    html = markdown_to_html(md_content, _register_fonts())
+    tmp_path = f"{output_path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            result = pisa.CreatePDF(html, dest=f, link_callback=assets.link_callback, encoding="utf-8")
+        if result.err:
+            raise RuntimeError(f"xhtml2pdf reported {result.err} error(s)")
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class ReportJob:
+    """一个报告渲染任务"""
+
+    def __init__(self, md_content: str, pdf_path: str, assets: LocalAssets, session_id: Optional[str] = None):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.md_content = md_content
+        self.pdf_path = pdf_path
+        self.assets = assets
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.cached = False
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.future: Optional[Future] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "status": self.status,
+            # 相对于 output/ 的路径，即 /output/ 静态挂载下的 URL 路径
+            "pdf": os.path.relpath(self.pdf_path, self.assets.output_root).replace(os.sep, "/"),
+            "error": self.error,
+            "cached": self.cached,
+            "queue_ms": round((self.started_at - self.created_at) * 1000, 1) if self.started_at else None,
+            "render_ms": round((self.finished_at - self.started_at) * 1000, 1)
+            if self.started_at and self.finished_at else None,
+        }
+
+
+class ReportRenderQueue:
+    """后台报告渲染队列：固定大小的线程池 + 按内容哈希的 PDF 缓存"""
+
+    def __init__(self, cache_dir: str, max_workers: int = 2, max_jobs: int = 500, max_cached: int = 200):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_jobs = max_jobs
+        self.max_cached = max_cached
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="report")
+        self.jobs: Dict[str, ReportJob] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, md_content: str, pdf_path: str, assets: LocalAssets, session_id: Optional[str] = None) -> ReportJob:
+        job = ReportJob(md_content, pdf_path, assets, session_id)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self._trim()
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[ReportJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self, session_id: Optional[str] = None) -> List[ReportJob]:
+        with self.lock:
+            return [j for j in self.jobs.values() if session_id is None or j.session_id == session_id]
+
+    def _trim(self):
+        # 只保留最近的任务记录
+        finished = [j for j in self.jobs.values() if j.status in ("done", "failed")]
+        for job in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job.job_id]
+
+    def _prune_cache(self):
+        """缓存的 PDF 超过上限时删除最旧的"""
+        try:
+            entries = [e for e in os.scandir(self.cache_dir) if e.name.endswith(".pdf")]
+        except OSError:
+            return
+        if len(entries) <= self.max_cached:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_cached]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _run(self, job: ReportJob):
+        job.status = "rendering"
+        job.started_at = time.time()
+        try:
+            key = content_key(job.md_content, job.assets)
+            cached_pdf = os.path.join(self.cache_dir, f"{key}.pdf")
+            if os.path.exists(cached_pdf):
+                job.cached = True
+            else:
+                render_pdf(job.md_content, cached_pdf, job.assets)
+                self._prune_cache()
+            # 缓存和产物目录在同一文件系统上时直接硬链接
+            tmp_path = f"{job.pdf_path}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                os.link(cached_pdf, tmp_path)
+            except OSError:
+                shutil.copyfile(cached_pdf, tmp_path)
+            os.replace(tmp_path, job.pdf_path)
+            job.status = "done"
+        except Exception as e:
+            logger.error(f"Report render failed for {job.pdf_path}: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            # 渲染完成后不再需要保留报告原文
+            job.md_content = ""
+        return job
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
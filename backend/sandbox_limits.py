@@ -0,0 +1,148 @@
+"""
+沙箱资源限制
+
+LLM 生成的代码在内核子进程中运行，这里负责:
+- 子进程环境变量白名单（不向用户代码泄露 API Key 等服务端配置）
+- 启动时通过 rlimit 限制地址空间、单文件大小和进程 / 线程数（POSIX）
+- 每次执行的 CPU 时间配额（内核进程内设置 RLIMIT_CPU 软限制，见 kernel_worker）
+- 超时后按进程组终止：先 SIGTERM，宽限期后 SIGKILL，用户代码启动的子进程一并清理
+
+Windows 上没有 resource / 进程组，只保留环境变量白名单和超时终止。
+"""
+import os
+import signal
+import subprocess
+from functools import partial
+from typing import Any, Dict, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 地址空间上限 (MB)，0 表示不限制；numpy / BLAS 会预留较多虚拟内存，不宜设得过低
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "4096"))
+# 每次执行的 CPU 时间上限 (秒)，0 表示不限制
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "120"))
+# 单个文件的写入上限 (MB)
+SANDBOX_FILE_SIZE_MB = int(os.getenv("SANDBOX_FILE_SIZE_MB", "1024"))
+# RLIMIT_NPROC 按用户统计（包括服务进程自身的线程），默认不启用，只限制数值库的线程池
+SANDBOX_MAX_PROCS = int(os.getenv("SANDBOX_MAX_PROCS", "0"))
+SANDBOX_THREADS = int(os.getenv("SANDBOX_THREADS", "4"))
+# 超时后 SIGTERM 到 SIGKILL 的宽限期 (秒)
+SANDBOX_KILL_GRACE = float(os.getenv("SANDBOX_KILL_GRACE", "2"))
+
+# 传递给沙箱的环境变量（其余全部丢弃）
+ENV_ALLOWLIST = {
+    "PATH", "HOME", "USER", "LANG", "LANGUAGE", "LC_ALL", "LC_CTYPE", "TZ", "TMPDIR", "TEMP", "TMP",
+    "PYTHONPATH", "PYTHONHOME", "VIRTUAL_ENV", "CONDA_PREFIX", "MPLCONFIGDIR", "FONTCONFIG_PATH",
+    "DATASET_CACHE_DIR",
+    # 沙箱内 sql() / 绘图辅助函数的配置
+    "SQL_MAX_ROWS", "SQL_MEMORY_MB",
+    "PLOT_MAX_POINTS", "PLOT_LINE_POINTS", "PLOT_GUARD_POINTS", "PLOT_DPI", "PLOT_FONT_PATH",
+    # Windows 上启动 Python 需要的变量
+    "SYSTEMROOT", "SYSTEMDRIVE", "WINDIR", "COMSPEC", "PATHEXT", "USERPROFILE", "APPDATA", "LOCALAPPDATA",
+}
+ENV_ALLOWLIST.update(name.strip() for name in os.getenv("SANDBOX_ENV_ALLOW", "").split(",") if name.strip())
+
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_MAX_THREADS")
+
+
+def sandbox_env(extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """白名单过滤后的子进程环境变量"""
+    env = {k: v for k, v in os.environ.items() if k in ENV_ALLOWLIST}
+    env["MPLBACKEND"] = os.environ.get("MPLBACKEND", "Agg")
+    env["PYTHONUNBUFFERED"] = "1"
+    env["PYTHONIOENCODING"] = "utf-8"
+    if SANDBOX_THREADS > 0:
+        for name in THREAD_ENV_VARS:
+            env[name] = str(SANDBOX_THREADS)
+    if SANDBOX_CPU_SECONDS > 0:
+        env["SANDBOX_CPU_SECONDS"] = str(SANDBOX_CPU_SECONDS)
+    if extra:
+        env.update(extra)
+    return env
+
+
+def _set_limit(name: str, value: int):
+    limit = getattr(resource, name, None)
+    if limit is None or value <= 0:
+        return
+    try:
+        _, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit, (value, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def _apply_limits(cpu_seconds: int = 0):
+    """在子进程 exec 之前执行（preexec_fn），只做简单的系统调用"""
+    if cpu_seconds > 0:
+        # 一次性进程：软限制触发 SIGXCPU，宽限后由硬限制强制终止
+        try:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + int(SANDBOX_KILL_GRACE) + 1))
+        except (ValueError, OSError):
+            pass
+    _set_limit("RLIMIT_AS", SANDBOX_MEMORY_MB * 1024 * 1024)
+    _set_limit("RLIMIT_FSIZE", SANDBOX_FILE_SIZE_MB * 1024 * 1024)
+    _set_limit("RLIMIT_NPROC", SANDBOX_MAX_PROCS)
+    # 超出文件大小限制时让 write() 返回 EFBIG，而不是直接杀死进程
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+
+
+def popen_kwargs(cpu_seconds: int = 0) -> Dict[str, Any]:
+    """
+    subprocess.Popen 的沙箱参数：独立进程组 + rlimit。
+    cpu_seconds 只用于一次性执行的进程；常驻内核在每次执行前自行设置 CPU 配额。
+    """
+    if os.name != "posix":
+        return {}
+    kwargs: Dict[str, Any] = {"start_new_session": True}
+    if resource is not None:
+        kwargs["preexec_fn"] = partial(_apply_limits, cpu_seconds)
+    return kwargs
+
+
+def kill_process_group(process: subprocess.Popen, grace: float = SANDBOX_KILL_GRACE):
+    """终止子进程及其进程组：SIGTERM，宽限期内未退出再 SIGKILL"""
+    if process.poll() is not None:
+        return
+    if os.name != "posix":
+        process.kill()
+        process.wait(timeout=5)
+        return
+
+    def send(sig):
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    send(signal.SIGTERM)
+    try:
+        process.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        pass
+    # 主进程已退出时进程组里也可能还有用户代码启动的子进程
+    send(signal.SIGKILL)
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        pass
+
+
+def describe_exit(returncode: Optional[int]) -> str:
+    """把内核退出码翻译为可读的原因（rlimit 触发的信号）"""
+    if returncode is None or returncode >= 0:
+        return f"exit code {returncode}"
+    reasons = {
+        "SIGKILL": "killed by SIGKILL (possibly out of memory)",
+        "SIGXCPU": "CPU time limit exceeded",
+        "SIGSEGV": "segmentation fault (possibly out of memory)",
+    }
+    for name, reason in reasons.items():
+        if getattr(signal, name, None) == -returncode:
+            return reason
+    return f"signal {-returncode}"
@@ -0,0 +1,160 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, Optional
+
+_DONE = object()
+# 执行线程与事件循环之间最多缓冲的输出行数；消费者（WebSocket）跟不上时执行线程阻塞等待
+LINE_BUFFER = 256
+
+
+class ExecutionScheduler:
+    """
+    全局代码执行调度器
+    - 限制同时运行的沙箱执行数量
+    - 超出上限的请求按会话轮转排队，单个会话不能占满队列
+    - 阻塞的执行生成器在有界线程池中运行，不会卡住事件循环
+    """
+
+    def __init__(self, max_concurrent: int = 4):
+        self.max_concurrent = max(1, max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="sandbox")
+        self._waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._running = 0
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def queue_depth(self) -> int:
+        """当前排队等待执行的请求数"""
+        return sum(len(q) for q in self._waiting.values())
+
+    def _position(self, session_id: str) -> int:
+        """估算某个会话在轮转队列中的位置（从 1 开始）"""
+        position = 0
+        for sid, q in self._waiting.items():
+            position += 1
+            if sid == session_id:
+                return position
+        return position
+
+    async def _acquire(self, session_id: str):
+        if self._running < self.max_concurrent and not self._waiting:
+            self._running += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(session_id, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经分配到执行槽位但调用方被取消，归还槽位
+                self._release()
+            else:
+                q = self._waiting.get(session_id)
+                if q is not None and future in q:
+                    q.remove(future)
+                    if not q:
+                        del self._waiting[session_id]
+            raise
+
+    def _release(self):
+        # 轮转选择下一个会话，把槽位直接交给它
+        while self._waiting:
+            session_id, q = next(iter(self._waiting.items()))
+            future = q.popleft()
+            if q:
+                self._waiting.move_to_end(session_id)
+            else:
+                del self._waiting[session_id]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._running -= 1
+
+    async def run_stream(
+        self,
+        session_id: str,
+        gen_factory: Callable[..., Iterator[str]],
+        *args: Any,
+        notify: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        排队获取执行槽位后，在线程池中运行阻塞的生成器，并异步地逐行产出结果。
+        notify 用于把排队深度和等待时间回报给客户端；
+        interrupt 在调用方提前停止读取时调用（例如终止内核），不必等到执行产生下一行输出才结束。
+        """
+        loop = asyncio.get_running_loop()
+        enqueued_at = time.perf_counter()
+
+        if notify and (self._running >= self.max_concurrent or self._waiting):
+            await notify({
+                "type": "exec_queue",
+                "position": self._position(session_id) + 1,
+                "queue_depth": self.queue_depth() + 1,
+                "running": self._running,
+            })
+
+        await self._acquire(session_id)
+        try:
+            wait_ms = round((time.perf_counter() - enqueued_at) * 1000, 1)
+            if notify:
+                await notify({"type": "exec_start", "wait_ms": wait_ms, "queue_depth": self.queue_depth()})
+
+            # 有界队列：输出过快时执行线程阻塞，不会在服务进程中无限堆积
+            lines: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=LINE_BUFFER)
+            stop = threading.Event()
+
+            def put(item) -> bool:
+                """在执行线程中把一项放入队列；调用方已停止读取时放弃并返回 False"""
+                future = asyncio.run_coroutine_threadsafe(lines.put(item), loop)
+                while True:
+                    try:
+                        future.result(timeout=0.1)
+                        return True
+                    except FutureTimeout:
+                        if stop.is_set():
+                            future.cancel()
+                            return False
+
+            def pump():
+                gen = gen_factory(*args)
+                try:
+                    for line in gen:
+                        if not put(line) or stop.is_set():
+                            break
+                except BaseException as e:
+                    put(f"\n[Error]: {e}")
+                finally:
+                    gen.close()
+                    put(_DONE)
+
+            worker = loop.run_in_executor(self._executor, pump)
+            finished = False
+            try:
+                while True:
+                    item = await lines.get()
+                    if item is _DONE:
+                        finished = True
+                        break
+                    yield item
+            finally:
+                stop.set()
+                if not finished and interrupt is not None:
+                    # 执行可能正在进行长时间的静默计算，直接中止，而不是等它产生下一行输出
+                    try:
+                        interrupt()
+                    except Exception:
+                        pass
+                # 等待线程真正结束后再释放槽位，保证并发上限准确
+                await asyncio.shield(worker)
+        finally:
+            self._release()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,257 @@
+"""
+会话持久化 (SQLite)
+
+保存会话、完整对话记录、每一步的指标、产物文件和 token 用量，WebSocket 断开后可以按 session_id 恢复：
+- 对话上下文（压缩后的 LLM 历史 + 统计）以快照形式保存，恢复时无需重放分析过程
+- 完整的对话记录只追加写入 messages 表，快照大小受 token 预算约束，不会随会话增长
+- 所有写入先进入内存队列，由后台任务按时间窗口批量提交（一个事务）；同一会话的多次快照只写最新的一次
+- 读取时优先使用尚未落盘的快照
+
+未安装 aiosqlite 时不启用持久化。
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created REAL,
+    updated REAL,
+    model TEXT,
+    title TEXT,
+    steps INTEGER DEFAULT 0,
+    tokens_in INTEGER DEFAULT 0,
+    tokens_out INTEGER DEFAULT 0,
+    context TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT,
+    seq INTEGER,
+    role TEXT,
+    content TEXT,
+    created REAL,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS steps (
+    session_id TEXT,
+    step INTEGER,
+    step_type TEXT,
+    spans TEXT,
+    tokens_in INTEGER,
+    tokens_out INTEGER,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS steps_session ON steps (session_id);
+CREATE TABLE IF NOT EXISTS artifacts (
+    session_id TEXT,
+    name TEXT,
+    created REAL,
+    PRIMARY KEY (session_id, name)
+);
+"""
+
+
+class SessionStore:
+    """带写入批处理的异步会话存储"""
+
+    def __init__(self, path: str, flush_interval: float = 0.05, max_batch: int = 500, retry_interval: float = 1.0):
+        self.path = os.path.abspath(path)
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.max_batch = max_batch
+        self._conn = None
+        self._pending: List[Tuple[str, tuple]] = []
+        # session_id -> 尚未落盘的最新快照
+        self._snapshots: Dict[str, Dict[str, Any]] = {}
+        # session_id -> 已写入 messages 表的对话记录条数
+        self._persisted: Dict[str, int] = {}
+        self._wake = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = await aiosqlite.connect(self.path)
+        await self._conn.execute("PRAGMA journal_mode=WAL")
+        await self._conn.execute("PRAGMA synchronous=NORMAL")
+        await self._conn.executescript(SCHEMA)
+        await self._conn.commit()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    def _enqueue(self, sql: str, params: tuple):
+        self._pending.append((sql, params))
+        self._wake.set()
+
+    def save(self, session_id: str, context, model: str = "", title: str = ""):
+        """
+        记录会话的最新状态：上下文快照 + 新增的对话记录。
+        只修改内存中的队列，由后台任务批量写入。
+        """
+        now = time.time()
+        start = self._persisted.get(session_id, 0)
+        for seq, message in enumerate(context.transcript[start:], start):
+            self._enqueue(
+                "INSERT OR REPLACE INTO messages (session_id, seq, role, content, created) VALUES (?, ?, ?, ?, ?)",
+                (session_id, seq, message["role"], message["content"], now),
+            )
+        self._persisted[session_id] = len(context.transcript)
+
+        previous = self._snapshots.get(session_id, {})
+        self._snapshots[session_id] = {
+            "context": context.to_state(),
+            "model": model or previous.get("model", ""),
+            "title": title or previous.get("title", ""),
+            "updated": now,
+        }
+        self._wake.set()
+
+    def add_step(self, session_id: str, metrics: Dict[str, Any]):
+        """记录一步的指标（step_metrics 帧）并累加会话的 token 用量"""
+        tokens_in = metrics.get("tokens_in") or 0
+        tokens_out = metrics.get("tokens_out") or 0
+        now = time.time()
+        self._enqueue(
+            "INSERT INTO steps (session_id, step, step_type, spans, tokens_in, tokens_out, created)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (session_id, metrics.get("step"), metrics.get("step_type"),
+             json.dumps(metrics.get("spans_ms", {})), tokens_in, tokens_out, now),
+        )
+        # 会话的第一个快照可能还没写入，会话行不存在时先创建
+        self._enqueue(
+            "INSERT INTO sessions (session_id, created, updated, model, title, steps, tokens_in, tokens_out)"
+            " VALUES (?, ?, ?, '', '', 1, ?, ?)"
+            " ON CONFLICT(session_id) DO UPDATE SET steps = sessions.steps + 1,"
+            " tokens_in = sessions.tokens_in + excluded.tokens_in, tokens_out = sessions.tokens_out + excluded.tokens_out",
+            (session_id, now, now, tokens_in, tokens_out),
+        )
+
+    def add_artifacts(self, session_id: str, names: List[str]):
+        now = time.time()
+        for name in names:
+            self._enqueue(
+                "INSERT OR IGNORE INTO artifacts (session_id, name, created) VALUES (?, ?, ?)",
+                (session_id, name, now),
+            )
+
+    async def _flush_loop(self):
+        while True:
+            await self._wake.wait()
+            # 攒一个时间窗口内的写入，合并为一个事务
+            await asyncio.sleep(self.flush_interval)
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # 未提交的写入已放回队列，稍后重试
+                logger.warning(f"Session store flush failed, retrying in {self.retry_interval}s: {e}")
+                self._wake.set()
+                await asyncio.sleep(self.retry_interval)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._conn is None:
+                return
+            snapshots, self._snapshots = self._snapshots, {}
+            taken: List[Tuple[str, tuple]] = []
+            try:
+                # 会话行先于同一批次中的 messages / steps 写入
+                for session_id, snap in snapshots.items():
+                    await self._conn.execute(
+                        "INSERT INTO sessions (session_id, created, updated, model, title, context)"
+                        " VALUES (?, ?, ?, ?, ?, ?)"
+                        " ON CONFLICT(session_id) DO UPDATE SET updated = excluded.updated,"
+                        " model = excluded.model, title = CASE WHEN sessions.title = '' THEN excluded.title"
+                        " ELSE sessions.title END, context = excluded.context",
+                        (session_id, snap["updated"], snap["updated"], snap["model"], snap["title"],
+                         json.dumps(snap["context"], ensure_ascii=False)),
+                    )
+                while self._pending:
+                    batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                    taken.extend(batch)
+                    for sql, params in batch:
+                        await self._conn.execute(sql, params)
+                await self._conn.commit()
+            except BaseException:
+                # 事务回滚，取出的写入放回队列（期间产生的更新的快照优先）
+                try:
+                    await self._conn.rollback()
+                except Exception as e:
+                    logger.warning(f"Session store rollback failed: {e}")
+                self._snapshots = {**snapshots, **self._snapshots}
+                self._pending = taken + self._pending
+                raise
+
+    async def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        读取会话的上下文快照和完整对话记录，不存在时返回 None。
+        返回 {"context": ..., "transcript": [...], "model": ...}
+        """
+        snap = self._snapshots.get(session_id)
+        if snap is None:
+            async with self._conn.execute(
+                "SELECT context, model, title FROM sessions WHERE session_id = ?", (session_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None or not row[0]:
+                return None
+            snap = {"context": json.loads(row[0]), "model": row[1], "title": row[2]}
+        # 对话记录可能还有一部分在写入队列中，先落盘再读取
+        await self.flush()
+        async with self._conn.execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+        ) as cursor:
+            transcript = [{"role": role, "content": content} for role, content in await cursor.fetchall()]
+        self._persisted[session_id] = len(transcript)
+        return {**snap, "transcript": transcript}
+
+    async def summary(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """会话概要：token 用量、步骤指标和产物列表"""
+        await self.flush()
+        async with self._conn.execute(
+            "SELECT created, updated, model, title, steps, tokens_in, tokens_out FROM sessions WHERE session_id = ?",
+            (session_id,),
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        async with self._conn.execute(
+            "SELECT step, step_type, spans, tokens_in, tokens_out FROM steps WHERE session_id = ? ORDER BY rowid",
+            (session_id,),
+        ) as cursor:
+            steps = [
+                {"step": s, "step_type": t, "spans_ms": json.loads(spans or "{}"), "tokens_in": i, "tokens_out": o}
+                for s, t, spans, i, o in await cursor.fetchall()
+            ]
+        async with self._conn.execute(
+            "SELECT name FROM artifacts WHERE session_id = ? ORDER BY created", (session_id,)
+        ) as cursor:
+            artifacts = [name for (name,) in await cursor.fetchall()]
+        keys = ("created", "updated", "model", "title", "steps", "tokens_in", "tokens_out")
+        return {"session_id": session_id, **dict(zip(keys, row)), "step_metrics": steps, "artifacts": artifacts}
+
+    def forget(self, session_id: str):
+        """连接结束后释放内存中的写入进度（数据仍在数据库中）"""
+        self._persisted.pop(session_id, None)
@@ -0,0 +1,167 @@
+"""
+会话隔离的工作区
+
+- 每个会话在 sessions/<session_id>/ 下有独立的执行目录，uploads/ 中的文件以硬链接的形式出现在其中
+  （不支持硬链接时复制）；内核在写入这些文件前会先断开链接（见 kernel_worker），共享的上传文件不会被改写
+- 每个会话的产物收集到 output/<session_id>/，不同会话不会互相"偷走"生成的图表
+- 长时间无活动的会话目录和产物目录按 TTL 回收
+"""
+import os
+import re
+import time
+import uuid
+import shutil
+import logging
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SESSIONS_DIR = os.path.abspath(os.getenv("SESSIONS_DIR", "sessions"))
+# 执行目录的保留时间（会话断开后），以及产物目录的保留时间
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(3600)))
+OUTPUT_TTL = float(os.getenv("OUTPUT_TTL", str(7 * 24 * 3600)))
+
+_SESSION_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+def is_session_id(name: str) -> bool:
+    return bool(_SESSION_ID_RE.match(name))
+
+
+def unique_name(prefix: str, suffix: str = "") -> str:
+    """带时间戳和随机后缀的文件名，同一秒内也不会冲突"""
+    return f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}{suffix}"
+
+
+class SessionWorkspace:
+    """一个会话的执行目录和产物目录"""
+
+    def __init__(self, session_id: str, uploads_dir: str = "uploads", output_root: str = "output"):
+        self.session_id = session_id
+        self.uploads_dir = os.path.abspath(uploads_dir)
+        self.work_dir = os.path.join(SESSIONS_DIR, session_id)
+        self.output_dir = os.path.join(os.path.abspath(output_root), session_id)
+        # 相对于静态文件挂载点 /output 的路径前缀
+        self.output_prefix = f"output/{session_id}"
+        os.makedirs(self.work_dir, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        # 文件名 -> 链接进来时的 inode，用于判断会话内的文件是否仍是上传文件的视图
+        self.linked: Dict[str, int] = {}
+        # 上次同步时上传文件目录的版本号，未变化时跳过同步
+        self.synced_version: Optional[int] = None
+        self.touch()
+
+    def touch(self):
+        """刷新活动时间，GC 据此判断会话是否过期"""
+        now = time.time()
+        for path in (self.work_dir, self.output_dir):
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+
+    def _link(self, src: str, dest: str):
+        tmp_dest = f"{dest}.{uuid.uuid4().hex[:8]}.link"
+        try:
+            os.link(src, tmp_dest)
+        except OSError:
+            shutil.copy2(src, tmp_dest)
+        os.replace(tmp_dest, dest)
+
+    def sync_uploads(self, version: Optional[int] = None) -> List[str]:
+        """
+        让执行目录中的上传文件视图与 uploads/ 保持一致，返回本次新建或删除的路径。
+        会话自己改写或替换过的文件保持不动。
+        version 为上传文件目录（FileCatalog）的版本号：与上次同步时相同说明没有变化，
+        直接返回，不再逐个 stat 上传文件。
+        """
+        if version is not None and version == self.synced_version:
+            return []
+        self.synced_version = version
+        changed: List[str] = []
+        try:
+            names = [n for n in os.listdir(self.uploads_dir) if not n.startswith(".")]
+        except OSError:
+            names = []
+
+        current = set()
+        for name in names:
+            src = os.path.join(self.uploads_dir, name)
+            dest = os.path.join(self.work_dir, name)
+            try:
+                st = os.stat(src)
+            except OSError:
+                continue
+            if not os.path.isfile(src):
+                continue
+            current.add(name)
+            try:
+                dest_ino = os.stat(dest).st_ino
+            except OSError:
+                dest_ino = None
+
+            previous = self.linked.get(name)
+            if dest_ino is not None and dest_ino == st.st_ino:
+                self.linked[name] = st.st_ino
+                continue
+            if dest_ino is None or dest_ino == previous:
+                # 尚未链接，或仍是旧版本上传文件的视图
+                try:
+                    self._link(src, dest)
+                    self.linked[name] = os.stat(dest).st_ino
+                    changed.append(dest)
+                except OSError as e:
+                    logger.warning(f"Failed to link {name} into session {self.session_id}: {e}")
+
+        # 已从 uploads/ 删除的文件：移除未被会话改写过的视图
+        for name in list(self.linked):
+            if name in current:
+                continue
+            dest = os.path.join(self.work_dir, name)
+            try:
+                if os.stat(dest).st_ino == self.linked[name]:
+                    os.remove(dest)
+                    changed.append(dest)
+            except OSError:
+                pass
+            del self.linked[name]
+        return changed
+
+    def output_url_path(self, name: str) -> str:
+        return f"{self.output_prefix}/{name}"
+
+    def remove_work_dir(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def collect_garbage(output_root: str = "output", active: Iterable[str] = ()) -> Dict[str, int]:
+    """删除过期的会话执行目录和产物目录，返回删除的数量"""
+    active = set(active)
+    now = time.time()
+    removed = {"sessions": 0, "outputs": 0}
+    for root, ttl, key in (
+        (SESSIONS_DIR, SESSION_TTL, "sessions"),
+        (os.path.abspath(output_root), OUTPUT_TTL, "outputs"),
+    ):
+        try:
+            names = os.listdir(root)
+        except OSError:
+            continue
+        for name in names:
+            if not is_session_id(name) or name in active:
+                continue
+            path = os.path.join(root, name)
+            try:
+                if not os.path.isdir(path) or now - os.stat(path).st_mtime < ttl:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed[key] += 1
+    if removed["sessions"] or removed["outputs"]:
+        logger.info(f"Session GC removed {removed['sessions']} workspaces, {removed['outputs']} output dirs")
+    return removed
@@ -0,0 +1,101 @@
+"""
+Agent 步骤标签 (<Analyze>, <Understand>, <Code>, <Answer>) 的增量解析器
+
+LLM 流式输出时逐块 feed，只扫描新到达的文本；
+一旦检测到闭合的 <Code> 块就可以立即开始执行，不必等待整个补全结束。
+"""
+from typing import List, Optional, Tuple
+
+STEP_TAGS = ("Analyze", "Understand", "Code", "Answer")
+
+
+class TagStreamParser:
+    """
+    增量标签解析器。
+    blocks 按出现顺序记录已闭合的 (tag, body)，open_tag 为当前未闭合的标签。
+    """
+
+    def __init__(self, tags: Tuple[str, ...] = STEP_TAGS):
+        self.tags = tags
+        self.buffer = ""
+        self.blocks: List[Tuple[str, str]] = []
+        self.open_tag: Optional[str] = None
+        self.seen_tags: List[str] = []
+        self.closed_end: Optional[int] = None  # 最近一个闭合标签在 buffer 中的结束位置
+        self._open_body_start = 0
+        self._scan_pos = 0
+        self._max_open_len = max(len(t) for t in tags) + 2
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        """追加一段文本，返回本次新闭合的 (tag, body) 列表"""
+        self.buffer += text
+        closed: List[Tuple[str, str]] = []
+
+        while True:
+            if self.open_tag is None:
+                start = self._find_open()
+                if start is None:
+                    break
+            else:
+                close_str = f"</{self.open_tag}>"
+                end = self.buffer.find(close_str, self._scan_pos)
+                if end == -1:
+                    # 结束标签可能被切在两个 chunk 之间
+                    self._scan_pos = max(self._open_body_start, len(self.buffer) - len(close_str) + 1)
+                    break
+                body = self.buffer[self._open_body_start:end].strip()
+                block = (self.open_tag, body)
+                self.blocks.append(block)
+                closed.append(block)
+                self.open_tag = None
+                self.closed_end = end + len(close_str)
+                self._scan_pos = self.closed_end
+        return closed
+
+    def _find_open(self) -> Optional[int]:
+        pos = self._scan_pos
+        while True:
+            lt = self.buffer.find("<", pos)
+            if lt == -1:
+                self._scan_pos = len(self.buffer)
+                return None
+            gt = self.buffer.find(">", lt)
+            if gt == -1:
+                # 开始标签还没有完整到达；太长则说明不是标签
+                if len(self.buffer) - lt <= self._max_open_len + 32:
+                    self._scan_pos = lt
+                    return None
+                pos = lt + 1
+                continue
+            name = self.buffer[lt + 1:gt].split(" ", 1)[0]
+            if name in self.tags:
+                self.open_tag = name
+                self.seen_tags.append(name)
+                self._open_body_start = gt + 1
+                self._scan_pos = gt + 1
+                return lt
+            pos = lt + 1
+
+    def first_block(self, tag: str) -> Optional[str]:
+        """返回第一个已闭合的指定标签内容"""
+        for name, body in self.blocks:
+            if name == tag:
+                return body
+        return None
+
+    def body(self, tag: str) -> Optional[str]:
+        """返回指定标签的内容；标签未闭合时返回目前已收到的部分"""
+        closed = self.first_block(tag)
+        if closed is not None:
+            return closed
+        if self.open_tag == tag:
+            return self.buffer[self._open_body_start:].strip()
+        return None
+
+
+def extract_blocks(text: str, tag: str) -> List[str]:
+    """从完整文本中提取所有闭合的指定标签内容"""
+    parser = TagStreamParser()
+    parser.feed(text)
+    return [body for name, body in parser.blocks if name == tag]
+
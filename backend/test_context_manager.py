@@ -0,0 +1,63 @@
+from context_manager import ConversationContext, count_tokens
+
+
+def execution_output(step, rows=100):
+    return "\n".join(f"row {step} {i}" for i in range(rows))
+
+
+# 预算放得下一次完整的执行输出，放不下三次（与 tiktoken 是否可用无关）
+BUDGET = count_tokens(execution_output(0)) * 2
+
+
+def make_context():
+    context = ConversationContext(
+        "system prompt", token_budget=BUDGET, keep_recent_outputs=1, compact_output_tokens=50,
+    )
+    context.add_user("# Instruction\nanalyze the data")
+    for step in range(3):
+        context.add_assistant(f"<Code>print({step})</Code>")
+        context.add_execution(execution_output(step))
+    return context
+
+
+def test_compact_stays_within_budget():
+    context = make_context()
+    messages = context.build()
+    stats = context.stats()
+    assert stats["compactions"] == 1
+    assert stats["prompt_tokens"] <= context.token_budget
+    # 最近一次执行输出保持完整，较早的被截断
+    assert messages[-1]["content"] == execution_output(2)
+    assert messages[2]["content"] != execution_output(0)
+    # 完整记录不受压缩影响
+    assert context.transcript[3]["content"] == execution_output(0)
+
+
+def test_prefix_is_stable_after_compaction():
+    context = make_context()
+    first = context.build()
+    context.add_assistant("<Answer>done</Answer>")
+    second = context.build()
+    assert second[:len(first)] == first
+    assert context.stats()["prefix_reused_messages"] == len(first)
+
+
+def test_volatile_state_does_not_break_the_prefix():
+    context = make_context()
+    first = context.build(volatile="# Data\na.csv")
+    context.add_user("next question")
+    second = context.build(volatile="# Data\na.csv\nb.csv")
+    # 易变状态只追加在末尾，不写入历史
+    assert first[-1] == {"role": "system", "content": "# Data\na.csv"}
+    assert second[:len(first) - 1] == first[:-1]
+    assert context.stats()["prefix_reused_messages"] == len(first) - 1
+
+
+def test_compaction_survives_a_snapshot_round_trip():
+    context = make_context()
+    first = context.build()
+    restored = ConversationContext.from_state(
+        "system prompt", context.to_state(), context.transcript,
+        token_budget=BUDGET, keep_recent_outputs=1, compact_output_tokens=50,
+    )
+    assert restored.build() == first
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+import dataset_cache
+from exec_cache import ExecCache
+
+CODE = "import pandas as pd\ndf = pd.read_csv('data.csv')\nprint(len(df))"
+
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    # 哈希索引写到临时目录，不影响真实的 cache/datasets
+    monkeypatch.setattr(dataset_cache, "CACHE_DIR", str(tmp_path / "datasets"))
+    work = tmp_path / "work"
+    work.mkdir()
+    (work / "data.csv").write_text("a,b\n1,2\n", encoding="utf-8")
+    return str(work)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ExecCache(str(tmp_path / "exec_cache"))
+    yield cache
+    cache.close()
+
+
+def input_state(work_dir, *names):
+    """与 WorkspaceTracker.input_state 相同的格式：相对路径 -> (inode, mtime_ns)"""
+    state = {}
+    for name in names:
+        st = os.stat(os.path.join(work_dir, name))
+        state[name] = (st.st_ino, st.st_mtime_ns)
+    return state
+
+
+def run(cache, work_dir, session_id="s1", kernel_id="k1", code=CODE, reads=("data.csv",), before=None):
+    """模拟一次真正的执行：读取 data.csv 并成功结束"""
+    state = cache.session(session_id, kernel_id)
+    if before is None:
+        before = input_state(work_dir, "data.csv")
+    usage = {"ok": True, "reads": list(reads)}
+    cache.record(state, code, usage, kernel_id, work_dir, before, ["1\n"], [], 5.0)
+    return state
+
+
+def test_same_code_and_inputs_hit(cache, work_dir):
+    run(cache, work_dir)
+    entry = cache.lookup(cache.session("s2", "k2"), CODE, work_dir)
+    assert entry is not None
+    assert entry["output"] == ["1\n"]
+    assert set(entry["deps"]) == {"data.csv"}
+
+
+def test_comments_and_formatting_do_not_matter(cache, work_dir):
+    run(cache, work_dir)
+    reformatted = "import pandas as pd  # load\n\ndf = pd.read_csv( 'data.csv' )\nprint(len(df))\n"
+    assert cache.lookup(cache.session("s2", "k2"), reformatted, work_dir) is not None
+
+
+def test_changed_input_file_misses(cache, work_dir):
+    run(cache, work_dir)
+    with open(os.path.join(work_dir, "data.csv"), "w", encoding="utf-8") as f:
+        f.write("a,b\n1,2\n3,4\n")
+    assert cache.lookup(cache.session("s2", "k2"), CODE, work_dir) is None
+
+
+def test_input_rewritten_during_execution_is_not_cached(cache, work_dir):
+    before = input_state(work_dir, "data.csv")
+    with open(os.path.join(work_dir, "data.csv"), "w", encoding="utf-8") as f:
+        f.write("a,b\n5,6\n7,8\n")
+    run(cache, work_dir, before=before)
+    assert cache.stats()["entries"] == 0
+
+
+def test_history_chain_is_part_of_the_key(cache, work_dir):
+    run(cache, work_dir)
+    follow_up = "print(df.shape)"
+    run(cache, work_dir, code=follow_up)
+    # 新会话的历史为空：后续步骤依赖之前定义的 df，不能命中
+    assert cache.lookup(cache.session("s2", "k2"), follow_up, work_dir) is None
+    # 回放了相同的第一步之后历史一致，可以命中
+    state = cache.session("s3", "k3")
+    cache.replayed(state, CODE, cache.lookup(state, CODE, work_dir))
+    assert state.pending == [CODE]
+    assert cache.lookup(state, follow_up, work_dir) is not None
+
+
+def test_kernel_restart_resets_the_chain(cache, work_dir):
+    state = run(cache, work_dir)
+    assert state.chain != ""
+    assert cache.session("s1", "k2").chain == ""
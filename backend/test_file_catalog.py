@@ -0,0 +1,71 @@
+import os
+
+from file_catalog import FileCatalog
+
+SESSION_A = "a" * 32
+SESSION_B = "b" * 32
+
+
+def write(root, name, content):
+    path = os.path.join(root, *name.split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def make_catalog(tmp_path):
+    root = str(tmp_path / "output")
+    write(root, f"{SESSION_A}/chart.png", "a")
+    write(root, f"{SESSION_B}/chart.png", "b")
+    catalog = FileCatalog(root, recursive=True)
+    catalog.scan()
+    return root, catalog
+
+
+def test_etag_is_stable_without_changes(tmp_path):
+    _, catalog = make_catalog(tmp_path)
+    assert catalog.etag() == catalog.etag()
+    assert catalog.etag(f"{SESSION_A}/") == catalog.etag(f"{SESSION_A}/")
+
+
+def test_session_etag_ignores_other_sessions(tmp_path):
+    root, catalog = make_catalog(tmp_path)
+    all_before = catalog.etag()
+    a_before = catalog.etag(f"{SESSION_A}/")
+    b_before = catalog.etag(f"{SESSION_B}/")
+
+    write(root, f"{SESSION_B}/report.pdf", "pdf")
+    catalog.upsert(f"{SESSION_B}/report.pdf")
+
+    assert catalog.etag(f"{SESSION_A}/") == a_before
+    assert catalog.etag(f"{SESSION_B}/") != b_before
+    assert catalog.etag() != all_before
+
+
+def test_removal_changes_the_session_etag(tmp_path):
+    _, catalog = make_catalog(tmp_path)
+    before = catalog.etag(f"{SESSION_A}/")
+    catalog.remove(f"{SESSION_A}/chart.png")
+    assert catalog.etag(f"{SESSION_A}/") != before
+    # 不存在的条目不改变版本号
+    after = catalog.etag(f"{SESSION_A}/")
+    catalog.remove(f"{SESSION_A}/missing.png")
+    assert catalog.etag(f"{SESSION_A}/") == after
+
+
+def test_etag_depends_on_query(tmp_path):
+    _, catalog = make_catalog(tmp_path)
+    prefix = f"{SESSION_A}/"
+    page1 = catalog.etag(prefix, {"q": None, "mime": None, "offset": 0, "limit": 10})
+    page2 = catalog.etag(prefix, {"q": None, "mime": None, "offset": 10, "limit": 10})
+    images = catalog.etag(prefix, {"q": None, "mime": "image/", "offset": 0, "limit": 10})
+    assert len({page1, page2, images, catalog.etag(prefix)}) == 4
+    # 参数顺序不影响 ETag
+    assert page1 == catalog.etag(prefix, {"limit": 10, "offset": 0, "mime": None, "q": None})
+
+
+def test_etag_differs_between_catalog_instances(tmp_path):
+    root, catalog = make_catalog(tmp_path)
+    restarted = FileCatalog(root, recursive=True)
+    restarted.scan()
+    assert restarted.etag() != catalog.etag()
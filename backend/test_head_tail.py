@@ -0,0 +1,36 @@
+from utils import _HeadTail
+
+MARKER = "[{lines} lines / {bytes} bytes omitted]"
+
+
+def test_within_limits_keeps_everything():
+    ht = _HeadTail(max_bytes=1000, max_lines=10)
+    for i in range(4):
+        assert ht.add(f"l{i}\n") == f"l{i}\n"
+    assert not ht.overflowed
+    assert ht.render(MARKER) == "l0\nl1\nl2\nl3\n"
+
+
+def test_line_limit_keeps_head_and_tail():
+    ht = _HeadTail(max_bytes=1000, max_lines=4)
+    passed = [ht.add(f"l{i}\n") for i in range(10)]
+    # 只有开头配额内的部分立即返回
+    assert passed[:2] == ["l0\n", "l1\n"]
+    assert all(p == "" for p in passed[2:])
+    assert ht.omitted_lines == 6
+    assert ht.render(MARKER) == "l0\nl1\n[6 lines / 18 bytes omitted]l8\nl9\n"
+
+
+def test_byte_limit_truncates_a_single_long_line():
+    ht = _HeadTail(max_bytes=100, max_lines=10)
+    assert ht.add("a" * 500 + "b" * 500) == "a" * 50
+    assert ht.omitted_bytes == 900
+    assert ht.render(MARKER) == "a" * 50 + "[0 lines / 900 bytes omitted]" + "b" * 50
+
+
+def test_multibyte_text_is_not_split_inside_a_character():
+    ht = _HeadTail(max_bytes=20, max_lines=10)
+    # 每个汉字 3 字节，开头配额 10 字节只能放下 3 个字
+    assert ht.add("数据" * 20) == "数据数"
+    # 结尾同样只保留完整的字符
+    assert ht.render(MARKER).endswith("omitted]据数据")
@@ -1,16 +1,14 @@
 import os
 import sys
 import asyncio
-import concurrent.futures
-from utils import convert_md_to_pdf
 
-def run_conversion_in_thread(pdf_report_content, output_pdf_path):
-    return convert_md_to_pdf(pdf_report_content, output_pdf_path)
+from report_renderer import LocalAssets, render_pdf
 
-async def test_conversion_async():
-    md_file_path = r"d:\docker-apps\AIAnalyze\backend\output\report_1764822807.md"
-    output_pdf_path = r"d:\docker-apps\AIAnalyze\backend\output\test_report_async_1764822807.pdf"
+def run_conversion_in_thread(md_content, output_pdf_path, output_root):
+    render_pdf(md_content, output_pdf_path, LocalAssets(output_root, os.path.dirname(output_pdf_path)))
+    return True
 
+async def test_conversion_async(md_file_path, output_pdf_path, output_root="output"):
     print(f"Reading markdown file from: {md_file_path}")
     try:
         with open(md_file_path, "r", encoding="utf-8") as f:
@@ -20,15 +18,13 @@ async def test_conversion_async():
         return
 
     print(f"Starting async conversion to: {output_pdf_path}")
-    
-    abs_output_dir = os.path.abspath("output").replace("\\", "/")
-    pdf_report_content = md_content.replace("http://localhost:8080/output/", f"file:///{abs_output_dir}/")
-    pdf_report_content = pdf_report_content.replace("http://127.0.0.1:8080/output/", f"file:///{abs_output_dir}/")
 
     loop = asyncio.get_running_loop()
-    # Simulate exactly what main.py does: loop.run_in_executor(None, ...)
+    # 与 main.py 相同：在线程池中渲染，/output/... 图片链接解析为本地文件
     try:
-        success = await loop.run_in_executor(None, run_conversion_in_thread, pdf_report_content, output_pdf_path)
+        success = await loop.run_in_executor(
+            None, run_conversion_in_thread, md_content, os.path.abspath(output_pdf_path), output_root
+        )
         
         if success:
             print("Async Conversion successful!")
@@ -40,6 +36,10 @@ async def test_conversion_async():
 if __name__ == "__main__":
     # Add backend directory to sys.path
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-    
+
+    if len(sys.argv) < 3:
+        print("Usage: python test_pdf_conversion.py <report.md> <output.pdf> [output_root]")
+        sys.exit(1)
+
     # Run async test
-    asyncio.run(test_conversion_async())
+    asyncio.run(test_conversion_async(*sys.argv[1:4]))
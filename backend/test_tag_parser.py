@@ -0,0 +1,60 @@
+from tag_parser import TagStreamParser, extract_blocks
+
+TEXT = "<Analyze>look at data</Analyze>\n<Code>\nprint(1)\n</Code>\ntrailing"
+
+
+def feed_chunks(parser, text, size):
+    closed = []
+    for i in range(0, len(text), size):
+        closed.extend(parser.feed(text[i:i + size]))
+    return closed
+
+
+def test_whole_text():
+    parser = TagStreamParser()
+    assert parser.feed(TEXT) == [("Analyze", "look at data"), ("Code", "print(1)")]
+    assert parser.open_tag is None
+    assert parser.seen_tags == ["Analyze", "Code"]
+
+
+def test_any_chunk_size_gives_same_blocks():
+    for size in range(1, len(TEXT) + 1):
+        parser = TagStreamParser()
+        assert feed_chunks(parser, TEXT, size) == [("Analyze", "look at data"), ("Code", "print(1)")], size
+
+
+def test_open_tag_split_across_chunks():
+    parser = TagStreamParser()
+    assert parser.feed("<Co") == []
+    assert parser.open_tag is None
+    assert parser.feed("de>x = 1") == []
+    assert parser.open_tag == "Code"
+    assert parser.body("Code") == "x = 1"
+
+
+def test_close_tag_split_across_chunks():
+    parser = TagStreamParser()
+    parser.feed("<Code>x = 1</Co")
+    assert parser.blocks == []
+    assert parser.feed("de>") == [("Code", "x = 1")]
+    assert parser.closed_end == len("<Code>x = 1</Code>")
+
+
+def test_block_closes_as_soon_as_its_end_tag_arrives():
+    parser = TagStreamParser()
+    assert parser.feed("<Code>a</Code>") == [("Code", "a")]
+    # 之后的文本不影响已闭合的块
+    assert parser.feed("<Answer>done") == []
+    assert parser.first_block("Code") == "a"
+    assert parser.body("Answer") == "done"
+
+
+def test_non_step_tags_are_ignored():
+    parser = TagStreamParser()
+    closed = feed_chunks(parser, "a < b and <div>x</div> <Answer>ok</Answer>", 3)
+    assert closed == [("Answer", "ok")]
+
+
+def test_extract_blocks():
+    assert extract_blocks("<Code>a</Code><Code>b</Code>", "Code") == ["a", "b"]
+    assert extract_blocks("<Code>a", "Code") == []
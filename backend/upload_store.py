@@ -0,0 +1,230 @@
+"""
+上传文件的内容寻址存储
+
+- 上传内容按块流式写入临时文件，同时增量计算 SHA-256，不会把整个文件读进内存
+- 完成后按哈希保存到 blobs/<前两位>/<sha256>，相同内容只保存一份
+- uploads/ 中的文件是指向 blob 的硬链接（不支持硬链接时退化为复制），通过临时文件 + 原子替换落盘
+- 支持分片续传：创建会话 -> 按 offset 追加分片 -> 完成
+- 每个 blob 被哪些上传文件引用记录在 refs.json 中（显式引用计数）。会话执行目录里的视图也是硬链接，
+  所以不能用 st_nlink 判断 blob 是否仍被使用；最后一个上传文件删除时即回收 blob 和数据缓存，
+  会话中残留的视图在同步或 GC 时解除链接后由文件系统释放
+"""
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import threading
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import dataset_cache
+
+STORE_DIR = os.path.abspath(os.getenv("UPLOAD_STORE_DIR", os.path.join("cache", "blobs")))
+TMP_DIR = os.path.join(STORE_DIR, "tmp")
+REFS_FILE = os.path.join(STORE_DIR, "refs.json")
+CHUNK_SIZE = 1024 * 1024
+
+_refs_lock = threading.Lock()
+
+
+def blob_path(digest: str) -> str:
+    return os.path.join(STORE_DIR, digest[:2], digest)
+
+
+def _blob_is_intact(path: str, digest: str) -> bool:
+    # 沙箱代码可能通过硬链接原地改写了内容，复用前确认 blob 未被修改
+    return dataset_cache.known_sha256(path) == digest
+
+
+def _link_or_copy(src: str, dest: str):
+    """原子地把 src 放到 dest：先在同目录建立临时链接/副本，再 os.replace"""
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        # 已经指向同一个 blob；对同一 inode 的 rename 什么都不做，会留下临时链接
+        return
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    tmp_dest = os.path.join(dest_dir, f".{os.path.basename(dest)}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        os.link(src, tmp_dest)
+    except OSError:
+        shutil.copyfile(src, tmp_dest)
+    os.replace(tmp_dest, dest)
+
+
+def _read_refs() -> Dict[str, List[str]]:
+    try:
+        with open(REFS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_refs(refs: Dict[str, List[str]]):
+    os.makedirs(STORE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=STORE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(refs, f)
+        os.replace(tmp_path, REFS_FILE)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _add_ref(digest: str, path: str):
+    path = os.path.abspath(path)
+    with _refs_lock:
+        refs = _read_refs()
+        paths = refs.setdefault(digest, [])
+        if path not in paths:
+            paths.append(path)
+            _write_refs(refs)
+
+
+def _referenced_digest(path: str) -> Optional[str]:
+    """按引用记录查找上传文件对应的 blob（文件内容被改写过时哈希索引已经查不到）"""
+    path = os.path.abspath(path)
+    with _refs_lock:
+        refs = _read_refs()
+    for digest, paths in refs.items():
+        if path in paths:
+            return digest
+    return None
+
+
+def release(digest: Optional[str], path: str):
+    """上传文件 path 不再引用 blob；没有任何上传文件引用时删除 blob 及其数据缓存"""
+    if not digest:
+        return
+    path = os.path.abspath(path)
+    with _refs_lock:
+        refs = _read_refs()
+        paths = [p for p in refs.get(digest, []) if p != path]
+        if paths:
+            refs[digest] = paths
+        else:
+            refs.pop(digest, None)
+        _write_refs(refs)
+    if paths:
+        return
+    try:
+        os.remove(blob_path(digest))
+    except OSError:
+        pass
+    dataset_cache.purge(digest)
+
+
+def commit(tmp_path: str, digest: str, dest: str) -> Dict[str, Any]:
+    """把已经写完并计算好哈希的临时文件提交到存储，并链接到 dest"""
+    previous = (_referenced_digest(dest) or dataset_cache.known_sha256(dest)) if os.path.exists(dest) else None
+    if previous is None and os.path.exists(dest):
+        # 非存储管理的旧文件，直接清理其缓存
+        dataset_cache.invalidate(dest)
+
+    target = blob_path(digest)
+    deduped = os.path.exists(target) and _blob_is_intact(target, digest)
+    if deduped:
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(tmp_path, target)
+        dataset_cache.remember_sha256(target, digest)
+
+    _link_or_copy(target, dest)
+    dataset_cache.remember_sha256(dest, digest)
+    _add_ref(digest, dest)
+
+    if previous and previous != digest:
+        release(previous, dest)
+    return {"sha256": digest, "size": os.path.getsize(dest), "deduped": deduped}
+
+
+async def save_stream(chunks: AsyncIterator[bytes], dest: str) -> Dict[str, Any]:
+    """从异步分块迭代器流式保存上传内容"""
+    os.makedirs(TMP_DIR, exist_ok=True)
+    tmp_path = os.path.join(TMP_DIR, f"{uuid.uuid4().hex}.part")
+    hasher = hashlib.sha256()
+    loop = asyncio.get_event_loop()
+    try:
+        with open(tmp_path, "wb") as f:
+            async for chunk in chunks:
+                hasher.update(chunk)
+                # 磁盘写入放到线程池，避免阻塞事件循环
+                await loop.run_in_executor(None, f.write, chunk)
+        return await loop.run_in_executor(None, commit, tmp_path, hasher.hexdigest(), dest)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+async def iter_upload(upload) -> AsyncIterator[bytes]:
+    """把 FastAPI UploadFile 转成分块迭代器"""
+    while True:
+        chunk = await upload.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def remove(path: str):
+    """删除上传文件，并回收不再被引用的 blob 和缓存"""
+    digest = _referenced_digest(path) or dataset_cache.known_sha256(path)
+    if digest is None:
+        dataset_cache.invalidate(path)
+    os.remove(path)
+    release(digest, path)
+
+
+class ResumableUpload:
+    """一个分片续传会话（保存在内存中，服务重启后需要重新上传）"""
+
+    def __init__(self, filename: str, total_size: Optional[int] = None):
+        self.upload_id = uuid.uuid4().hex
+        self.filename = filename
+        self.total_size = total_size
+        self.received = 0
+        self.hasher = hashlib.sha256()
+        os.makedirs(TMP_DIR, exist_ok=True)
+        self.tmp_path = os.path.join(TMP_DIR, f"{self.upload_id}.part")
+        open(self.tmp_path, "wb").close()
+        self.lock = asyncio.Lock()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "upload_id": self.upload_id,
+            "filename": self.filename,
+            "received": self.received,
+            "total_size": self.total_size,
+        }
+
+    async def append(self, offset: int, chunks: AsyncIterator[bytes]) -> Dict[str, Any]:
+        """追加一个分片；offset 必须等于已接收的字节数"""
+        async with self.lock:
+            if offset != self.received:
+                raise ValueError(f"offset mismatch: expected {self.received}, got {offset}")
+            loop = asyncio.get_event_loop()
+            with open(self.tmp_path, "ab") as f:
+                async for chunk in chunks:
+                    self.hasher.update(chunk)
+                    await loop.run_in_executor(None, f.write, chunk)
+                    self.received += len(chunk)
+            return self.status()
+
+    async def complete(self, dest: str) -> Dict[str, Any]:
+        async with self.lock:
+            if self.total_size is not None and self.received != self.total_size:
+                raise ValueError(f"incomplete upload: {self.received}/{self.total_size} bytes")
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, commit, self.tmp_path, self.hasher.hexdigest(), dest)
+
+    def abort(self):
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
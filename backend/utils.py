@@ -1,83 +1,24 @@
 import os
-import sys
-import json
+import time
+import uuid
 import shutil
-import tempfile
-import subprocess
-import traceback
+import stat
+import threading
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
+from collections import deque
+from typing import Any, List, Dict, Tuple, Optional
 
-import markdown
-from docx2pdf import convert as docx_to_pdf_convert
 try:
-    import pythoncom
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.events import (
+        FileCreatedEvent, DirCreatedEvent, FileMovedEvent, DirMovedEvent, FileModifiedEvent, FileClosedEvent,
+    )
+    WATCH_EVENTS = [FileCreatedEvent, DirCreatedEvent, FileMovedEvent, DirMovedEvent, FileModifiedEvent, FileClosedEvent]
 except ImportError:
-    pythoncom = None
-
-def convert_md_to_pdf(md_content: str, output_path: str) -> bool:
-    """
-    Convert Markdown content to PDF using Pandoc and docx2pdf.
-    Requires Pandoc and Microsoft Word installed.
-    """
-    # Initialize COM for this thread if needed (required for docx2pdf in threads)
-    if pythoncom:
-        pythoncom.CoInitialize()
-
-    temp_md_path = None
-    temp_docx_path = None
-    try:
-        # Convert output_path to absolute path to avoid cwd issues
-        output_path = os.path.abspath(output_path)
-        base_dir = os.path.dirname(output_path)
-        filename = os.path.splitext(os.path.basename(output_path))[0]
-        
-        # Create temp MD file
-        temp_md_path = os.path.join(base_dir, f"{filename}_temp.md")
-        with open(temp_md_path, "w", encoding="utf-8") as f:
-            f.write(md_content)
-            
-        temp_docx_path = os.path.join(base_dir, f"{filename}_temp.docx")
-        
-        # 1. MD -> DOCX (Pandoc)
-        cmd = [
-            "pandoc", 
-            os.path.basename(temp_md_path), 
-            "-o", os.path.basename(temp_docx_path),
-            "--metadata", "title=Data Analysis Report",
-            "--highlight-style=tango" 
-        ]
-        
-        # check=True ensures exception on failure
-        # We use base_dir as cwd, so we must use filenames only for pandoc input/output
-        subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=base_dir)
-        
-        # 2. DOCX -> PDF (docx2pdf)
-        # Note: docx2pdf on Windows opens Word in background.
-        docx_to_pdf_convert(temp_docx_path, output_path)
-        
-        return True
-        
-    except FileNotFoundError:
-        print("\n🚨 Error: Pandoc command not found.")
-        return False
-    except Exception as e:
-        print(f"PDF Conversion Error: {e}")
-        traceback.print_exc()
-        return False
-    finally:
-        # Cleanup
-        try:
-            if temp_md_path and os.path.exists(temp_md_path):
-                os.remove(temp_md_path)
-            if temp_docx_path and os.path.exists(temp_docx_path):
-                os.remove(temp_docx_path)
-        except Exception:
-            pass
-        
-        # Uninitialize COM
-        if pythoncom:
-            pythoncom.CoUninitialize()
+    Observer = None
+    FileSystemEventHandler = None
+    WATCH_EVENTS = None
 
 # 简单的路径唯一化处理
 def uniquify_path(path: Path) -> Path:
@@ -95,57 +36,428 @@ def uniquify_path(path: Path) -> Path:
             return new_path
         counter += 1
 
+class _TouchedPaths(FileSystemEventHandler if FileSystemEventHandler else object):
+    """记录工作区中被写入 / 创建 / 移入的路径"""
+
+    def __init__(self, barrier_prefix: str):
+        self.barrier_prefix = barrier_prefix
+        self.lock = threading.Lock()
+        self.paths: Dict[str, bool] = {}  # 路径 -> 是否为新出现的文件（创建 / 移入）
+        self.dirs: set = set()
+        self.barriers: Dict[str, threading.Event] = {}
+
+    def _touch(self, path: str, is_directory: bool, is_new: bool):
+        name = os.path.basename(path)
+        if name.startswith(self.barrier_prefix):
+            with self.lock:
+                barrier = self.barriers.get(name)
+            if barrier is not None:
+                barrier.set()
+            return
+        with self.lock:
+            if is_directory:
+                self.dirs.add(path)
+            else:
+                self.paths[path] = self.paths.get(path, False) or is_new
+
+    def on_created(self, event):
+        self._touch(event.src_path, event.is_directory, True)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._touch(event.src_path, False, False)
+
+    def on_moved(self, event):
+        self._touch(event.dest_path, event.is_directory, True)
+
+    def on_closed(self, event):
+        self._touch(event.src_path, False, False)
+
+    def take(self) -> Tuple[Dict[str, bool], set]:
+        with self.lock:
+            paths, dirs = self.paths, self.dirs
+            self.paths, self.dirs = {}, set()
+        return paths, dirs
+
+
+_observer = None
+_observer_lock = threading.Lock()
+# 多个会话可能监听同一个目录（共享同一个 watch），最后一个关闭时才取消监听
+_watch_refs: Dict[Any, int] = {}
+
+
+def _get_observer():
+    """进程内共享一个 inotify 观察线程；不可用时返回 None"""
+    global _observer
+    if Observer is None:
+        return None
+    with _observer_lock:
+        if _observer is None:
+            try:
+                observer = Observer()
+                observer.daemon = True
+                observer.start()
+                _observer = observer
+            except Exception as e:
+                print(f"File watcher unavailable, falling back to snapshots: {e}")
+                return None
+    return _observer
+
+
+def _move_file(src: Path, dest: Path):
+    """
+    移动文件（不复制）。同一文件系统上用硬链接 + 删除代替 rename：
+    移出被监听目录的 rename 会让 inotify 事件缓冲多等待 0.5 秒来配对
+    """
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.move(str(src), str(dest))
+    else:
+        os.unlink(src)
+
+
 class WorkspaceTracker:
-    """跟踪工作区文件变化并将产物收集到 static/ 目录"""
+    """
+    跟踪工作区文件变化并将产物收集到 static/ 目录
+
+    优先使用文件系统事件（watchdog/inotify）：只检查执行期间被写入的路径，
+    不再每一步遍历整个工作区。收集前写入一个屏障文件，收到它的事件即说明之前的事件都已送达。
+    事件不可用或屏障超时（例如事件队列溢出）时退化为遍历快照。
+    """
+
+    BARRIER_PREFIX = ".tracker_barrier_"
+    BARRIER_TIMEOUT = 2.0
 
     def __init__(self, workspace_dir: str, generated_dir: str):
         self.workspace_dir = Path(workspace_dir).resolve()
         self.generated_dir = Path(generated_dir).resolve()
         self.generated_dir.mkdir(parents=True, exist_ok=True)
-        self.before_state = self._snapshot()
+        self.watch = None
+        self.handler: Optional[_TouchedPaths] = None
+        self.observer = _get_observer()
+        if self.observer is not None:
+            try:
+                self.handler = _TouchedPaths(self.BARRIER_PREFIX)
+                with _observer_lock:
+                    self.watch = self.observer.schedule(
+                        self.handler, str(self.workspace_dir), recursive=True, event_filter=WATCH_EVENTS
+                    )
+                    _watch_refs[self.watch] = _watch_refs.get(self.watch, 0) + 1
+            except Exception as e:
+                print(f"Failed to watch {self.workspace_dir}, falling back to snapshots: {e}")
+                self.handler = None
+        # 由系统自身放入工作区的文件（如上传文件的链接），路径 -> (inode, mtime)
+        self.ignored: Dict[str, Tuple[int, int]] = {}
+        self.last_timings: Dict[str, float] = {}
+        # 事件模式下只在退化时使用快照，按时间判断变化
+        self.last_collect_ns = time.time_ns()
+        self.before_state = {} if self.handler else self._snapshot()
+
+    def _tracked(self, p: Path) -> bool:
+        return not str(p).startswith(str(self.generated_dir)) and not p.name.startswith(self.BARRIER_PREFIX)
+
+    def _is_ignored(self, p: Path, st: os.stat_result) -> bool:
+        return self.ignored.get(str(p)) == (st.st_ino, st.st_mtime_ns)
+
+    def ignore(self, paths: List[str]):
+        """标记由系统放入工作区的文件，它们不是代码生成的产物"""
+        for path in paths:
+            p = Path(path).resolve()
+            try:
+                st = p.stat()
+            except OSError:
+                self.ignored.pop(str(p), None)
+                continue
+            self.ignored[str(p)] = (st.st_ino, st.st_mtime_ns)
+
+    def input_state(self) -> Dict[str, Tuple[int, int]]:
+        """
+        工作区中由系统放入的输入文件（上传文件的视图）：相对路径 -> (inode, mtime)。
+        代码生成的文件每步都会被收集移走，执行前工作区里只剩这些文件。
+        """
+        state = {}
+        for path, key in self.ignored.items():
+            try:
+                rel = Path(path).relative_to(self.workspace_dir)
+            except ValueError:
+                continue
+            state[rel.as_posix()] = key
+        return state
 
     def _snapshot(self) -> Dict[Path, Tuple[int, int]]:
+        state = {}
         try:
-            return {
-                p.resolve(): (p.stat().st_size, p.stat().st_mtime_ns)
-                for p in self.workspace_dir.rglob("*")
-                if p.is_file() and not str(p).startswith(str(self.generated_dir))
-            }
+            for p in self.workspace_dir.rglob("*"):
+                if not self._tracked(p):
+                    continue
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode) and not self._is_ignored(p.resolve(), st):
+                    state[p.resolve()] = (st.st_size, st.st_mtime_ns)
         except Exception:
-            return {}
+            pass
+        return state
 
-    def diff_and_collect(self) -> List[str]:
-        """计算新增/修改的文件，复制到 generated/，并返回文件名列表"""
+    def _wait_barrier(self) -> bool:
+        """写入屏障文件并等待它的事件，保证之前的写入事件都已被处理"""
+        name = f"{self.BARRIER_PREFIX}{uuid.uuid4().hex}"
+        barrier = threading.Event()
+        with self.handler.lock:
+            self.handler.barriers[name] = barrier
+        path = self.workspace_dir / name
         try:
-            after_state = {
-                p.resolve(): (p.stat().st_size, p.stat().st_mtime_ns)
-                for p in self.workspace_dir.rglob("*")
-                if p.is_file() and not str(p).startswith(str(self.generated_dir))
-            }
-        except Exception:
-            after_state = {}
+            path.touch()
+            return barrier.wait(self.BARRIER_TIMEOUT)
+        except OSError:
+            return False
+        finally:
+            with self.handler.lock:
+                self.handler.barriers.pop(name, None)
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def _changed_from_events(self) -> Optional[List[Path]]:
+        if not self._wait_barrier():
+            return None
+        paths, dirs = self.handler.take()
+        candidates = dict(paths)
+        # 整个目录被移入工作区时只会收到目录事件，只遍历这些目录
+        for d in dirs:
+            if os.path.isdir(d):
+                for p in Path(d).rglob("*"):
+                    candidates[str(p)] = True
+
+        changed = []
+        for path, is_new in candidates.items():
+            p = Path(path)
+            if not self._tracked(p):
+                continue
+            try:
+                st = p.stat()
+            except OSError:
+                # 已被删除或移走
+                continue
+            if not stat.S_ISREG(st.st_mode) or self._is_ignored(p.resolve(), st):
+                continue
+            # 只改了权限等属性（mtime 未变）的文件不算修改
+            if is_new or st.st_mtime_ns >= self.last_collect_ns:
+                changed.append(p.resolve())
+        return changed
+
+    def _changed_from_snapshot(self) -> List[Path]:
+        after_state = self._snapshot()
+        if self.handler is not None:
+            # 事件模式下的退化：没有旧快照，按修改时间判断
+            changed = [p for p, (_, mtime_ns) in after_state.items() if mtime_ns >= self.last_collect_ns]
+            self.handler.take()
+            return changed
 
         added = [p for p in after_state.keys() if p not in self.before_state]
         modified = [
             p for p in after_state.keys()
             if p in self.before_state and after_state[p] != self.before_state[p]
         ]
+        self.before_state = after_state
+        return added + modified
+
+    def diff_and_collect(self) -> List[str]:
+        """计算新增/修改的文件，复制到 generated/，并返回文件名列表"""
+        diff_started = time.perf_counter()
+        changed = None
+        if self.handler is not None:
+            changed = self._changed_from_events()
+            if changed is None:
+                print("Workspace events incomplete, falling back to a full snapshot")
+        if changed is None:
+            changed = self._changed_from_snapshot()
+        self.last_collect_ns = time.time_ns()
+        move_started = time.perf_counter()
 
         collected_files = []
 
-        for p in added + modified:
+        for p in sorted(changed):
             try:
                 # 复制到 generated (static) 目录
                 dest = self.generated_dir / p.name
                 dest = uniquify_path(dest)
-                shutil.move(str(p), str(dest))  # Move instead of copy
+                _move_file(p, dest)
                 collected_files.append(dest.name)
             except Exception as e:
                 print(f"Error moving file {p}: {e}")
 
-        self.before_state = after_state
+        # 最近一次收集的分阶段耗时（秒），供指标统计使用
+        self.last_timings = {
+            "tracker_diff": move_started - diff_started,
+            "file_move": time.perf_counter() - move_started,
+        }
         return collected_files
 
+    def close(self):
+        """停止监听该工作区（共享的观察线程继续运行）"""
+        if self.observer is not None and self.handler is not None and self.watch is not None:
+            with _observer_lock:
+                _watch_refs[self.watch] -= 1
+                try:
+                    if _watch_refs[self.watch] <= 0:
+                        del _watch_refs[self.watch]
+                        self.observer.unschedule(self.watch)
+                    else:
+                        self.observer.remove_handler_for_watch(self.handler, self.watch)
+                except Exception:
+                    pass
+        self.handler = None
+
+class _HeadTail:
+    """在字节 / 行数上限内保留输出的开头和结尾"""
+
+    def __init__(self, max_bytes: int, max_lines: int):
+        self.head_bytes_limit = max_bytes // 2
+        self.head_lines_limit = max(1, max_lines // 2)
+        self.tail_bytes_limit = max_bytes - self.head_bytes_limit
+        self.tail_lines_limit = max(1, max_lines - self.head_lines_limit)
+        self.head: List[str] = []
+        self.head_bytes = 0
+        self.tail: deque = deque()
+        self.tail_bytes = 0
+        self.overflowed = False
+        self.omitted_lines = 0
+        self.omitted_bytes = 0
+
+    def add(self, text: str) -> str:
+        """追加一段输出，返回仍在开头配额内的部分"""
+        size = len(text.encode("utf-8"))
+        if not self.overflowed:
+            if self.head_bytes + size <= self.head_bytes_limit and len(self.head) < self.head_lines_limit:
+                self.head.append(text)
+                self.head_bytes += size
+                return text
+            self.overflowed = True
+            # 超长的单行：开头配额剩余的部分仍然保留
+            room = self.head_bytes_limit - self.head_bytes
+            if room > 0 and len(self.head) < self.head_lines_limit:
+                part = text.encode("utf-8")[:room].decode("utf-8", errors="ignore")
+                self.head.append(part)
+                self.head_bytes += len(part.encode("utf-8"))
+                text = text[len(part):]
+                size = len(text.encode("utf-8"))
+                self.tail.append(text)
+                self.tail_bytes += size
+                self._trim_tail()
+                return part
+
+        self.tail.append(text)
+        self.tail_bytes += size
+        self._trim_tail()
+        return ""
+
+    def _trim_tail(self):
+        while self.tail and (self.tail_bytes > self.tail_bytes_limit or len(self.tail) > self.tail_lines_limit):
+            if len(self.tail) == 1:
+                # 单行超长：只保留末尾部分
+                data = self.tail[0].encode("utf-8")
+                keep = data[-self.tail_bytes_limit:].decode("utf-8", errors="ignore")
+                self.omitted_bytes += len(data) - len(keep.encode("utf-8"))
+                self.tail[0] = keep
+                self.tail_bytes = len(keep.encode("utf-8"))
+                break
+            removed = self.tail.popleft()
+            self.tail_bytes -= len(removed.encode("utf-8"))
+            self.omitted_bytes += len(removed.encode("utf-8"))
+            self.omitted_lines += removed.count("\n") or 1
+
+    def render(self, marker: str) -> str:
+        if not self.omitted_bytes:
+            return "".join(self.head) + "".join(self.tail)
+        return "".join(self.head) + marker.format(lines=self.omitted_lines, bytes=self.omitted_bytes) + "".join(self.tail)
+
+
+class OutputCapture:
+    """
+    有界的代码执行输出捕获
+    - 推送给前端和反馈给 LLM 分别有独立的字节 / 行数上限，超出后保留首尾并插入省略标记
+    - 输出超出任一上限时，完整日志写入 output/ 目录供下载；日志本身也有大小上限
+    """
+
+    def __init__(
+        self,
+        spill_dir: str,
+        client_max_bytes: int = 256 * 1024,
+        client_max_lines: int = 4000,
+        llm_max_bytes: int = 16 * 1024,
+        llm_max_lines: int = 400,
+        spill_max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.spill_dir = spill_dir
+        self.client = _HeadTail(client_max_bytes, client_max_lines)
+        self.llm = _HeadTail(llm_max_bytes, llm_max_lines)
+        self.total_bytes = 0
+        self.total_lines = 0
+        self.spill_name: Optional[str] = None
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_truncated = False
+        self._spill_bytes = 0
+        self._spill_file = None
+        self._pending: List[str] = []
+        self._client_notice_sent = False
+
+    def _spill(self, text: str):
+        if self._spill_file is None:
+            if not (self.client.overflowed or self.llm.overflowed):
+                self._pending.append(text)
+                return
+            os.makedirs(self.spill_dir, exist_ok=True)
+            path = uniquify_path(Path(self.spill_dir) / f"exec_log_{int(time.time())}_{uuid.uuid4().hex[:6]}.log")
+            self._spill_file = open(path, "w", encoding="utf-8")
+            self.spill_name = path.name
+            self._spill_file.writelines(self._pending)
+            self._spill_bytes = sum(len(t.encode("utf-8")) for t in self._pending)
+            self._pending = []
+        if self.spill_truncated:
+            return
+        size = len(text.encode("utf-8"))
+        if self._spill_bytes + size > self.spill_max_bytes:
+            self.spill_truncated = True
+            self._spill_file.write(f"\n[... 日志超过 {self.spill_max_bytes} 字节，后续输出已丢弃 ...]\n")
+            return
+        self._spill_bytes += size
+        self._spill_file.write(text)
+
+    def feed(self, text: str) -> str:
+        """捕获一段输出，返回应该实时推送给前端的部分"""
+        self.total_bytes += len(text.encode("utf-8"))
+        self.total_lines += text.count("\n")
+        visible = self.client.add(text)
+        self.llm.add(text)
+        self._spill(text)
+        if self.client.overflowed and not self._client_notice_sent:
+            self._client_notice_sent = True
+            visible += "\n[... 输出过长，中间部分不再实时显示，结束后显示末尾 ...]\n"
+        return visible
+
+    def finish(self) -> str:
+        """执行结束：关闭日志文件，返回需要补发给前端的末尾部分"""
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        self._pending = []
+        if not self.client.overflowed:
+            return ""
+        note = f"[... 已省略 {self.client.omitted_lines} 行 / {self.client.omitted_bytes} 字节"
+        note += f"，完整日志: output/{self.spill_name} ...]\n" if self.spill_name else " ...]\n"
+        return note + "".join(self.client.tail)
+
+    def llm_text(self) -> str:
+        """反馈给 LLM 的输出（首尾保留）"""
+        marker = "\n[... 已省略 {lines} 行 / {bytes} 字节输出"
+        marker += f"，完整日志: output/{self.spill_name} ...]\n" if self.spill_name else " ...]\n"
+        return self.llm.render(marker)
+
+
 def execute_code_safe(code_str: str, workspace_dir: str, timeout_sec: int = 60) -> tuple[str, List[str]]:
     """在独立进程中执行 Python 代码，并返回 (output, new_artifacts)"""
     # 初始化 Tracker（这里是临时的，只是为了diff这次执行的变化）
@@ -169,54 +481,3 @@ def execute_code_safe(code_str: str, workspace_dir: str, timeout_sec: int = 60)
     # 这需要深度修改 execute_code_safe 和 main.py 的调用逻辑。
     # 我们先不改 utils 的签名，而是新增一个 generator 版本的 execute_code_stream
     pass
-
-def execute_code_stream(code_str: str, workspace_dir: str, timeout_sec: int = 60):
-    """
-    Generator that yields stdout/stderr chunks as they happen.
-    """
-    exec_cwd = os.path.abspath(workspace_dir)
-    os.makedirs(exec_cwd, exist_ok=True)
-    tmp_path = None
-    
-    try:
-        fd, tmp_path = tempfile.mkstemp(suffix=".py", dir=exec_cwd)
-        os.close(fd)
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            f.write(code_str)
-
-        child_env = os.environ.copy()
-        child_env.setdefault("MPLBACKEND", "Agg")
-        child_env.pop("DISPLAY", None)
-        
-        process = subprocess.Popen(
-            [sys.executable, tmp_path],
-            cwd=exec_cwd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT, # Merge stderr into stdout
-            text=True,
-            bufsize=1, # Line buffered
-            universal_newlines=True,
-            env=child_env
-        )
-        
-        # Stream output
-        if process.stdout:
-            for line in process.stdout:
-                yield line
-                
-        process.wait(timeout=timeout_sec)
-        
-        if process.returncode != 0:
-            yield f"\n[Process exited with code {process.returncode}]"
-
-    except subprocess.TimeoutExpired:
-        process.kill()
-        yield f"\n[Timeout]: execution exceeded {timeout_sec} seconds"
-    except Exception as e:
-        yield f"\n[Error]: {str(e)}"
-    finally:
-        try:
-            if tmp_path and os.path.exists(tmp_path):
-                os.remove(tmp_path)
-        except Exception:
-            pass
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""
+WebSocket 发送缓冲
+
+LLM token 和代码输出不再逐条 send_json，而是按时间窗口 / 字节阈值合并发送：
+- 相邻的 stream_token 合并为一条
+- 一次刷新中有多条帧时打包成 {"type": "batch", "frames": [...]}
+- 客户端跟不上时，可丢弃的输出（代码 stdout）只保留首尾并标注跳过的字节数；
+  不可丢弃的内容（LLM token）超过上限时让生产者等待
+"""
+import json
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 单条 stream_token 帧的 JSON 外壳大小，用于估算合并节省的字节数
+TOKEN_FRAME_OVERHEAD = len(json.dumps({"type": "stream_token", "content": ""}))
+
+
+def _dumps(frame: Dict[str, Any]) -> str:
+    return json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
+
+
+class _TokenRun:
+    """一段待发送的连续 token；可丢弃的输出超过上限后只保留首尾"""
+
+    def __init__(self, droppable: bool, keep_bytes: int):
+        self.droppable = droppable
+        self.keep_bytes = keep_bytes
+        self.head: List[str] = []
+        self.head_bytes = 0
+        self.tail: List[str] = []
+        self.tail_bytes = 0
+        self.dropped_bytes = 0
+        self.count = 0
+
+    @property
+    def size(self) -> int:
+        return self.head_bytes + self.tail_bytes
+
+    def append(self, content: str, limit: Optional[int]):
+        self.count += 1
+        size = len(content.encode("utf-8"))
+        if limit is None or not self.tail and self.head_bytes + size <= limit:
+            self.head.append(content)
+            self.head_bytes += size
+            return
+
+        # 超出上限：保留开头一部分，之后只维护一个尾部窗口
+        self.tail.append(content)
+        self.tail_bytes += size
+        while self.tail and self.tail_bytes > self.keep_bytes:
+            removed = self.tail.pop(0)
+            removed_size = len(removed.encode("utf-8"))
+            self.tail_bytes -= removed_size
+            self.dropped_bytes += removed_size
+
+    def render(self) -> str:
+        if not self.dropped_bytes:
+            return "".join(self.head) + "".join(self.tail)
+        marker = f"\n[... 客户端接收过慢，已跳过 {self.dropped_bytes} 字节输出 ...]\n"
+        return "".join(self.head) + marker + "".join(self.tail)
+
+
+class BufferedSender:
+    """每个 WebSocket 连接一个发送缓冲，由后台任务按窗口刷新"""
+
+    def __init__(
+        self,
+        websocket,
+        flush_interval: float = 0.03,
+        flush_bytes: int = 16 * 1024,
+        max_pending_bytes: int = 256 * 1024,
+        keep_bytes: int = 16 * 1024,
+    ):
+        self.websocket = websocket
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.max_pending_bytes = max_pending_bytes
+        self.keep_bytes = keep_bytes
+
+        self._pending: List[Any] = []  # dict 控制帧 或 _TokenRun
+        self._pending_bytes = 0
+        self._wakeup = asyncio.Event()
+        self._urgent = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+        self.frames_in = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+        self.bytes_dropped = 0
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    async def send_json(self, frame: Dict[str, Any]):
+        """控制帧：保持顺序，立即触发刷新"""
+        self._check()
+        self.frames_in += 1
+        self._pending.append(frame)
+        self._drained.clear()
+        self._wakeup.set()
+        self._urgent.set()
+
+    async def send_token(self, content: str, droppable: bool = False):
+        """流式文本：合并到上一段连续 token 中，按窗口刷新"""
+        self._check()
+        if not content:
+            return
+        # 不可丢弃的内容积压过多时等待客户端消化（背压）
+        if not droppable and self._pending_bytes >= self.max_pending_bytes:
+            await self._drained.wait()
+            self._check()
+
+        self.frames_in += 1
+        run = self._pending[-1] if self._pending else None
+        if not isinstance(run, _TokenRun) or run.droppable != droppable:
+            run = _TokenRun(droppable, self.keep_bytes)
+            self._pending.append(run)
+
+        before = run.size
+        run.append(content, self.max_pending_bytes if droppable else None)
+        self._pending_bytes += run.size - before
+        self._drained.clear()
+        self._wakeup.set()
+        if self._pending_bytes >= self.flush_bytes:
+            self._urgent.set()
+
+    async def flush(self):
+        """等待当前缓冲全部发送完毕"""
+        self._check()
+        self._urgent.set()
+        await self._drained.wait()
+        self._check()
+
+    def _take(self) -> List[Dict[str, Any]]:
+        frames: List[Dict[str, Any]] = []
+        for item in self._pending:
+            if isinstance(item, _TokenRun):
+                self.bytes_dropped += item.dropped_bytes
+                content = item.render()
+                frames.append({"type": "stream_token", "content": content})
+                # 每个原始 token 单独发送时的外壳开销
+                self.bytes_saved += TOKEN_FRAME_OVERHEAD * (item.count - 1)
+            else:
+                frames.append(item)
+        self._pending = []
+        self._pending_bytes = 0
+        return frames
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                if not self._pending and self._closed:
+                    break
+                if not self._urgent.is_set():
+                    try:
+                        await asyncio.wait_for(self._urgent.wait(), timeout=self.flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
+                self._urgent.clear()
+
+                frames = self._take()
+                if frames:
+                    if len(frames) == 1:
+                        payload = _dumps(frames[0])
+                    else:
+                        payload = _dumps({"type": "batch", "frames": frames})
+                    await self.websocket.send_text(payload)
+                    self.frames_sent += 1
+                    self.bytes_sent += len(payload.encode("utf-8"))
+
+                if not self._pending:
+                    self._drained.set()
+                    if self._closed:
+                        break
+        except BaseException as e:
+            # 连接断开等错误在下一次 send 时抛给调用方
+            self._error = e
+            self._drained.set()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+    async def close(self):
+        """刷新剩余内容并停止后台任务"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._urgent.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=5)
+        except BaseException:
+            self._task.cancel()
+        logger.info(f"WebSocket sender stats: {self.stats()}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "frames_in": self.frames_in,
+            "frames_sent": self.frames_sent,
+            "bytes_sent": self.bytes_sent,
+            "bytes_saved": self.bytes_saved,
+            "bytes_dropped": self.bytes_dropped,
+        }
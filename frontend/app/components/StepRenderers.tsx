@@ -83,9 +83,22 @@ export const StepRenderer: React.FC<StepRendererProps> = ({ step, isLast }) => {
                   const url = `http://127.0.0.1:8080/${cleanPath}`;
                   
                   if (isImage) {
+                      // Load the small WebP preview first (click opens the original); SVGs have no thumbnail
+                      const thumbUrl = /\.svg$/i.test(fileName) ? url : `http://127.0.0.1:8080/thumbnails/${cleanPath}`;
                       return (
                           <div key={idx} className="border rounded-lg overflow-hidden bg-gray-100 dark:bg-gray-800">
-                              <img src={url} alt={fileName} className="w-full h-auto object-contain max-h-[300px]" />
+                              <a href={url} target="_blank" rel="noopener noreferrer">
+                                  <img
+                                    src={thumbUrl}
+                                    alt={fileName}
+                                    loading="lazy"
+                                    onError={(e) => {
+                                        const img = e.currentTarget;
+                                        if (img.src !== url) img.src = url;
+                                    }}
+                                    className="w-full h-auto object-contain max-h-[300px]"
+                                  />
+                              </a>
                               <div className="p-2 text-xs text-center truncate" title={fileName}>{fileName}</div>
                           </div>
                       );
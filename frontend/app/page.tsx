@@ -70,8 +70,18 @@ export default function Home() {
   };
 
   const fetchOutputs = async () => {
+    // Outputs are scoped to the current session; there is nothing to list before one is assigned
+    const sessionId = localStorage.getItem('session_id');
+    if (!sessionId) {
+      setOutputs([]);
+      return;
+    }
     try {
-      const res = await fetch('http://127.0.0.1:8080/outputs');
+      const res = await fetch(`http://127.0.0.1:8080/outputs?session_id=${encodeURIComponent(sessionId)}`);
+      if (!res.ok) {
+        setOutputs([]);
+        return;
+      }
       const data = await res.json();
       setOutputs(data);
     } catch (e) {
@@ -144,7 +154,10 @@ export default function Home() {
 
   const connectWebSocket = () => {
     if (wsRef.current) return;
-    const ws = new WebSocket('ws://127.0.0.1:8080/ws/chat');
+    // 带上已保存的会话 ID，断线重连后后端从快照恢复上下文
+    const savedSession = localStorage.getItem('session_id');
+    const query = savedSession ? `?session_id=${encodeURIComponent(savedSession)}` : '';
+    const ws = new WebSocket(`ws://127.0.0.1:8080/ws/chat${query}`);
     
     ws.onopen = () => {
       console.log('Connected to WS');
@@ -152,8 +165,21 @@ export default function Home() {
 
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
-      
-      if (data.type === 'stream_start') {
+      // 后端会把同一时间窗口内的多条帧打包成 batch，React 会把其中的状态更新合并为一次渲染
+      const frames = data.type === 'batch' ? data.frames : [data];
+      for (const frame of frames) {
+        handleFrame(frame);
+      }
+    };
+
+    const handleFrame = (data: any) => {
+      if (data.type === 'session') {
+        localStorage.setItem('session_id', data.session_id);
+        fetchOutputs();
+        if (data.resumed) {
+          console.log(`Session ${data.session_id} resumed in ${data.restore_ms}ms`);
+        }
+      } else if (data.type === 'stream_start') {
         setStatus('busy');
         // Create a new empty assistant message if the last one isn't from assistant or is "done"
         setMessages(prev => {
@@ -198,6 +224,13 @@ export default function Home() {
           // Real-time refresh of outputs
           fetchOutputs();
           fetchFiles(); 
+      } else if (data.type === 'report_job') {
+          // 报告 PDF 在后台渲染，完成后刷新产物列表
+          if (data.status === 'done') {
+            fetchOutputs();
+          } else if (data.status === 'failed') {
+            console.error("Report render failed", data.error);
+          }
       } else if (data.type === 'step_update') {
           setCurrentStep(data.current);
       } else if (data.type === 'done') {
@@ -209,7 +242,9 @@ export default function Home() {
 
     ws.onclose = () => {
       console.log('WS Closed');
-      wsRef.current = null;
+      if (wsRef.current === ws) {
+        wsRef.current = null;
+      }
       // Reconnect after a delay if needed
     };
 
@@ -564,6 +599,12 @@ export default function Home() {
                     onClick={() => {
                         setMessages([]);
                         localStorage.removeItem('chat_history');
+                        // 清除对话时开始新的会话
+                        localStorage.removeItem('session_id');
+                        setOutputs([]);
+                        wsRef.current?.close();
+                        wsRef.current = null;
+                        connectWebSocket();
                     }}
                     className="p-3 text-gray-500 hover:bg-gray-100 rounded-lg"
                     title="清除对话"